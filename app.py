@@ -1,13 +1,19 @@
 from flask import (
     Flask, render_template, request,
-    redirect, session, send_from_directory,
-    jsonify, url_for, abort
+    redirect, session,
+    jsonify, url_for, abort, make_response, g, send_from_directory
 )
 from werkzeug.utils import secure_filename
-from functools import wraps
+import hmac
+import math
 import os
+import time
 
-from config import SECRET_KEY, MEDIA_DIR, ALLOWED_EXT
+from config import (
+    SECRET_KEY, MEDIA_DIR, ALLOWED_EXT, ADMIN_PAGE_SIZE, HLS_ENABLED,
+    UPLOAD_CHUNK_SIZE, UPLOAD_PARALLEL, METRICS_ENABLED, METRICS_TOKEN,
+    SERVE_PORT, FEDERATION_ROUTING,
+)
 
 from services.auth import login_user, register_user
 from services.media import (
@@ -18,24 +24,43 @@ from services.media import (
 )
 from services.db_init import init_db
 from services.media_scan import scan_media
-from services.watch import update_progress
-from services.roles import role_required
+from services.watch import update_progress, parse_progress, start_progress_flusher
+from services.search import suggest
+from services.hls import start_package, resolve_hls_path, wait_for_file, touch
+from services.transcode import playable_path, transcode_stats
+from services.probe import backfill_probes, duration_of
+from services.trickplay import trickplay_url
+from services.thumbnails import VARIANT_DIR
+from services.uploads import (
+    UploadError,
+    create_upload,
+    upload_status,
+    write_chunk,
+    complete_upload,
+    abort_upload,
+    expire_uploads,
+    start_expiry,
+    register_media,
+    reserve_name,
+)
+from services.cache import page_tag, rendered_pages
+from services.fingerprint import canonical_id, refresh_aliases, enqueue_backfill
+from services.permissions import (
+    login_required, role_required, invalidate_user, get_current_user,
+)
+from services.streaming import resolve_media_path, stream_file, stream_remux, proxy_stream
+from services.remux import remux_method
+from services.jobs import start_workers
+from services.watcher import start_watcher
+from services import bandwidth, federation, metrics, profiler
 
-from models.base import execute, query
+from models.base import execute, query, release_db
 from werkzeug.security import generate_password_hash
 
 # ================= APP =================
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
-
-# ================= LOGIN REQUIRED =================
-def login_required(view):
-    @wraps(view)
-    def wrapped(*args, **kwargs):
-        if "user_id" not in session:
-            return redirect(url_for("login_view"))
-        return view(*args, **kwargs)
-    return wrapped
+app.teardown_appcontext(release_db)
 
 # ================= ROOT ADMIN BOOTSTRAP =================
 def ensure_root_admin():
@@ -58,44 +83,265 @@ def ensure_root_admin():
             )
         )
 
-# ================= INIT =================
-with app.app_context():
-    init_db()
-    ensure_root_admin()
-    added = scan_media()
-    print(f"[MEDIA SCAN] Added {added} new items")
+# ================= STARTUP =================
+# Importing this module has no side effects: serve.py initializes once
+# in its master process and forks workers; single-process entry points
+# call bootstrap().
+app.config["READY"] = False
+app.config["DRAINING"] = False
+
+def initialize(scan=True):
+    """
+    One-time startup work: schema, root account, library scan and
+    backfill jobs.
+    """
+    with app.app_context():
+        init_db()
+        ensure_root_admin()
+        if scan:
+            report = scan_media()
+            print(
+                "[MEDIA SCAN] Added {added}, removed {removed}, moved {moved}, "
+                "modified {modified}, unchanged {unchanged}".format(**report)
+            )
+        refresh_aliases()
+        enqueue_backfill()
+        backfill_probes()
+        expire_uploads()
+
+def start_background():
+    """
+    Job workers and the library watcher; one set per deployment.
+    """
+    start_workers(app)
+    start_watcher(app)
+    start_expiry()
+    federation.start_sync()
+
+def bootstrap():
+    """
+    Everything in this process (python app.py, asgi.py).
+    """
+    initialize()
+    start_background()
+    start_progress_flusher(app)
+    app.config["READY"] = True
+
+# ================= INSTRUMENTATION =================
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_timing(resp):
+    started = g.pop("started", None)
+    if started is not None:
+        # the rule, not the path, keeps label cardinality bounded
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - started,
+            route=rule,
+            method=request.method,
+            status=resp.status_code,
+        )
+    return resp
+
+@app.route("/metrics")
+def metrics_view():
+    if not METRICS_ENABLED:
+        abort(404)
+    if METRICS_TOKEN:
+        sent = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(sent, f"Bearer {METRICS_TOKEN}"):
+            abort(401)
+
+    resp = make_response(metrics.render())
+    resp.mimetype = "text/plain"
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+# ================= HEALTH =================
+@app.route("/healthz")
+def healthz():
+    return jsonify({"ok": True, "pid": os.getpid()})
+
+@app.route("/readyz")
+def readyz():
+    """
+    200 once this worker has started and can reach the DB; 503 while
+    starting or draining, so a balancer or the launcher can wait.
+    """
+    ready = app.config["READY"] and not app.config["DRAINING"]
+    if ready:
+        try:
+            query("SELECT 1", one=True)
+        except Exception:
+            ready = False
+
+    resp = jsonify({"ready": ready, "pid": os.getpid()})
+    resp.status_code = 200 if ready else 503
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
 
 # ================= HOME =================
 @app.route("/")
 def index():
     user_id = session.get("user_id")
+    role = session.get("role")
+
+    # Same catalog + same progress -> same page. Polling clients get a
+    # 304 without touching the DB; the rest reuse the rendered HTML.
+    tag = page_tag(user_id, role, request.query_string)
+    if request.if_none_match.contains_weak(tag):
+        resp = app.response_class(status=304)
+    else:
+        key = (user_id, role, request.query_string)
+        hit = rendered_pages.get(key)
+        if hit and hit[0] == tag:
+            html = hit[1]
+        else:
+            q = request.args.get("q")
+            category = request.args.get("category")
+
+            media, next_cursor = list_media(
+                user_id=user_id,
+                q=q,
+                category=category
+            )
 
-    q = request.args.get("q")
-    category = request.args.get("category")
+            html = render_template(
+                "index.html",
+                media=media,
+                next_cursor=next_cursor,
+                q=q,
+                category=category
+            )
+            rendered_pages.put(key, (tag, html), size=len(html))
+        resp = make_response(html)
+
+    resp.set_etag(tag, weak=True)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# ================= CATALOG PAGES (INFINITE SCROLL) =================
+@app.route("/api/media")
+def api_media():
+    try:
+        media, next_cursor = list_media(
+            user_id=session.get("user_id"),
+            q=request.args.get("q"),
+            category=request.args.get("category"),
+            cursor=request.args.get("cursor"),
+        )
+    except ValueError:
+        abort(400)
 
-    media = list_media(
-        user_id=user_id,
-        q=q,
-        category=category
-    )
+    return jsonify({"items": media, "next": next_cursor})
 
-    return render_template(
-        "index.html",
-        media=media,
-        q=q,
-        category=category
-    )
+# ================= SEARCH AUTOCOMPLETE =================
+@app.route("/search/suggest")
+def search_suggest():
+    q = request.args.get("q", "").strip()
+    if not q:
+        return jsonify([])
+    return jsonify(suggest(q))
 
 # ================= PROTECTED MEDIA =================
 @app.route("/media/<path:filename>")
-@login_required
 def media_file(filename):
-    return send_from_directory(MEDIA_DIR, filename)
+    # ?remux=<seconds>: MKV/AVI as live fragmented MP4 from that point
+    remux_at = request.args.get("remux")
+    if remux_at is not None:
+        try:
+            remux_at = float(remux_at)
+        except ValueError:
+            abort(400)
+        if not math.isfinite(remux_at):
+            abort(400)
+        remux_at = max(0.0, remux_at)
+
+    user = get_current_user()
+    if user is None:
+        token = request.args.get("fed")
+        if token is None:
+            return redirect(url_for("login_view"))
+        # a peer's user, sent here for a file in our MEDIA_DIR
+        user = federation.token_user(token, filename)
+        if user is None:
+            abort(403)
+        return _serve_media(filename, user, remux_at)
+
+    try:
+        url, path = federation.route(filename, user)
+    except LookupError:
+        abort(503)
+
+    if url is None:
+        return _serve_media(path, user, remux_at)
+    if remux_at is not None:
+        url += f"&remux={remux_at:g}"
+    if FEDERATION_ROUTING == "proxy":
+        return proxy_stream(url, user)
+    return redirect(url)
+
+def _serve_media(filename, user, remux_at):
+    path = resolve_media_path(filename)
+    if remux_at is not None:
+        method = remux_method(filename)
+        if method:
+            return stream_remux(path, filename, method, remux_at, user)
+    return stream_file(path, user)
+
+# ================= HLS (ADAPTIVE BITRATE) =================
+@app.route("/hls/<int:media_id>/master.m3u8")
+@login_required
+def hls_master(media_id):
+    if not HLS_ENABLED:
+        abort(404)
+
+    media_id = canonical_id(media_id)  # duplicates share one package
+
+    try:
+        start_package(media_id)
+    except FileNotFoundError:
+        abort(404)
+    except (RuntimeError, OSError):
+        abort(503)
+
+    touch(media_id)
+    path = resolve_hls_path(media_id, "master.m3u8")
+    # another worker may have claimed the package a moment ago
+    if not path.exists() and not wait_for_file(path, media_id):
+        abort(404)
+    return stream_file(path)
+
+@app.route("/hls/<int:media_id>/<path:name>")
+@login_required
+def hls_file(media_id, name):
+    media_id = canonical_id(media_id)
+    path = resolve_hls_path(media_id, name)
+
+    # the player may ask for a playlist/segment just ahead of ffmpeg
+    if not path.exists() and not wait_for_file(path, media_id):
+        abort(404)
+
+    if name.endswith(".m3u8"):
+        touch(media_id)
+    return stream_file(path)
+
+# ================= THUMBNAILS =================
+@app.route("/thumbs/<name>")
+def thumb_variant(name):
+    resp = send_from_directory(VARIANT_DIR.resolve(), name)
+    # names change with the bytes, so a copy never goes stale
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
 
 # ================= WATCH =================
 @app.route("/watch/<int:media_id>")
 def watch(media_id):
-    media = get_media_by_id(media_id)
+    media = get_media_by_id(media_id, session.get("user_id"))
 
     if not media:
         abort(404)
@@ -106,25 +352,53 @@ def watch(media_id):
     progress = media["progress"]
     next_media = get_next_media(media_id)
 
+    # titles on a peer are played from the file; packaging and
+    # previews happen where the file is
+    remote = federation.is_remote(media["filepath"])
+
+    hls_url = None
+    if HLS_ENABLED and media["is_video"] and not remote:
+        hls_url = url_for("hls_master", media_id=media_id)
+
+    previews_url = trickplay_url(media_id) if media["is_video"] and not remote else None
+
+    # MKV/AVI play from their MP4 variant once it exists; until then a
+    # live remux stands in when only the container needs changing
+    remux = None
+    if remote:
+        src, preparing = media["filepath"], False
+    else:
+        src, preparing = playable_path(media_id, media["filepath"])
+        if preparing and remux_method(media["filepath"], media_id):
+            src, preparing = media["filepath"], False
+            remux = {
+                "url": url_for("media_file", filename=src, remux=""),
+                "duration": duration_of(media_id),
+            }
+
     return render_template(
         "watch.html",
         media=media,
         episodes=episodes,
         progress=progress,
         next_media=next_media,
+        hls_url=hls_url,
+        previews_url=previews_url,
+        src=src,
+        preparing=preparing,
+        remux=remux,
     )
 
 # ================= SAVE WATCH PROGRESS =================
 @app.route("/progress", methods=["POST"])
 @login_required
 def save_progress():
-    data = request.get_json()
+    try:
+        media_id, progress, position = parse_progress(request.get_json(silent=True) or {})
+    except ValueError:
+        abort(400)
 
-    update_progress(
-        session["user_id"],
-        int(data["media_id"]),
-        int(data["progress"])
-    )
+    update_progress(session["user_id"], media_id, progress, position)
 
     return jsonify({"ok": True})
 
@@ -132,7 +406,101 @@ def save_progress():
 @app.route("/admin")
 @role_required("root", "admin")
 def admin_dashboard():
-    return render_template("admin/dashboard.html")
+    return render_template("admin/dashboard.html", transcode=transcode_stats())
+
+# ================= DIAGNOSTICS =================
+@app.route("/admin/diagnostics")
+@role_required("root", "admin")
+def admin_diagnostics():
+    return render_template(
+        "admin/diagnostics.html",
+        slow_ms=metrics.slow_query_threshold_ms(),
+        slow_queries=metrics.slow_query_log(),
+        profile=profiler.status(),
+        hot=profiler.top_functions(),
+    )
+
+@app.route("/admin/diagnostics/slow-queries", methods=["POST"])
+@role_required("root", "admin")
+def admin_slow_queries():
+    try:
+        ms = float(request.form.get("threshold_ms") or 0)
+    except ValueError:
+        abort(400)
+    metrics.set_slow_query_threshold(ms if ms > 0 else None)
+    return redirect(url_for("admin_diagnostics"))
+
+@app.route("/admin/diagnostics/profiler", methods=["POST"])
+@role_required("root", "admin")
+def admin_profiler():
+    if request.form.get("action") == "start":
+        profiler.start(request.form.get("seconds", type=float))
+    else:
+        profiler.stop()
+    return redirect(url_for("admin_diagnostics"))
+
+@app.route("/admin/diagnostics/profile.txt")
+@role_required("root", "admin")
+def admin_profile_download():
+    resp = make_response(profiler.collapsed())
+    resp.mimetype = "text/plain"
+    resp.headers["Content-Disposition"] = "attachment; filename=profile.txt"
+    return resp
+
+# ================= STREAMS (BANDWIDTH) =================
+ROLES = ("user", "admin", "root")
+
+@app.route("/admin/streams")
+@role_required("root", "admin")
+def admin_streams():
+    return render_template(
+        "admin/streams.html",
+        stats=bandwidth.snapshot(),
+        roles=ROLES,
+        policy=bandwidth.role_policy(),
+    )
+
+@app.route("/admin/streams.json")
+@role_required("root", "admin")
+def admin_streams_json():
+    return jsonify(bandwidth.snapshot())
+
+@app.route("/admin/streams/roles", methods=["POST"])
+@role_required("root", "admin")
+def admin_stream_roles():
+    role = request.form.get("role")
+    try:
+        weight = float(request.form.get("weight") or 1)
+        cap_mbps = float(request.form.get("cap_mbps") or 0)
+    except ValueError:
+        abort(400)
+    if not (math.isfinite(weight) and math.isfinite(cap_mbps)):
+        abort(400)  # nan slips through the comparisons below
+    if role not in ROLES or weight <= 0 or cap_mbps < 0:
+        abort(400)
+
+    bandwidth.set_role_policy(role, weight, cap_mbps)
+    return redirect(url_for("admin_streams"))
+
+# ================= FEDERATION =================
+@app.route("/federation/changes")
+def federation_changes():
+    if not federation.authorized(request.headers.get("Authorization")):
+        abort(404)
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        abort(400)
+    return jsonify(federation.feed(since))
+
+@app.route("/federation/thumbs/<int:media_id>")
+def federation_thumb(media_id):
+    location = federation.thumb_location(media_id)
+    if location is None:
+        abort(404)
+    resp = redirect(location)
+    resp.headers["Cache-Control"] = "public, max-age=300"
+    return resp
 
 # ================= USER MANAGEMENT =================
 @app.route("/admin/users")
@@ -158,10 +526,26 @@ def admin_users():
     elif status == "disabled":
         sql += " AND active = 0"
 
-    sql += " ORDER BY id"
+    cursor = request.args.get("cursor", type=int)
+    if cursor:
+        sql += " AND id > ?"
+        params.append(cursor)
+
+    sql += " ORDER BY id LIMIT ?"
+    params.append(ADMIN_PAGE_SIZE + 1)
 
     users = query(sql, tuple(params))
-    return render_template("admin/users.html", users=users)
+
+    next_cursor = None
+    if len(users) > ADMIN_PAGE_SIZE:
+        users = users[:ADMIN_PAGE_SIZE]
+        next_cursor = users[-1]["id"]
+
+    return render_template(
+        "admin/users.html",
+        users=users,
+        next_cursor=next_cursor
+    )
 
 @app.route("/admin/users/create", methods=["POST"])
 @role_required("root")
@@ -181,13 +565,14 @@ def create_admin_user():
     if existing:
         abort(400)
 
-    execute(
+    user_id = execute(
         """
         INSERT INTO users (username, password, role, active)
         VALUES (?, ?, ?, 1)
         """,
         (username, generate_password_hash(password), role)
     )
+    invalidate_user(user_id)
 
     return redirect(url_for("admin_users"))
 
@@ -207,6 +592,7 @@ def toggle_user(user_id):
         "UPDATE users SET active = NOT active WHERE id=?",
         (user_id,)
     )
+    invalidate_user(user_id)  # a disabled user loses access immediately
 
     return redirect(url_for("admin_users"))
 
@@ -228,17 +614,72 @@ def upload_media():
         if ext not in ALLOWED_EXT:
             abort(400)
 
-        path = MEDIA_DIR / filename
-        file.save(path)
-
-        execute(
-            "INSERT INTO media (title, filepath, category) VALUES (?, ?, ?)",
-            (title, filename, category)
-        )
+        # plain form fallback (no JS); the page normally uses /api/uploads
+        filename = reserve_name(filename)
+        file.save(MEDIA_DIR / filename)
+        register_media(filename, title, category)
 
         return redirect(url_for("admin_dashboard"))
 
-    return render_template("admin/upload.html")
+    return render_template(
+        "admin/upload.html",
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        parallel=UPLOAD_PARALLEL,
+    )
+
+# ================= RESUMABLE UPLOADS =================
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({"error": str(e)}), e.status
+
+@app.route("/api/uploads", methods=["POST"])
+@role_required("root", "admin")
+def upload_create():
+    data = request.get_json(silent=True) or {}
+    status = create_upload(
+        data.get("filename"),
+        data.get("size"),
+        data.get("title"),
+        data.get("category"),
+        data.get("chunk_size"),
+    )
+    resp = jsonify(status)
+    resp.status_code = 201
+    resp.headers["Location"] = url_for("upload_info", upload_id=status["id"])
+    return resp
+
+@app.route("/api/uploads/<upload_id>", methods=["GET"])
+@role_required("root", "admin")
+def upload_info(upload_id):
+    status = upload_status(upload_id)
+    resp = jsonify(status)
+    resp.headers["Upload-Offset"] = str(status["offset"])
+    resp.headers["Upload-Length"] = str(status["size"])
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+@app.route("/api/uploads/<upload_id>/chunks/<int:index>", methods=["PUT"])
+@role_required("root", "admin")
+def upload_chunk(upload_id, index):
+    status = write_chunk(
+        upload_id,
+        index,
+        request.stream,
+        request.content_length,
+        request.headers.get("Upload-Checksum"),
+    )
+    return jsonify({"received": len(status["received"]), "chunks": status["chunks"]})
+
+@app.route("/api/uploads/<upload_id>/complete", methods=["POST"])
+@role_required("root", "admin")
+def upload_complete(upload_id):
+    return jsonify(complete_upload(upload_id))
+
+@app.route("/api/uploads/<upload_id>", methods=["DELETE"])
+@role_required("root", "admin")
+def upload_abort(upload_id):
+    abort_upload(upload_id)
+    return "", 204
 
 # ================= LOGIN =================
 @app.route("/login", methods=["GET", "POST"])
@@ -286,4 +727,7 @@ def logout():
 
 # ================= RUN =================
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    # the reloader's parent only watches files; the server runs in its child
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        bootstrap()
+    app.run(debug=True, host="0.0.0.0", port=SERVE_PORT)
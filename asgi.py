@@ -0,0 +1,23 @@
+"""
+ASGI entry point: the same app, with media streams, progress posts and
+catalog JSON served on an event loop (see services/asgi.py).
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --no-access-log
+    python asgi.py
+
+Single process; for several workers use `python serve.py --asgi`.
+"""
+
+from app import app, bootstrap
+from services.asgi import make_asgi
+
+bootstrap()
+application = make_asgi(app)
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("ASGI mode needs an ASGI server: pip install uvicorn")
+
+    uvicorn.run(application, host="0.0.0.0", port=5000, access_log=False)
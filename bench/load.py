@@ -0,0 +1,489 @@
+"""
+Mixed-traffic load test for the catalog, player and streaming endpoints.
+
+Builds a synthetic library in a throwaway directory, boots the full app
+on it and lets simulated viewers hit `/`, `/watch/<id>`, ranged
+`/media/...` reads, `/progress` posts and `/login` in a weighted mix.
+Reports throughput, latency and time-to-first-byte percentiles and
+bytes/sec per endpoint, and writes them to JSON for comparison.
+
+    python -m bench.load --viewers 32 --duration 30
+    python -m bench.load --mix home=1,watch=1,media=8,progress=4,login=0
+    python -m bench.load --compare bench/results/<older>.json
+
+Against a running instance (every viewer logs in with one account):
+
+    python -m bench.load --url http://tv-box:5000 --user alice --password ...
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+DEFAULT_MIX = "home=3,watch=2,media=10,progress=4,login=1"
+CATEGORIES = ["movies", "series", "documentaries", "kids", "music"]
+
+
+# ----------------------------
+# Synthetic library
+# ----------------------------
+
+def make_library(root: Path, items: int, size_mb: int):
+    """
+    `items` sparse files of `size_mb` each: a random head (so every
+    file fingerprints differently) and holes that read back as zeros.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    for n in range(items):
+        category = CATEGORIES[n % len(CATEGORIES)]
+        (root / category).mkdir(exist_ok=True)
+        with open(root / category / f"bench_title_{n:05d}.mp4", "wb") as f:
+            f.write(os.urandom(64 * 1024))
+            f.truncate(size_mb * 1024 * 1024)
+
+
+def boot_local(workdir: Path, items: int, size_mb: int, users: int):
+    """
+    Imports the app inside `workdir` (DB, caches and thumbnails land
+    there), serves it on an ephemeral port and creates bench accounts.
+    Returns (server, base url, [(username, password)]).
+    """
+    make_library(workdir / "media", items, size_mb)
+
+    os.environ["MEDIA_DIR"] = str(workdir / "media")
+    os.environ.setdefault("WATCH_MODE", "off")
+    os.chdir(workdir)
+    sys.path.insert(0, str(REPO_DIR))
+
+    from werkzeug.serving import make_server
+
+    import app as webapp
+    from services.auth import register_user
+    from services.jobs import queue_depth
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    webapp.bootstrap()
+
+    accounts = []
+    with webapp.app.app_context():
+        for n in range(users):
+            username, password = f"bench{n}", f"bench-pass-{n}"
+            register_user(username, password)
+            accounts.append((username, password))
+
+        # Probe/thumbnail jobs for the new library would otherwise
+        # compete with the measured requests
+        deadline = time.monotonic() + 120
+        while queue_depth() and time.monotonic() < deadline:
+            time.sleep(0.5)
+
+    server = make_server("127.0.0.1", 0, webapp.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}", accounts
+
+
+def stop_local(server):
+    """
+    Stops the local server and the app's background threads, so none
+    of them writes into the temp directory while it is removed.
+    """
+    import app as webapp
+    from services.jobs import stop_workers
+    from services.watch import flush_progress
+    from services.watcher import stop_watcher
+
+    server.shutdown()
+    stop_workers()
+    stop_watcher()
+    with webapp.app.app_context():
+        flush_progress()
+
+
+# ----------------------------
+# HTTP
+# ----------------------------
+
+def request(base, method, path, headers=None, body=None, read_limit=None):
+    """
+    One request on a fresh connection. Returns
+    (status, response headers, bytes read, ttfb s, total s).
+    """
+    parts = urlsplit(base)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    started = time.perf_counter()
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        ttfb = time.perf_counter() - started
+
+        read = 0
+        while read_limit is None or read < read_limit:
+            want = 64 * 1024 if read_limit is None else min(64 * 1024, read_limit - read)
+            data = resp.read(want)
+            if not data:
+                break
+            read += len(data)
+        total = time.perf_counter() - started
+        return resp.status, resp.headers, read, ttfb, total
+    finally:
+        conn.close()
+
+
+def discover_library(base, cookie):
+    """
+    [(media id, filepath, is_video)] from /api/media, all pages.
+    """
+    library, cursor = [], None
+    while True:
+        path = "/api/media" + (f"?{urlencode({'cursor': cursor})}" if cursor else "")
+        conn = http.client.HTTPConnection(urlsplit(base).hostname, urlsplit(base).port or 80)
+        conn.request("GET", path, headers={"Cookie": cookie})
+        page = json.loads(conn.getresponse().read())
+        conn.close()
+
+        library += [(m["id"], m["filepath"], m["is_video"]) for m in page["items"]]
+        cursor = page["next"]
+        if not cursor:
+            return library
+
+
+# ----------------------------
+# Viewers
+# ----------------------------
+
+class Recorder:
+    """
+    Samples per endpoint: (status, bytes read, ttfb, total).
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, name, status, nbytes, ttfb, total):
+        with self.lock:
+            self.samples[name].append((status, nbytes, ttfb, total))
+
+
+class Viewer:
+    """
+    One simulated browser: logs in, then picks actions from the mix
+    until told to stop. Keeps its session cookie and the home page's
+    ETag like a real browser does.
+    """
+
+    def __init__(self, base, account, library, mix, read_kb, recorder):
+        self.base = base
+        self.account = account
+        self.library = [m for m in library if m[2]] or library
+        self.actions, self.weights = zip(*mix.items())
+        self.read_bytes = read_kb * 1024
+        self.recorder = recorder
+        self.cookie = None
+        self.etag = None
+        self.positions = {}
+        self.sizes = {}
+
+    def _record(self, name, result):
+        status, _headers, nbytes, ttfb, total = result
+        if self.recorder:
+            self.recorder.add(name, status, nbytes, ttfb, total)
+
+    def _headers(self, **extra):
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        headers.update(extra)
+        return headers
+
+    def login(self):
+        username, password = self.account
+        result = request(
+            self.base, "POST", "/login",
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            body=urlencode({"username": username, "password": password}),
+        )
+        cookie = result[1].get("Set-Cookie")
+        if result[0] == 302 and cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        self._record("login", result)
+
+    def home(self):
+        headers = self._headers()
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        result = request(self.base, "GET", "/", headers=headers)
+        self.etag = result[1].get("ETag") or self.etag
+        self._record("home", result)
+
+    def watch(self):
+        media_id, _path, _video = random.choice(self.library)
+        self._record("watch", request(self.base, "GET", f"/watch/{media_id}",
+                                      headers=self._headers()))
+
+    def media(self):
+        _id, filepath, _video = random.choice(self.library)
+        # seek somewhere inside the file once its size is known
+        size = self.sizes.get(filepath)
+        offset = random.randrange(0, size) if size else 0
+        result = request(
+            self.base, "GET", f"/media/{filepath}",
+            headers=self._headers(Range=f"bytes={offset}-"),
+            read_limit=self.read_bytes,
+        )
+        total = (result[1].get("Content-Range") or "").rpartition("/")[2]
+        if total.isdigit():
+            self.sizes[filepath] = int(total)
+        self._record("media", result)
+
+    def progress(self):
+        media_id, _path, _video = random.choice(self.library)
+        position = self.positions.get(media_id, 0.0) + random.uniform(5, 30)
+        self.positions[media_id] = position
+        self._record("progress", request(
+            self.base, "POST", "/progress",
+            headers=self._headers(**{"Content-Type": "application/json"}),
+            body=json.dumps({"media_id": media_id, "position": position,
+                             "duration": 3600}),
+        ))
+
+    def run(self, stop):
+        self.login()
+        while not stop.is_set():
+            action = random.choices(self.actions, self.weights)[0]
+            try:
+                getattr(self, action)()
+            except OSError:
+                if self.recorder:
+                    self.recorder.add(action, 0, 0, 0.0, 0.0)
+
+
+# ----------------------------
+# Report
+# ----------------------------
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def summarize(samples, elapsed):
+    """
+    {endpoint: stats} plus an "all" row. Times are in milliseconds.
+    """
+    def stats(rows):
+        ok = [r for r in rows if 0 < r[0] < 500]
+        ttfb = [r[2] * 1000 for r in ok] or [0.0]
+        total = [r[3] * 1000 for r in ok] or [0.0]
+        nbytes = sum(r[1] for r in rows)
+        statuses = defaultdict(int)
+        for r in rows:
+            statuses[str(r[0])] += 1
+        return {
+            "requests": len(rows),
+            "errors": len(rows) - len(ok),
+            "statuses": dict(statuses),
+            "rps": len(rows) / elapsed,
+            "latency_ms": {
+                "mean": statistics.fmean(total),
+                "p50": percentile(total, 50),
+                "p95": percentile(total, 95),
+                "p99": percentile(total, 99),
+            },
+            "ttfb_ms": {
+                "p50": percentile(ttfb, 50),
+                "p95": percentile(ttfb, 95),
+                "p99": percentile(ttfb, 99),
+            },
+            "bytes": nbytes,
+            "bytes_per_sec": nbytes / elapsed,
+        }
+
+    report = {name: stats(rows) for name, rows in sorted(samples.items())}
+    report["all"] = stats([r for rows in samples.values() for r in rows])
+    return report
+
+
+def print_report(report, elapsed, viewers):
+    print(f"{viewers} viewers for {elapsed:.1f}s")
+    print(f"{'endpoint':<10}{'reqs':>8}{'err':>6}{'rps':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'ttfb95':>9}{'MB/s':>9}")
+    for name, s in report.items():
+        print(f"{name:<10}{s['requests']:>8}{s['errors']:>6}{s['rps']:>9.1f}"
+              f"{s['latency_ms']['p50']:>9.2f}{s['latency_ms']['p95']:>9.2f}"
+              f"{s['latency_ms']['p99']:>9.2f}{s['ttfb_ms']['p95']:>9.2f}"
+              f"{s['bytes_per_sec'] / 1e6:>9.2f}")
+
+
+def print_comparison(old, new):
+    """
+    Relative change of rps and p95 per endpoint; p95 up or rps down
+    by more than 10% is flagged.
+    """
+    print(f"\nvs {old['meta'].get('commit', '?')} ({old['meta'].get('started', '?')})")
+    print(f"{'endpoint':<10}{'rps':>18}{'p95 ms':>22}")
+    for name, s in new["endpoints"].items():
+        before = old["endpoints"].get(name)
+        if not before:
+            continue
+
+        def delta(a, b):
+            return (b - a) / a * 100 if a else 0.0
+
+        rps = delta(before["rps"], s["rps"])
+        p95 = delta(before["latency_ms"]["p95"], s["latency_ms"]["p95"])
+        flag = "  <-- regression" if rps < -10 or p95 > 10 else ""
+        print(f"{name:<10}{s['rps']:>9.1f} ({rps:+5.1f}%)"
+              f"{s['latency_ms']['p95']:>11.2f} ({p95:+5.1f}%){flag}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ----------------------------
+# Main
+# ----------------------------
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ("home", "watch", "media", "progress", "login"):
+            raise SystemExit(f"unknown action in --mix: {name!r}")
+        if float(weight or 1) > 0:
+            mix[name] = float(weight or 1)
+    if not mix:
+        raise SystemExit("--mix has no actions")
+    return mix
+
+
+def run(base, accounts, library, args):
+    mix = parse_mix(args.mix)
+    stop = threading.Event()
+    viewers = [
+        Viewer(base, accounts[n % len(accounts)], library, mix, args.read_kb, None)
+        for n in range(args.viewers)
+    ]
+    threads = [threading.Thread(target=v.run, args=(stop,), daemon=True) for v in viewers]
+    for t in threads:
+        t.start()
+
+    # warm-up traffic (logins, cold caches) isn't recorded
+    time.sleep(args.warmup)
+    recorder = Recorder()
+    for v in viewers:
+        v.recorder = recorder
+
+    started = time.perf_counter()
+    time.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - started
+    for t in threads:
+        t.join(timeout=30)
+
+    return summarize(recorder.samples, elapsed), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--viewers", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--read-kb", type=int, default=512,
+                        help="bytes read per ranged /media request")
+    parser.add_argument("--items", type=int, default=500)
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--url")
+    parser.add_argument("--user")
+    parser.add_argument("--password")
+    parser.add_argument("--out", help="JSON results path (default: bench/results/)")
+    parser.add_argument("--compare", help="earlier JSON results to diff against")
+    args = parser.parse_args()
+
+    # the local server runs inside a temp directory
+    for name in ("out", "compare"):
+        if getattr(args, name):
+            setattr(args, name, str(Path(getattr(args, name)).resolve()))
+
+    meta = {
+        "commit": git_commit(),
+        "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }
+
+    cwd = os.getcwd()
+    # a job may still have ffmpeg writing a thumbnail when we clean up
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        server = None
+        if args.url:
+            if not (args.user and args.password):
+                parser.error("--url needs --user and --password")
+            base, accounts = args.url.rstrip("/"), [(args.user, args.password)]
+        else:
+            print(f"[BENCH] Building {args.items} x {args.size_mb}MB library")
+            server, base, accounts = boot_local(Path(tmp), args.items, args.size_mb, args.users)
+
+        try:
+            probe = Viewer(base, accounts[0], [], {"login": 1}, 0, None)
+            probe.login()
+            if not probe.cookie:
+                raise SystemExit("[BENCH] Login failed")
+            library = discover_library(base, probe.cookie)
+            if not library:
+                raise SystemExit("[BENCH] Library is empty")
+
+            report, elapsed = run(base, accounts, library, args)
+            # written before the library is torn down, whatever happens then
+            results = save_results(report, elapsed, meta, args)
+        finally:
+            if server:
+                stop_local(server)
+                os.chdir(cwd)
+
+    if args.compare:
+        print_comparison(json.loads(Path(args.compare).read_text()), results)
+
+
+def save_results(report, elapsed, meta, args):
+    print_report(report, elapsed, args.viewers)
+    results = {"meta": {**meta, "elapsed": elapsed}, "endpoints": report}
+
+    out = Path(args.out) if args.out else RESULTS_DIR / (
+        f"load-{meta['started'].replace(':', '')[:17]}-{meta['commit'] or 'nogit'}.json"
+    )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(results, indent=2))
+    print(f"[BENCH] Results written to {out}")
+    return results
+
+if __name__ == "__main__":
+    main()
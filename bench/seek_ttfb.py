@@ -0,0 +1,139 @@
+"""
+Time-to-first-byte after a seek on /media.
+
+Spins up the streaming layer on a throwaway server with a synthetic
+file and fires random `Range: bytes=N-` requests at it, the way a
+<video> element does while scrubbing.
+
+    python -m bench.seek_ttfb --size-mb 512 --seeks 200 --clients 8
+    python -m bench.seek_ttfb --baseline      # send_from_directory
+
+Against a running instance (needs a logged-in session cookie):
+
+    python -m bench.seek_ttfb --url http://tv-box:5000/media/x.mp4 \
+        --cookie "session=..."
+"""
+
+import argparse
+import http.client
+import logging
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from flask import Flask, send_from_directory
+from werkzeug.serving import make_server
+
+from services.streaming import stream_file
+
+
+def make_library(root: Path, size_mb: int) -> Path:
+    path = root / "bench.mp4"
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+    return path
+
+
+def make_app(root: Path, baseline: bool) -> Flask:
+    app = Flask(__name__)
+
+    @app.route("/media/<path:filename>")
+    def media(filename):
+        if baseline:
+            return send_from_directory(root, filename)
+        return stream_file(root / filename)
+
+    return app
+
+
+def seek(url, offset, cookie=None, read_bytes=64 * 1024):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    headers = {"Range": f"bytes={offset}-"}
+    if cookie:
+        headers["Cookie"] = cookie
+
+    started = time.perf_counter()
+    conn.request("GET", parts.path, headers=headers)
+    resp = conn.getresponse()
+    resp.read(1)
+    ttfb = time.perf_counter() - started
+    resp.read(read_bytes)
+    first_chunk = time.perf_counter() - started
+    conn.close()
+
+    return resp.status, ttfb, first_chunk
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def run(url, size, seeks, clients, cookie=None):
+    offsets = [random.randrange(0, size) for _ in range(seeks)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(lambda o: seek(url, o, cookie), offsets))
+    elapsed = time.perf_counter() - started
+
+    statuses = {s for s, _, _ in results}
+    ttfb = [t * 1000 for _, t, _ in results]
+    chunk = [c * 1000 for _, _, c in results]
+
+    print(f"statuses        {sorted(statuses)}")
+    print(f"seeks           {seeks} over {clients} clients in {elapsed:.2f}s")
+    print(f"ttfb ms         p50={statistics.median(ttfb):.2f} "
+          f"p95={percentile(ttfb, 95):.2f} p99={percentile(ttfb, 99):.2f}")
+    print(f"first 64k ms    p50={statistics.median(chunk):.2f} "
+          f"p95={percentile(chunk, 95):.2f} p99={percentile(chunk, 99):.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--seeks", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--baseline", action="store_true")
+    parser.add_argument("--url")
+    parser.add_argument("--cookie")
+    args = parser.parse_args()
+
+    if args.url:
+        parts = urlsplit(args.url)
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+        conn.request("HEAD", parts.path,
+                     headers={"Cookie": args.cookie} if args.cookie else {})
+        size = int(conn.getresponse().getheader("Content-Length"))
+        run(args.url, size, args.seeks, args.clients, args.cookie)
+        return
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        make_library(root, args.size_mb)
+
+        server = make_server("127.0.0.1", 0, make_app(root, args.baseline),
+                             threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            url = f"http://127.0.0.1:{server.server_port}/media/bench.mp4"
+            run(url, args.size_mb * 1024 * 1024, args.seeks, args.clients)
+        finally:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,224 @@
 
 from pathlib import Path
 import os
+import socket
 
 MEDIA_DIR = Path(os.environ.get("MEDIA_DIR", "./media")).resolve()
-DB_PATH = Path("netflix_clone.db")
+DB_PATH = Path(os.environ.get("DB_PATH", "netflix_clone.db"))
 
 SECRET_KEY = "dev-secret"
 
 ALLOWED_EXT = {".mp4", ".mkv", ".webm", ".avi", ".mp3", ".ogg"}
 VIDEO_EXT = {".mp4", ".mkv", ".webm", ".avi"}
+
+# Streaming: read size for non-sendfile bodies, and the cap applied to
+# open-ended ranges ("bytes=N-") so one seek doesn't pin a whole file.
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 256 * 1024))
+STREAM_MAX_RANGE = int(os.environ.get("STREAM_MAX_RANGE", 8 * 1024 * 1024))
+STREAM_MAX_RANGES = 16
+
+# Background jobs (thumbnails, ...): each worker thread drives at most one
+# ffmpeg process, so this also bounds concurrent subprocesses.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+JOB_MAX_ATTEMPTS = 3
+
+# Library scanner: directories are listed concurrently (I/O bound on NAS
+# mounts) and DB writes are committed in batches.
+SCAN_WORKERS = int(os.environ.get("SCAN_WORKERS", 8))
+SCAN_BATCH = 500
+# Scans never delete media when the library looks absent rather than
+# emptied: MEDIA_DIR empty, MEDIA_DIR_MARKER (a file kept at its root,
+# e.g. ".library") set but missing, or more than
+# SCAN_MAX_REMOVE_FRACTION of the indexed files gone at once (past
+# SCAN_MAX_REMOVE_MIN). An unmounted share looks exactly like that.
+MEDIA_DIR_MARKER = os.environ.get("MEDIA_DIR_MARKER", "")
+SCAN_MAX_REMOVE_FRACTION = float(os.environ.get("SCAN_MAX_REMOVE_FRACTION", 0.5))
+SCAN_MAX_REMOVE_MIN = 20
+
+# Library watcher: "auto" uses inotify unless MEDIA_DIR is a network
+# mount, where it falls back to polling. "off" disables it.
+WATCH_MODE = os.environ.get("WATCH_MODE", "auto")
+WATCH_DEBOUNCE = float(os.environ.get("WATCH_DEBOUNCE", 2.0))
+WATCH_POLL_INTERVAL = float(os.environ.get("WATCH_POLL_INTERVAL", 15.0))
+
+# SQLite: connections are pooled and tuned once when opened.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 16))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", 5.0))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 32 * 1024))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))
+DB_STATEMENT_CACHE = 256
+
+# Watch progress is buffered in memory and written in one transaction
+# every PROGRESS_FLUSH_INTERVAL seconds or PROGRESS_FLUSH_SIZE entries.
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", 10.0))
+PROGRESS_FLUSH_SIZE = int(os.environ.get("PROGRESS_FLUSH_SIZE", 500))
+# where each process keeps its unflushed entries (one file per user and
+# process) so the others serve them too
+PROGRESS_STATE_DIR = Path(os.environ.get("PROGRESS_STATE_DIR", "cache/progress")).resolve()
+
+# Keyset pagination page sizes
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 48))
+ADMIN_PAGE_SIZE = 50
+
+# HLS packaging: (height, video kbps) rungs, never upscaled past the
+# source. Segments live under HLS_DIR, evicted LRU past HLS_CACHE_BYTES.
+HLS_ENABLED = os.environ.get("HLS_ENABLED", "1") == "1"
+HLS_DIR = Path(os.environ.get("HLS_DIR", "cache/hls")).resolve()
+HLS_CACHE_BYTES = int(os.environ.get("HLS_CACHE_BYTES", 20 * 1024 ** 3))
+HLS_LADDER = [(1080, 5000), (720, 2800), (480, 1400), (360, 800)]
+HLS_SEGMENT_TYPE = os.environ.get("HLS_SEGMENT_TYPE", "fmp4")  # or "mpegts"
+HLS_SEGMENT_SECONDS = 4
+HLS_MAX_LIVE = int(os.environ.get("HLS_MAX_LIVE", 2))
+HLS_START_TIMEOUT = 15.0
+HLS_PREPACKAGE = os.environ.get("HLS_PREPACKAGE", "0") == "1"
+# Ahead-of-time packaging runs on its own job threads, fewer than
+# HLS_MAX_LIVE so players starting an unpackaged title still get one
+HLS_PREPACKAGE_WORKERS = int(os.environ.get("HLS_PREPACKAGE_WORKERS", 1))
+
+# Transcoding: containers browsers can't be relied on to play get a
+# sibling ".<name>.mp4" variant (remuxed when the codecs allow it).
+# Runs on its own pool; ffmpeg threads are split between its workers.
+TRANSCODE_EXT = {".mkv", ".avi"}
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", max(1, (os.cpu_count() or 2) // 4)))
+TRANSCODE_THREADS = max(1, (os.cpu_count() or 2) // TRANSCODE_WORKERS)
+TRANSCODE_CRF = int(os.environ.get("TRANSCODE_CRF", 21))
+
+# ffprobe runs on its own small pool (mostly waiting on disk/NAS)
+PROBE_WORKERS = int(os.environ.get("PROBE_WORKERS", 4))
+
+# In-memory catalog/page caches (invalidated by version counters)
+CATALOG_CACHE_PAGES = int(os.environ.get("CATALOG_CACHE_PAGES", 256))
+PROGRESS_CACHE_USERS = int(os.environ.get("PROGRESS_CACHE_USERS", 1024))
+PAGE_CACHE_BYTES = int(os.environ.get("PAGE_CACHE_BYTES", 32 * 1024 * 1024))
+
+# Authorization: user records are cached per process. Changes made
+# through the app invalidate at once; the TTL bounds anything else
+# (another process, manual DB edits).
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 30.0))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 4096))
+
+# Resumable uploads: clients send fixed-size chunks (in parallel, any
+# order) that are written straight into a preallocated file.
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+UPLOAD_MIN_CHUNK = 256 * 1024  # below this, per-request overhead dominates
+UPLOAD_MAX_CHUNK = 64 * 1024 * 1024
+UPLOAD_PARALLEL = int(os.environ.get("UPLOAD_PARALLEL", 4))
+UPLOAD_EXPIRY_HOURS = int(os.environ.get("UPLOAD_EXPIRY_HOURS", 24))
+# How often (seconds) the background process looks for abandoned uploads
+UPLOAD_EXPIRY_INTERVAL = int(os.environ.get("UPLOAD_EXPIRY_INTERVAL", 3600))
+
+# Content fingerprints (sampled head/middle/tail + size) find duplicates
+# and moves; FINGERPRINT_FULL also stores a whole-file BLAKE2 hash and
+# only treats files as duplicates when those match too. A move the
+# inode does not show (a copy across filesystems) keeps the media id
+# only when the stored whole-file hash matches, so it needs this on.
+FINGERPRINT_FULL = os.environ.get("FINGERPRINT_FULL", "0") == "1"
+
+# Instrumentation: Prometheus text at /metrics (METRICS_TOKEN, when set,
+# must be sent as a bearer token). Statements slower than SLOW_QUERY_MS
+# are logged (0 = off; admins can change it at runtime).
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 0))
+SLOW_QUERY_KEEP = 200
+# Under serve.py each process publishes its metrics and slow-query log
+# here every METRICS_PUBLISH_INTERVAL seconds; the worker answering
+# /metrics or the diagnostics page adds up the live ones
+METRICS_STATE_DIR = Path(os.environ.get("METRICS_STATE_DIR", "cache/metrics")).resolve()
+METRICS_PUBLISH_INTERVAL = 2.0
+
+# Sampling profiler (admin toggle): stack snapshot interval and the
+# longest a run may last before it stops itself.
+PROFILE_INTERVAL = 0.01
+PROFILE_MAX_SECONDS = 300
+# Under serve.py every process samples itself while a run is on and
+# publishes its stacks here each second; reports add them up
+PROFILE_STATE_DIR = Path(os.environ.get("PROFILE_STATE_DIR", "cache/profile")).resolve()
+
+# ASGI mode (asgi.py): media streams, progress posts and catalog JSON
+# are served on the event loop, with file reads and DB calls on
+# ASGI_IO_THREADS; every other route runs the Flask app on
+# ASGI_WSGI_THREADS through a WSGI bridge.
+ASGI_IO_THREADS = int(os.environ.get("ASGI_IO_THREADS", 16))
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", 32))
+ASGI_MAX_BODY = 64 * 1024
+ASGI_BRIDGE_BUFFER = 8
+
+# Pre-fork launcher (serve.py): web workers forked from an initialized
+# master, plus one background process for jobs and the watcher.
+SERVE_HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", 5000))
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", os.cpu_count() or 2))
+SERVE_GRACEFUL_TIMEOUT = float(os.environ.get("SERVE_GRACEFUL_TIMEOUT", 30.0))
+SERVE_READY_TIMEOUT = 30.0
+
+# Seek-preview sprite sheets (trickplay): one tile every
+# TRICKPLAY_INTERVAL seconds, widened for long videos so a sheet never
+# exceeds TRICKPLAY_MAX_TILES
+TRICKPLAY_ENABLED = os.environ.get("TRICKPLAY_ENABLED", "1") == "1"
+TRICKPLAY_INTERVAL = float(os.environ.get("TRICKPLAY_INTERVAL", 10.0))
+TRICKPLAY_WIDTH = int(os.environ.get("TRICKPLAY_WIDTH", 160))
+TRICKPLAY_COLUMNS = 10
+TRICKPLAY_MAX_TILES = 600
+
+# Bandwidth scheduler, in Mbit/s (0 = unlimited). The global budget is
+# shared between users by role weight, each user's share between their
+# streams; role weights and per-role user caps are set on the admin
+# Streams page.
+BANDWIDTH_GLOBAL_MBPS = float(os.environ.get("BANDWIDTH_GLOBAL_MBPS", 0))
+BANDWIDTH_USER_MBPS = float(os.environ.get("BANDWIDTH_USER_MBPS", 0))
+BANDWIDTH_STREAM_MBPS = float(os.environ.get("BANDWIDTH_STREAM_MBPS", 0))
+BANDWIDTH_BURST_SECONDS = 2.0
+BANDWIDTH_REBALANCE_INTERVAL = 0.5
+# where each worker publishes its streams for the others
+BANDWIDTH_STATE_DIR = Path(os.environ.get("BANDWIDTH_STATE_DIR", "cache/bandwidth")).resolve()
+
+# Local read-through cache for a slow (NFS/SMB) MEDIA_DIR, off unless
+# MEDIA_CACHE_DIR is set. Files are cached in MEDIA_CACHE_BLOCK blocks:
+# from MEDIA_CACHE_ADMIT_HITS plays on, blocks read are kept; from
+# MEDIA_CACHE_FILL_HITS on, the whole file is copied in the background.
+# Plays are accesses more than MEDIA_CACHE_HIT_WINDOW seconds apart.
+MEDIA_CACHE_DIR = Path(os.environ["MEDIA_CACHE_DIR"]).resolve() if os.environ.get("MEDIA_CACHE_DIR") else None
+MEDIA_CACHE_BYTES = int(os.environ.get("MEDIA_CACHE_BYTES", 100 * 1024 ** 3))
+MEDIA_CACHE_POLICY = os.environ.get("MEDIA_CACHE_POLICY", "lru")  # or "lfu"
+MEDIA_CACHE_BLOCK = 1024 * 1024
+MEDIA_CACHE_ADMIT_HITS = int(os.environ.get("MEDIA_CACHE_ADMIT_HITS", 2))
+MEDIA_CACHE_FILL_HITS = int(os.environ.get("MEDIA_CACHE_FILL_HITS", 4))
+MEDIA_CACHE_HIT_WINDOW = 300.0
+
+# Federation: nodes listed in FEDERATION_PEERS (base URLs) pull each
+# other's catalog changes every FEDERATION_SYNC_INTERVAL seconds and
+# list each other's titles. /media requests go to the least loaded node
+# holding the file (redirected, or proxied when clients can't reach
+# peers). Every node needs the same FEDERATION_SECRET; FEDERATION_URL is
+# this node's address as clients see it.
+FEDERATION_PEERS = [u.strip().rstrip("/") for u in os.environ.get("FEDERATION_PEERS", "").split(",") if u.strip()]
+FEDERATION_SECRET = os.environ.get("FEDERATION_SECRET")
+FEDERATION_NODE = os.environ.get("FEDERATION_NODE") or f"{socket.gethostname()}:{SERVE_PORT}"
+FEDERATION_URL = os.environ.get("FEDERATION_URL")
+FEDERATION_ROUTING = os.environ.get("FEDERATION_ROUTING", "redirect")  # or "proxy"
+FEDERATION_SYNC_INTERVAL = float(os.environ.get("FEDERATION_SYNC_INTERVAL", 10.0))
+# what this node can send, for load comparisons between nodes
+FEDERATION_CAPACITY_MBPS = float(os.environ.get("FEDERATION_CAPACITY_MBPS", BANDWIDTH_GLOBAL_MBPS or 1000))
+# a peer must be this much less loaded (share of capacity) to take a
+# stream the local node could serve itself
+FEDERATION_LOCAL_BIAS = 0.2
+FEDERATION_TOKEN_TTL = 6 * 3600
+
+# Live remux: MKV/AVI whose codecs browsers play are streamed as
+# fragmented MP4 (stream copy, AAC audio when needed) until their
+# variant exists. Output is cached per start keyframe under REMUX_DIR,
+# evicted LRU past REMUX_CACHE_BYTES; REMUX_MAX_LIVE bounds the ffmpeg
+# processes per worker.
+REMUX_ENABLED = os.environ.get("REMUX_ENABLED", "1") == "1"
+REMUX_DIR = Path(os.environ.get("REMUX_DIR", "cache/remux")).resolve()
+REMUX_CACHE_BYTES = int(os.environ.get("REMUX_CACHE_BYTES", 10 * 1024 ** 3))
+REMUX_MAX_LIVE = int(os.environ.get("REMUX_MAX_LIVE", 8))
+REMUX_FRAGMENT_SECONDS = 1.0
+
+# Thumbnails: each video's card image is kept in these widths and
+# formats, named by content hash and served as immutable. THUMB_WIDTH
+# is the `src` for browsers that ignore srcset (and for posters).
+THUMB_WIDTHS = (160, 320, 640)
+THUMB_FORMATS = tuple(os.environ.get("THUMB_FORMATS", "webp,jpg").split(","))
+THUMB_WIDTH = 320
@@ -1,22 +1,168 @@
-
+import os
+import queue
 import sqlite3
-from flask import g
-from config import DB_PATH
+import threading
+import time
+from contextlib import contextmanager
+
+from config import (
+    DB_PATH,
+    DB_POOL_SIZE,
+    DB_BUSY_TIMEOUT,
+    DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE,
+    DB_STATEMENT_CACHE,
+)
+from services.metrics import observe_query
+
+# Idle connections, most recently used first (warm page cache)
+_idle = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+# The connection checked out by the current thread, and its
+# transaction() nesting depth
+_local = threading.local()
+
+
+def _connect():
+    db = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,  # pooled: one thread at a time
+    )
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    db.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    db.execute("PRAGMA temp_store=MEMORY")
+    return db
+
 
 def get_db():
-    if not hasattr(g, "db"):
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
-    return g.db
+    """
+    Returns this thread's connection, checking one out of the pool
+    on first use. It stays with the thread until release_db().
+    """
+    db = getattr(_local, "db", None)
+    if db is None:
+        try:
+            db = _idle.get_nowait()
+        except queue.Empty:
+            db = _connect()
+        _local.db = db
+        _local.depth = 0
+    return db
+
+
+def release_db(exc=None):
+    """
+    Returns the thread's connection to the pool (Flask teardown).
+    Anything left uncommitted is rolled back.
+    """
+    db = getattr(_local, "db", None)
+    if db is None:
+        return
+
+    _local.db = None
+    _local.depth = 0
+
+    if db.in_transaction:
+        db.rollback()
+
+    try:
+        _idle.put_nowait(db)
+    except queue.Full:
+        db.close()
+
+
+def close_pool():
+    release_db()
+    while True:
+        try:
+            _idle.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+def _reset_after_fork():
+    """
+    A SQLite connection must not be used across fork(). Children drop
+    the inherited pool (without closing: that would touch the parent's
+    locks) and open their own.
+    """
+    global _idle, _local
+    _orphans.append((_idle, getattr(_local, "db", None)))
+    _idle = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+    _local = threading.local()
+
+
+# inherited connections, kept referenced so they are never finalized
+_orphans = []
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _in_transaction():
+    return getattr(_local, "depth", 0) > 0
+
+
+@contextmanager
+def transaction():
+    """
+    Groups writes into one commit. Nested blocks join the outer
+    transaction.
+
+        with transaction() as db:
+            db.execute(...)
+            execute(...)   # does not commit on its own here
+    """
+    db = get_db()
+
+    if _in_transaction():
+        _local.depth += 1
+        try:
+            yield db
+        finally:
+            _local.depth -= 1
+        return
+
+    db.execute("BEGIN IMMEDIATE")
+    _local.depth = 1
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+    finally:
+        _local.depth = 0
+
 
 def query(sql, args=(), one=False):
+    started = time.perf_counter()
     cur = get_db().execute(sql, args)
     rows = cur.fetchall()
     cur.close()
+    observe_query("query", sql, time.perf_counter() - started)
     return rows[0] if one and rows else rows
 
+
 def execute(sql, args=()):
+    started = time.perf_counter()
     db = get_db()
     cur = db.execute(sql, args)
-    db.commit()
+    if not _in_transaction():
+        db.commit()
+    observe_query("execute", sql, time.perf_counter() - started)
     return cur.lastrowid
+
+
+def execute_many(sql, rows):
+    started = time.perf_counter()
+    db = get_db()
+    cur = db.executemany(sql, rows)
+    if not _in_transaction():
+        db.commit()
+    observe_query("execute_many", sql, time.perf_counter() - started)
+    return cur.rowcount
@@ -1,6 +1,6 @@
 from pathlib import Path
 from config import VIDEO_EXT, MEDIA_DIR
-from services.thumbnails import ensure_thumb
+from services.thumbnails import ensure_thumb, PLACEHOLDER_URL
 
 
 class Media:
@@ -37,7 +37,7 @@ class Media:
         """
         Default thumbnail (used by templates)
         """
-        return "/static/thumbs/placeholder.jpg"
+        return PLACEHOLDER_URL
 
 
 class VideoMedia(Media):
@@ -52,7 +52,7 @@ class VideoMedia(Media):
         return "▶"
 
     def thumb_url(self):
-        # auto-generate thumbnail using ffmpeg
+        # queues generation in the background on a miss
         return ensure_thumb(self.full_path, self.id)
 
 
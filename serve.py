@@ -0,0 +1,424 @@
+"""
+Pre-fork launcher. The master process initializes once (schema, library
+scan, backfill jobs), then forks one background process for the job
+pool and library watcher and SERVE_WORKERS web workers that accept on a
+shared socket. Workers start from the warmed-up master image: no
+imports, no filesystem walk.
+
+    python serve.py                      # threaded WSGI server per worker
+    python serve.py --workers 8 --asgi   # uvicorn event loop per worker
+
+Signals to the master:
+
+    HUP          graceful reload: re-exec with the listening socket kept
+                 open, start new workers, then drain the old ones
+    TERM, INT    graceful stop
+"""
+
+import argparse
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from config import (
+    SERVE_HOST,
+    SERVE_PORT,
+    SERVE_WORKERS,
+    SERVE_GRACEFUL_TIMEOUT,
+    SERVE_READY_TIMEOUT,
+    METRICS_ENABLED,
+)
+
+LISTEN_FD_ENV = "SERVE_LISTEN_FD"
+OLD_PIDS_ENV = "SERVE_OLD_PIDS"
+OLD_BACKGROUND_ENV = "SERVE_OLD_BACKGROUND"
+
+_PID = struct.Struct("<i")
+
+
+# ----------------------------
+# Workers
+# ----------------------------
+
+class InFlight:
+    """
+    WSGI middleware counting requests whose response is not closed
+    yet, so a draining worker can wait for streams to finish.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self.idle = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        from werkzeug.wsgi import ClosingIterator
+
+        with self.idle:
+            self.count += 1
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return ClosingIterator(result, [self._done])
+
+    def _done(self):
+        with self.idle:
+            self.count -= 1
+            if not self.count:
+                self.idle.notify_all()
+
+    def wait(self, timeout):
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.count, timeout)
+
+
+def _child_signals(*ignored):
+    signal.set_wakeup_fd(-1)
+    for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_IGN if sig in ignored else signal.SIG_DFL)
+
+
+def run_worker(webapp, sock, ready_w, asgi):
+    """
+    One web worker; returns its exit code after a graceful drain.
+    """
+    from services import metrics, profiler
+    from services.watch import start_progress_flusher, flush_progress
+
+    app = webapp.app
+    start_progress_flusher(app)
+    profiler.start_follower()
+    if METRICS_ENABLED:
+        metrics.start_publishing()  # /metrics may be answered by another worker
+
+    def notify_ready():
+        app.config["READY"] = True
+        os.write(ready_w, _PID.pack(os.getpid()))
+
+    if asgi:
+        import uvicorn
+        from services.asgi import make_asgi
+
+        server = uvicorn.Server(uvicorn.Config(
+            make_asgi(app),
+            lifespan="on",
+            access_log=False,
+            log_level="warning",
+            timeout_graceful_shutdown=SERVE_GRACEFUL_TIMEOUT,
+        ))
+
+        def wait_started():
+            while not server.started and not server.should_exit:
+                time.sleep(0.005)
+            if server.started:
+                notify_ready()
+
+        threading.Thread(target=wait_started, daemon=True).start()
+        server.run(sockets=[sock])  # drains on SIGTERM itself
+        app.config["DRAINING"] = True
+        flush_progress()
+        return 0
+
+    from werkzeug.serving import make_server
+
+    tracker = InFlight(app)
+    server = make_server(
+        SERVE_HOST, 0, tracker, threaded=True, fd=sock.fileno()
+    )
+    sock.close()  # the server holds its own descriptor
+
+    def drain(signum, frame):
+        app.config["DRAINING"] = True
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, drain)
+    notify_ready()
+    server.serve_forever()
+
+    server.server_close()  # stop accepting; in-flight requests go on
+    if not tracker.wait(SERVE_GRACEFUL_TIMEOUT):
+        print(f"[SERVE] Worker {os.getpid()}: {tracker.count} requests cut off")
+    flush_progress()
+    return 0
+
+
+def run_background(webapp):
+    """
+    Job pool and library watcher, until SIGTERM.
+    """
+    from services import metrics, profiler
+    from services.jobs import stop_workers
+
+    # threads started below inherit the mask, so only sigwait() sees these
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+    webapp.start_background()
+    profiler.start_follower()
+    if METRICS_ENABLED:
+        metrics.start_publishing()  # job and ffmpeg timings are only seen here
+
+    while signal.sigwait({signal.SIGTERM, signal.SIGINT}) != signal.SIGTERM:
+        pass  # Ctrl-C reaches the whole group; the master decides
+
+    stop_workers(timeout=SERVE_GRACEFUL_TIMEOUT)
+    return 0
+
+
+# ----------------------------
+# Master
+# ----------------------------
+
+class Master:
+    def __init__(self, webapp, sock, workers, asgi):
+        self.webapp = webapp
+        self.sock = sock
+        self.size = workers
+        self.asgi = asgi
+
+        self.workers = {}       # pid -> fork time
+        self.background = None
+        self.ready = set()
+        self.stopping = False
+        # children of the image we were re-exec'ed from, see reload()
+        self.old = {int(p) for p in os.environ.pop(OLD_PIDS_ENV, "").split(",") if p}
+        self.old_background = int(os.environ.pop(OLD_BACKGROUND_ENV, 0))
+
+        self.signal_r, signal_w = os.pipe()
+        os.set_blocking(self.signal_r, False)
+        os.set_blocking(signal_w, False)
+        signal.set_wakeup_fd(signal_w)
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(sig, lambda *_: None)  # wakes the select() below
+
+        self.ready_r, self.ready_w = os.pipe()
+
+    # ---- processes ----
+
+    def _fork(self, target, *args):
+        pid = os.fork()
+        if pid:
+            return pid
+
+        code = 1
+        try:
+            os.close(self.signal_r)
+            os.close(self.ready_r)
+            code = target(*args)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def spawn_worker(self):
+        def child():
+            _child_signals(signal.SIGHUP, signal.SIGINT)
+            return run_worker(self.webapp, self.sock, self.ready_w, self.asgi)
+
+        pid = self._fork(child)
+        self.workers[pid] = time.monotonic()
+
+    def spawn_background(self):
+        def child():
+            _child_signals(signal.SIGHUP)
+            self.sock.close()
+            return run_background(self.webapp)
+
+        self.background = self._fork(child)
+
+    def _terminate(self, pids, timeout=SERVE_GRACEFUL_TIMEOUT + 5):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + timeout
+        pending = set(pids)
+        while pending and time.monotonic() < deadline:
+            for pid in list(pending):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        pending.discard(pid)
+                except ChildProcessError:
+                    pending.discard(pid)
+            time.sleep(0.05)
+
+        for pid in pending:
+            print(f"[SERVE] {pid} did not stop, killing it")
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+    # ---- events ----
+
+    def _wait(self, timeout):
+        """
+        Signals received and workers that reported ready.
+        """
+        try:
+            readable, _, _ = select.select([self.signal_r, self.ready_r], [], [], timeout)
+        except InterruptedError:
+            readable = []
+
+        signals = set()
+        if self.signal_r in readable:
+            try:
+                signals = set(os.read(self.signal_r, 64))
+            except BlockingIOError:
+                pass
+
+        if self.ready_r in readable:
+            data = os.read(self.ready_r, _PID.size * 64)
+            for (pid,) in _PID.iter_unpack(data):
+                if pid in self.workers:
+                    self.ready.add(pid)
+                    elapsed = (time.monotonic() - self.workers[pid]) * 1000
+                    print(f"[SERVE] Worker {pid} ready in {elapsed:.0f}ms")
+        return signals
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+
+            if pid in self.workers:
+                del self.workers[pid]
+                self.ready.discard(pid)
+                if not self.stopping:
+                    print(f"[SERVE] Worker {pid} exited ({status}), replacing it")
+            elif pid == self.background and not self.stopping:
+                self.background = None
+                print(f"[SERVE] Background process exited ({status}), restarting it")
+            self.old.discard(pid)
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + SERVE_READY_TIMEOUT
+        while len(self.ready) < len(self.workers) and time.monotonic() < deadline:
+            self._wait(0.1)
+            self._reap()
+
+    def run(self):
+        if self.old_background:
+            # one job pool at a time: stop the old one before starting ours
+            self._terminate([self.old_background])
+
+        self.spawn_background()
+        for _ in range(self.size):
+            self.spawn_worker()
+        self._wait_ready()
+        print(f"[SERVE] {len(self.ready)}/{self.size} workers ready, "
+              f"listening on {self.sock.getsockname()}")
+
+        if self.old:
+            print(f"[SERVE] Draining {len(self.old)} old workers")
+            for pid in self.old:
+                os.kill(pid, signal.SIGTERM)
+
+        while True:
+            signals = self._wait(1.0)
+            self._reap()
+
+            if signals & {signal.SIGTERM, signal.SIGINT}:
+                return self.stop()
+            if signal.SIGHUP in signals:
+                self.reload()
+
+            if self.background is None:
+                self.spawn_background()
+            for _ in range(self.size - len(self.workers)):
+                self.spawn_worker()
+
+    def stop(self):
+        self.stopping = True
+        print("[SERVE] Stopping")
+        children = list(self.workers) + list(self.old)
+        if self.background:
+            children.append(self.background)
+        self._terminate(children)
+
+    def reload(self):
+        """
+        Re-execs the master with the socket kept open; the new image
+        adopts the current children as old ones and drains them once
+        its own workers are ready.
+        """
+        check = subprocess.run(
+            [sys.executable, "-c", "import app"], capture_output=True, text=True
+        )
+        if check.returncode:
+            print(f"[SERVE] Reload aborted, app does not import:\n{check.stderr}")
+            return
+
+        print("[SERVE] Reloading")
+        self.sock.set_inheritable(True)
+        os.environ[LISTEN_FD_ENV] = str(self.sock.fileno())
+        os.environ[OLD_PIDS_ENV] = ",".join(map(str, [*self.workers, *self.old]))
+        os.environ[OLD_BACKGROUND_ENV] = str(self.background or 0)
+        signal.set_wakeup_fd(-1)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable, *sys.orig_argv[1:]])
+
+
+# ----------------------------
+# Main
+# ----------------------------
+
+def listening_socket(host, port):
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(1024)
+    sock.set_inheritable(False)
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS)
+    parser.add_argument("--host", default=SERVE_HOST)
+    parser.add_argument("--port", type=int, default=SERVE_PORT)
+    parser.add_argument("--asgi", action="store_true",
+                        help="serve with uvicorn (see services/asgi.py)")
+    args = parser.parse_args()
+
+    sock = listening_socket(args.host, args.port)
+    reloading = OLD_PIDS_ENV in os.environ
+
+    import app as webapp
+    from models.base import close_pool
+
+    if args.asgi:
+        try:
+            import uvicorn  # noqa: F401  (loaded once, before forking)
+            import services.asgi  # noqa: F401
+        except ImportError:
+            raise SystemExit("--asgi needs an ASGI server: pip install uvicorn")
+
+    started = time.monotonic()
+    webapp.initialize(scan=not reloading)  # the watcher catches up after a reload
+    close_pool()  # no SQLite connection may cross fork()
+    print(f"[SERVE] Initialized in {(time.monotonic() - started) * 1000:.0f}ms")
+
+    Master(webapp, sock, max(1, args.workers), args.asgi).run()
+
+
+if __name__ == "__main__":
+    main()
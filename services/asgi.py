@@ -0,0 +1,572 @@
+# services/asgi.py
+
+import asyncio
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.cookies import SimpleCookie
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+from itsdangerous import BadSignature
+from werkzeug.datastructures import Headers
+from werkzeug.security import safe_join
+
+from config import (
+    MEDIA_DIR,
+    STREAM_CHUNK_SIZE,
+    ASGI_IO_THREADS,
+    ASGI_WSGI_THREADS,
+    ASGI_MAX_BODY,
+    ASGI_BRIDGE_BUFFER,
+    FEDERATION_ROUTING,
+)
+from models.base import release_db
+from services import bandwidth, federation, media_cache, metrics
+from services.media import list_media
+from services.permissions import active_user
+from services.streaming import plan_file
+from services.watch import parse_progress, update_progress, flush_progress
+
+
+# ----------------------------
+# Helpers
+# ----------------------------
+
+def _headers(scope):
+    return Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+
+
+def _encode_headers(headers):
+    return [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers]
+
+
+async def _respond(send, status, body=b"", content_type="text/plain; charset=utf-8",
+                   headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": _encode_headers(
+            [("Content-Type", content_type), ("Content-Length", len(body)), *headers]
+        ),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive, limit):
+    """
+    The whole request body, or None once it exceeds `limit`.
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if len(body) > limit:
+            return None
+        if not message.get("more_body"):
+            return bytes(body)
+
+
+def _bridged_media(scope):
+    """
+    Media requests left to the Flask view: live remuxes (?remux=),
+    visitors from a peer, and every stream in proxy mode (which may
+    relay it from a peer).
+    """
+    query_string = scope.get("query_string", b"")
+    if b"remux=" in query_string:
+        return True
+    if not federation.enabled():
+        return False
+    return FEDERATION_ROUTING == "proxy" or b"fed=" in query_string
+
+
+def _released(fn, *args):
+    # executor threads check out a pooled connection like request
+    # threads do, so hand it back after every call
+    try:
+        return fn(*args)
+    finally:
+        release_db()
+
+
+class _RequestBody:
+    """
+    wsgi.input for the bridge: pulls ASGI body messages from the event
+    loop as the Flask view reads (uploads stream, nothing is buffered
+    beyond one message).
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self.complete = False
+
+    def _fill(self):
+        if self.complete:
+            return False
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message["type"] == "http.request":
+            self._buffer += message.get("body", b"")
+            self.complete = not message.get("more_body")
+        else:
+            self.complete = True  # client went away
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self._buffer)
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while b"\n" not in self._buffer and (size < 0 or len(self._buffer) < size):
+            if not self._fill():
+                break
+        end = self._buffer.find(b"\n") + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+# ----------------------------
+# Application
+# ----------------------------
+
+class AsgiApp:
+    """
+    ASGI front for the Flask app. Media ranges, /progress and
+    /api/media are handled on the event loop; everything else goes
+    through a WSGI bridge on a thread pool, so existing views work
+    unchanged.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.cookie_name = flask_app.config["SESSION_COOKIE_NAME"]
+        self.serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        self.session_max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+        self.io = ThreadPoolExecutor(ASGI_IO_THREADS, thread_name_prefix="asgi-io")
+        self.wsgi = ThreadPoolExecutor(ASGI_WSGI_THREADS, thread_name_prefix="asgi-wsgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            await receive()
+            return await send({"type": "websocket.close", "code": 1000})
+
+        method, path = scope["method"], scope["path"]
+        if method in ("GET", "HEAD") and path.startswith("/media/") and not _bridged_media(scope):
+            handler, rule = self._media, "/media/<path:filename>"
+        elif method == "POST" and path == "/progress":
+            handler, rule = self._progress, "/progress"
+        elif method == "GET" and path == "/api/media":
+            handler, rule = self._api_media, "/api/media"
+        else:
+            return await self._bridge(scope, receive, send)  # timed by Flask
+
+        started = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                metrics.http_request_seconds.observe(
+                    time.perf_counter() - started,
+                    route=rule, method=method, status=message["status"],
+                )
+            await send(message)
+
+        await handler(scope, receive, timed_send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self._io(flush_progress)
+                self.io.shutdown(wait=False)
+                self.wsgi.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _io(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.io, _released, fn, *args)
+
+    def _session(self, headers):
+        cookie = SimpleCookie()
+        try:
+            cookie.load(headers.get("Cookie", ""))
+        except Exception:
+            return {}
+        morsel = cookie.get(self.cookie_name)
+        if morsel is None:
+            return {}
+        try:
+            return self.serializer.loads(morsel.value, max_age=self.session_max_age)
+        except BadSignature:
+            return {}
+
+    async def _login_redirect(self, scope, send):
+        await _respond(
+            send, 302, b"", headers=[("Location", scope.get("root_path", "") + "/login")]
+        )
+
+    # ---- native routes ----
+
+    async def _media(self, scope, receive, send):
+        headers = _headers(scope)
+        user_id = self._session(headers).get("user_id")
+        filename = scope["path"][len("/media/"):]
+        head = scope["method"] == "HEAD"
+
+        def prepare():
+            user = active_user(user_id)
+            if not user:
+                return None
+            try:
+                url, path = federation.route(filename, user)
+            except LookupError:
+                return 503
+            if url is not None:
+                return url
+            joined = safe_join(str(MEDIA_DIR), path)
+            if joined is None or not os.path.isfile(joined):
+                return False
+            plan = plan_file(Path(joined), headers)
+            if not plan.parts or head:
+                return joined, plan, None, None
+            source = media_cache.lookup(Path(joined), plan.size, plan.mtime_ns)
+            if source is None:
+                # opened here so a slow (NAS) open never blocks the loop
+                source = os.open(joined, os.O_RDONLY)
+            return joined, plan, source, bandwidth.open_stream(user, scope["path"])
+
+        prepared = await self._io(prepare)
+        if prepared is None:
+            return await self._login_redirect(scope, send)
+        if prepared is False:
+            return await _respond(send, 404, b"Not Found")
+        if prepared == 503:
+            return await _respond(send, 503, b"Service Unavailable")
+        if isinstance(prepared, str):
+            return await _respond(send, 302, b"", headers=[("Location", prepared)])
+
+        path, plan, source, stream = prepared
+        try:
+            await self._send_file(scope, receive, send, path, plan, source, stream)
+        finally:
+            if source is not None:
+                stream.close()
+                if isinstance(source, int):
+                    os.close(source)
+                else:
+                    source.close()
+
+    async def _send_file(self, scope, receive, send, path, plan, source, stream):
+        """
+        `source` is the open descriptor, a media_cache.CachedFile, or
+        None for a response without a body.
+        """
+        await send({
+            "type": "http.response.start",
+            "status": plan.status,
+            "headers": _encode_headers(plan.headers.items()),
+        })
+        if source is None:
+            return await send({"type": "http.response.body", "body": b""})
+
+        extensions = scope.get("extensions") or {}
+        if stream.paced or not isinstance(source, int):
+            # paced or read through the media cache: the server's
+            # sendfile can't do either
+            extensions = {}
+        metrics.streams_active.inc()
+        try:
+            if len(plan.parts) == 1 and "http.response.zerocopysend" in extensions:
+                # the server sendfile()s straight from our descriptor
+                _prefix, start, end = plan.parts[0]
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": source, "offset": start, "count": end - start + 1,
+                })
+                metrics.stream_bytes.inc(end - start + 1)
+                stream.consume(end - start + 1)
+                return
+            if plan.status == 200 and "http.response.pathsend" in extensions:
+                await send({"type": "http.response.pathsend", "path": path})
+                metrics.stream_bytes.inc(plan.size)
+                stream.consume(plan.size)
+                return
+            if isinstance(source, int):
+                await self._pump(receive, send, plan, partial(os.pread, source), stream)
+            else:
+                await self._pump(receive, send, plan, source.pread, stream)
+        finally:
+            metrics.streams_active.dec()
+
+    async def _pump(self, receive, send, plan, pread, stream):
+        """
+        Thread-offloaded preads, one chunk read ahead. `await send`
+        waits while the client's socket buffer is full, so a slow
+        viewer holds at most two chunks in memory and no thread; the
+        bandwidth scheduler's pauses hold nothing either.
+        """
+        loop = asyncio.get_running_loop()
+        gone = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            gone.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+
+        def read(pos, end):
+            return loop.run_in_executor(
+                self.io, pread, min(STREAM_CHUNK_SIZE, end - pos + 1), pos
+            )
+
+        pending = None
+        try:
+            for prefix, start, end in plan.parts:
+                if prefix:
+                    await send({"type": "http.response.body", "body": prefix, "more_body": True})
+
+                pos, pending = start, read(start, end)
+                while pending is not None:
+                    data = await pending
+                    if not data:
+                        return  # truncated under us; the server drops the connection
+                    pos += len(data)
+                    pending = read(pos, end) if pos <= end else None
+                    delay = stream.consume(len(data))
+                    if delay:
+                        try:
+                            await asyncio.wait_for(gone.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                    if gone.is_set():
+                        return
+                    await send({"type": "http.response.body", "body": data, "more_body": True})
+                    metrics.stream_bytes.inc(len(data))
+
+            await send({"type": "http.response.body", "body": plan.trailer})
+        finally:
+            watcher.cancel()
+            if pending is not None:
+                # the read-ahead must finish before the caller closes the source
+                await asyncio.wait([pending])
+
+    async def _progress(self, scope, receive, send):
+        headers = _headers(scope)
+        user_id = self._session(headers).get("user_id")
+
+        body = await _read_body(receive, ASGI_MAX_BODY)
+        if body is None:
+            return await _respond(send, 413, b"Payload Too Large")
+
+        def save():
+            if not active_user(user_id):
+                return None
+            # same leniency as request.get_json(silent=True)
+            data = {}
+            if headers.get("Content-Type", "").startswith("application/json"):
+                try:
+                    data = json.loads(body or b"{}")
+                except ValueError:
+                    pass
+            try:
+                media_id, progress, position = parse_progress(data or {})
+            except ValueError:
+                return False
+            update_progress(user_id, media_id, progress, position)
+            return True
+
+        saved = await self._io(save)
+        if saved is None:
+            return await self._login_redirect(scope, send)
+        if saved is False:
+            return await _respond(send, 400, b"Bad Request")
+        await _respond(send, 200, b'{"ok":true}\n', "application/json")
+
+    async def _api_media(self, scope, receive, send):
+        user_id = self._session(_headers(scope)).get("user_id")
+        args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+
+        def page():
+            try:
+                media, next_cursor = list_media(
+                    user_id=user_id,
+                    q=args.get("q"),
+                    category=args.get("category"),
+                    cursor=args.get("cursor"),
+                )
+            except ValueError:
+                return None
+            return self.flask_app.json.dumps({"items": media, "next": next_cursor})
+
+        body = await self._io(page)
+        if body is None:
+            return await _respond(send, 400, b"Bad Request")
+        await _respond(send, 200, (body + "\n").encode(), "application/json")
+
+    # ---- WSGI bridge ----
+
+    def _environ(self, scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "SERVER_SOFTWARE": "asgi-bridge",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.input_terminated": True,
+            "wsgi.errors": _Errors(),
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+
+        for name, value in scope["headers"]:
+            key = name.decode("latin-1").upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            value = value.decode("latin-1")
+            if key in environ:
+                value = environ[key] + ("; " if key == "HTTP_COOKIE" else ",") + value
+            environ[key] = value
+        return environ
+
+    async def _bridge(self, scope, receive, send):
+        """
+        Runs the Flask app on a worker thread. Response chunks cross
+        back through a small queue: when the client is slow the queue
+        fills and the view's generator blocks instead of buffering.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(ASGI_BRIDGE_BUFFER)
+        body = _RequestBody(receive, loop)
+        environ = self._environ(scope, body)
+        gone = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def run():
+            state = {}
+
+            def start_response(status, headers, exc_info=None):
+                if exc_info and state.get("sent"):
+                    raise exc_info[1].with_traceback(exc_info[2])
+                state["start"] = (int(status.split(" ", 1)[0]), headers)
+                return lambda data: put(("body", state["start"], data))
+
+            try:
+                result = self.flask_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if gone.is_set():
+                            break
+                        if chunk:
+                            state["sent"] = True
+                            put(("body", state["start"], chunk))
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+                put(("end", state["start"], b""))
+            except BaseException as e:
+                put(("error", None, e))
+            finally:
+                release_db()
+
+        worker = loop.run_in_executor(self.wsgi, run)
+        watcher = None
+        started = False
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            gone.set()
+
+        try:
+            while True:
+                kind, start, payload = await queue.get()
+                if kind == "error":
+                    print(f"[ASGI] {scope['method']} {scope['path']} failed: "
+                          + "".join(traceback.format_exception(payload)))
+                    if not started:
+                        await _respond(send, 500, b"Internal Server Error")
+                    break
+
+                if not started:
+                    status, headers = start
+                    await send({
+                        "type": "http.response.start",
+                        "status": status,
+                        "headers": _encode_headers(headers),
+                    })
+                    started = True
+                    if body.complete:
+                        watcher = asyncio.ensure_future(watch_disconnect())
+
+                await send({
+                    "type": "http.response.body",
+                    "body": payload,
+                    "more_body": kind == "body",
+                })
+                if kind == "end":
+                    break
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            gone.set()
+            while not worker.done():  # let a blocked put() finish
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+
+
+class _Errors:
+    def write(self, s):
+        print(s, end="")
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+
+def make_asgi(flask_app):
+    return AsgiApp(flask_app)
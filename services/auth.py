@@ -1,5 +1,6 @@
 from werkzeug.security import generate_password_hash, check_password_hash
 from models.base import query, execute
+from services.permissions import invalidate_user
 
 # ================= ROOT CONFIG =================
 ROOT_USERNAME = "root"
@@ -50,7 +51,7 @@ def register_user(username, password):
     if existing:
         return False, "Username already exists"
 
-    execute(
+    user_id = execute(
         "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
         [
             username,
@@ -58,6 +59,7 @@ def register_user(username, password):
             "user"
         ]
     )
+    invalidate_user(user_id)
 
     return True, None
 
@@ -0,0 +1,373 @@
+# services/bandwidth.py
+
+import itertools
+import json
+import math
+import os
+import threading
+import time
+
+from config import (
+    STREAM_CHUNK_SIZE,
+    BANDWIDTH_GLOBAL_MBPS,
+    BANDWIDTH_USER_MBPS,
+    BANDWIDTH_STREAM_MBPS,
+    BANDWIDTH_BURST_SECONDS,
+    BANDWIDTH_REBALANCE_INTERVAL,
+    BANDWIDTH_STATE_DIR,
+)
+from models.base import query, execute, release_db
+from services import metrics
+
+MBPS = 1_000_000 / 8  # bytes per second
+POLICY_TTL = 5.0
+# A stream sending below this share of its allocation is limited by the
+# client (full player buffer, slow Wi-Fi); it is offered its measured
+# rate with headroom and the rest goes to streams that can use it
+CLIENT_LIMITED = 0.8
+HEADROOM = 1.5
+
+
+def _mbps(value):
+    return value * MBPS if value and value > 0 else math.inf
+
+
+GLOBAL_RATE = _mbps(BANDWIDTH_GLOBAL_MBPS)
+USER_RATE = _mbps(BANDWIDTH_USER_MBPS)
+STREAM_RATE = _mbps(BANDWIDTH_STREAM_MBPS)
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_streams = {}           # stream id -> Stream, this process
+# user -> (tokens, monotonic time) left by their last stream: players
+# fetch one range after another, and a fresh burst for each would
+# make the limits moot
+_carry = {}
+_remote = []            # published streams of other processes
+_wake = threading.Event()
+_thread = None
+_policy = {"loaded": 0.0, "roles": {}}
+
+
+# ----------------------------
+# Role policy
+# ----------------------------
+
+def role_policy():
+    """
+    {role: (weight, per-user cap in bytes/s or None)} as set on the
+    admin Streams page; reloaded every POLICY_TTL seconds so every
+    worker picks up changes. A role cap replaces BANDWIDTH_USER_MBPS.
+    """
+    if time.monotonic() - _policy["loaded"] > POLICY_TTL:
+        rows = query("SELECT role, weight, cap_mbps FROM bandwidth_roles")
+        _policy["roles"] = {
+            row["role"]: (row["weight"], row["cap_mbps"] and row["cap_mbps"] * MBPS)
+            for row in rows
+        }
+        _policy["loaded"] = time.monotonic()
+    return _policy["roles"]
+
+
+def set_role_policy(role, weight, cap_mbps):
+    execute(
+        """
+        INSERT INTO bandwidth_roles (role, weight, cap_mbps)
+        VALUES (?, ?, ?)
+        ON CONFLICT(role) DO UPDATE SET
+            weight = excluded.weight,
+            cap_mbps = excluded.cap_mbps
+        """,
+        (role, weight, cap_mbps or None)
+    )
+    _policy["loaded"] = 0.0
+
+
+def paced(user):
+    """
+    True when some limit applies to streams of `user`, so they must be
+    sent from Python rather than handed to sendfile().
+    """
+    _weight, cap = role_policy().get(user["role"] if user else "user", (1.0, None))
+    return min(GLOBAL_RATE, STREAM_RATE, cap or USER_RATE) < math.inf
+
+
+# ----------------------------
+# Streams
+# ----------------------------
+
+class Stream:
+    """
+    One response body being sent. The sender calls consume() per chunk
+    and pauses for the returned number of seconds; the scheduler
+    adjusts `allowed` (bytes/s) as streams come and go.
+    """
+
+    def __init__(self, user, label):
+        role = user["role"] if user else "user"
+        weight, user_cap = role_policy().get(role, (1.0, None))
+        self.id = f"{os.getpid()}-{next(_ids)}"
+        self.user = user["id"] if user else None
+        self.username = user["username"] if user else None
+        self.role = role
+        self.label = label
+        self.weight = weight
+        self.user_cap = user_cap or USER_RATE
+        self.paced = min(GLOBAL_RATE, STREAM_RATE, self.user_cap) < math.inf
+        self.started = time.time()
+        self.sent = 0
+        self.rate = 0.0
+        self.allowed = math.inf
+        self.demand = math.inf
+
+        self._opened = time.monotonic()
+        self._tokens = None
+        self._last = self._opened
+        self._measured = (self._opened, 0)
+
+    def consume(self, n):
+        now = time.monotonic()
+        self.sent += n
+        allowed = self.allowed
+        if allowed == math.inf:
+            self._tokens, self._last = None, now
+            return 0.0
+
+        burst = max(allowed * BANDWIDTH_BURST_SECONDS, STREAM_CHUNK_SIZE)
+        if self._tokens is None:
+            self._tokens, self._last = _carry.get(self.user, (burst, now))
+        tokens = min(burst, self._tokens + (now - self._last) * allowed) - n
+        self._tokens, self._last = tokens, now
+        if tokens >= 0:
+            return 0.0
+
+        delay = -tokens / allowed
+        metrics.stream_throttled_seconds.inc(delay)
+        return delay
+
+    def _measure(self, now):
+        since, sent = self._measured
+        if now - since < BANDWIDTH_REBALANCE_INTERVAL / 2:
+            return
+        rate = (self.sent - sent) / (now - since)
+        self.rate = rate if since == self._opened else (self.rate + rate) / 2
+        self._measured = (now, self.sent)
+
+        settled = now - self._opened > 2 * BANDWIDTH_REBALANCE_INTERVAL
+        if settled and self.allowed < math.inf and self.rate < self.allowed * CLIENT_LIMITED:
+            self.demand = max(self.rate * HEADROOM, STREAM_CHUNK_SIZE)
+        else:
+            self.demand = math.inf
+
+    def describe(self):
+        return {
+            "id": self.id,
+            "user": self.user,
+            "username": self.username,
+            "role": self.role,
+            "label": self.label,
+            "started": self.started,
+            "sent": self.sent,
+            "rate": self.rate,
+            "allowed": _finite(self.allowed),
+            "weight": self.weight,
+            "user_cap": _finite(self.user_cap),
+            "limit": _finite(min(STREAM_RATE, self.demand)),
+        }
+
+    def close(self):
+        with _lock:
+            if self._tokens is not None:
+                _carry[self.user] = (self._tokens, self._last)
+            _streams.pop(self.id, None)
+            _rebalance_locked()
+        _wake.set()
+
+
+def _finite(value):
+    return None if value == math.inf else value
+
+
+def _infinite(value):
+    return math.inf if value is None else value
+
+
+def open_stream(user, label):
+    """
+    Registers a stream for `user` (a user record, or None) and gives it
+    its share at once. The caller must close() it.
+    """
+    stream = Stream(user, label)
+    with _lock:
+        _streams[stream.id] = stream
+        _rebalance_locked()
+    _start()
+    _wake.set()
+    return stream
+
+
+# ----------------------------
+# Scheduling
+# ----------------------------
+
+def fair_share(capacity, demands):
+    """
+    Weighted max-min fair split of `capacity` over {key: (weight,
+    limit)}: no entry gets more than its limit, and whatever limited
+    entries leave unused is shared among the rest by weight.
+    """
+    if capacity == math.inf:
+        return {key: limit for key, (_w, limit) in demands.items()}
+
+    alloc = {}
+    remaining = capacity
+    total = sum(weight for weight, _ in demands.values())
+    for key, (weight, limit) in sorted(demands.items(), key=lambda kv: kv[1][1] / kv[1][0]):
+        alloc[key] = min(limit, remaining * weight / total)
+        remaining -= alloc[key]
+        total -= weight
+    return alloc
+
+
+def allocate(streams):
+    """
+    {stream id: bytes/s} for described streams: the global budget is
+    shared between users by role weight, then each user's share
+    equally between their streams.
+    """
+    by_user = {}
+    for s in streams:
+        by_user.setdefault(s["user"], []).append(s)
+
+    users = {}
+    for user, own in by_user.items():
+        limit = sum(_infinite(s["limit"]) for s in own)
+        users[user] = (own[0]["weight"], min(_infinite(own[0]["user_cap"]), limit))
+
+    alloc = {}
+    for user, share in fair_share(GLOBAL_RATE, users).items():
+        alloc.update(fair_share(share, {
+            s["id"]: (1.0, _infinite(s["limit"])) for s in by_user[user]
+        }))
+    return alloc
+
+
+def _rebalance_locked():
+    """
+    Re-splits the budget over our streams and the last published
+    streams of other processes. Holds _lock.
+    """
+    if not _streams:
+        return
+    alloc = allocate([s.describe() for s in _streams.values()] + _remote)
+    for stream in _streams.values():
+        stream.allowed = alloc[stream.id]
+
+
+def _state_file(pid):
+    return BANDWIDTH_STATE_DIR / f"{pid}.json"
+
+
+def _publish(described):
+    """
+    Writes our streams where other workers (and the Streams page) see
+    them; removes the file once we have none.
+    """
+    path = _state_file(os.getpid())
+    if not described:
+        path.unlink(missing_ok=True)
+        return
+
+    BANDWIDTH_STATE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"at": time.time(), "streams": described}))
+    os.replace(tmp, path)
+
+
+def _read_published():
+    """
+    Streams published by live processes; stale files are removed.
+    """
+    streams = []
+    now = time.time()
+    try:
+        entries = list(os.scandir(BANDWIDTH_STATE_DIR))
+    except FileNotFoundError:
+        return streams
+
+    for entry in entries:
+        if not entry.name.endswith(".json"):
+            continue
+        if entry.name == f"{os.getpid()}.json":
+            continue
+        try:
+            state = json.loads(open(entry.path).read())
+        except (OSError, ValueError):
+            continue
+        age = now - state["at"]
+        if age > 60:
+            os.unlink(entry.path)
+        elif age < 4 * BANDWIDTH_REBALANCE_INTERVAL:
+            streams += state["streams"]
+    return streams
+
+
+def rebalance():
+    now = time.monotonic()
+    remote = _read_published()
+    with _lock:
+        _remote[:] = remote
+        for user, (_tokens, at) in list(_carry.items()):
+            if now - at > 60:
+                del _carry[user]  # long since refilled
+        for stream in _streams.values():
+            stream._measure(now)
+        _rebalance_locked()
+        described = [s.describe() for s in _streams.values()]
+    _publish(described)
+
+
+def _loop():
+    while True:
+        _wake.wait(BANDWIDTH_REBALANCE_INTERVAL if _streams else None)
+        _wake.clear()
+        try:
+            rebalance()
+        except Exception as e:
+            print(f"[BANDWIDTH] Rebalance failed: {e}")
+        finally:
+            release_db()
+
+
+def _start():
+    global _thread
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_loop, name="bandwidth", daemon=True)
+            _thread.start()
+
+
+# ----------------------------
+# Stats
+# ----------------------------
+
+def snapshot():
+    """
+    Every active stream in every worker, fastest first, plus the totals.
+    """
+    with _lock:
+        own = [s.describe() for s in _streams.values()]
+    streams = own + _read_published()
+
+    now = time.time()
+    for s in streams:
+        s["seconds"] = now - s["started"]
+    streams.sort(key=lambda s: -s["rate"])
+
+    return {
+        "streams": streams,
+        "total_rate": sum(s["rate"] for s in streams),
+        "budget": _finite(GLOBAL_RATE),
+        "user_rate": _finite(USER_RATE),
+        "stream_rate": _finite(STREAM_RATE),
+    }
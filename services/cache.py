@@ -0,0 +1,181 @@
+# services/cache.py
+
+import hashlib
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from config import CATALOG_CACHE_PAGES, PAGE_CACHE_BYTES, PROGRESS_CACHE_USERS
+
+# Distinguishes entity tags issued by different runs of the app
+BOOT_ID = f"{time.time_ns():x}"
+
+
+# ----------------------------
+# LRU
+# ----------------------------
+
+class LRUCache:
+    """
+    Thread-safe LRU bounded by entry count and/or total size (the
+    `size` passed to put()).
+    """
+
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size=1):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+            self._data[key] = (value, size)
+            self._bytes += size
+
+            while self._data and (
+                (self.max_items and len(self._data) > self.max_items)
+                or (self.max_bytes and self._bytes > self.max_bytes)
+            ):
+                _key, (_value, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+# ----------------------------
+# Version counters
+# ----------------------------
+
+# Kept in an anonymous shared mapping created at import, so processes
+# forked afterwards (serve.py workers) see each other's bumps. Slot 0
+# is the catalog and slot 1 every user record; then users hash into
+# USER_VERSION_SLOTS for watch progress and as many for their record.
+# A collision only costs a spurious cache miss.
+USER_VERSION_SLOTS = 1 << 16
+_SLOT = struct.Struct("<Q")
+_ALL_ACCOUNTS = 1
+_PROGRESS_BASE = 2
+_ACCOUNT_BASE = _PROGRESS_BASE + USER_VERSION_SLOTS
+
+_versions = mmap.mmap(-1, _SLOT.size * (_ACCOUNT_BASE + USER_VERSION_SLOTS))
+_versions_lock = multiprocessing.Lock()
+
+
+def _read(slot):
+    return _SLOT.unpack_from(_versions, slot * _SLOT.size)[0]
+
+
+def _bump(slot):
+    with _versions_lock:
+        _SLOT.pack_into(_versions, slot * _SLOT.size, _read(slot) + 1)
+
+
+def _user_slot(user_id, base=_PROGRESS_BASE):
+    return base + hash(user_id) % USER_VERSION_SLOTS
+
+
+def catalog_version():
+    return _read(0)
+
+
+def bump_catalog():
+    """
+    Called whenever media rows (or their thumbnails) change.
+    """
+    _bump(0)
+
+
+def user_version(user_id):
+    return _read(_user_slot(user_id))
+
+
+def bump_user(user_id):
+    """
+    Called whenever a user's watch progress changes.
+    """
+    _bump(_user_slot(user_id))
+
+
+def account_version(user_id):
+    return _read(_ALL_ACCOUNTS), _read(_user_slot(user_id, _ACCOUNT_BASE))
+
+
+def bump_account(user_id=None):
+    """
+    Called whenever a user record (role, active, ...) changes; None
+    for all of them.
+    """
+    _bump(_ALL_ACCOUNTS if user_id is None else _user_slot(user_id, _ACCOUNT_BASE))
+
+
+# ----------------------------
+# Shared settings
+# ----------------------------
+
+# Runtime switches an admin flips on one worker that every process
+# follows, as doubles in a mapping of their own (same fork rule)
+_SETTINGS = {"slow_query_ms": 0, "profile_run": 1, "profile_until": 2}
+_DOUBLE = struct.Struct("<d")
+_settings = mmap.mmap(-1, _DOUBLE.size * len(_SETTINGS))
+
+
+def shared_setting(name):
+    return _DOUBLE.unpack_from(_settings, _SETTINGS[name] * _DOUBLE.size)[0]
+
+
+def set_shared_setting(name, value):
+    _DOUBLE.pack_into(_settings, _SETTINGS[name] * _DOUBLE.size, float(value))
+
+
+# ----------------------------
+# Caches
+# ----------------------------
+
+# (q, category, cursor, limit) -> (catalog version, items, next cursor);
+# items carry no per-user fields
+catalog_pages = LRUCache(max_items=CATALOG_CACHE_PAGES)
+
+# user_id -> (user version, {media_id: (progress, position)})
+user_progress = LRUCache(max_items=PROGRESS_CACHE_USERS)
+
+# (user_id, role, query string) -> (tag, html)
+rendered_pages = LRUCache(max_bytes=PAGE_CACHE_BYTES)
+
+
+def page_tag(user_id, *parts):
+    """
+    Entity tag (unquoted, used weak) for a page built from the catalog
+    and one user's progress; changes whenever either version moves.
+    """
+    key = "|".join(
+        str(p) for p in (BOOT_ID, catalog_version(), user_id, user_version(user_id), *parts)
+    )
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
@@ -1,5 +1,8 @@
+import secrets
+
 from werkzeug.security import generate_password_hash
 from models.base import query, execute
+from services.search import init_search
 
 def init_db():
     # USERS
@@ -19,7 +22,8 @@ def init_db():
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         title TEXT NOT NULL,
         filepath TEXT NOT NULL,
-        category TEXT
+        category TEXT,
+        origin TEXT
     )
     """)
 
@@ -30,13 +34,219 @@ def init_db():
         user_id INTEGER NOT NULL,
         media_id INTEGER NOT NULL,
         progress INTEGER DEFAULT 0,
+        position REAL,
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         UNIQUE(user_id, media_id)
     )
     """)
 
+    # FILE INDEX (incremental scanner)
+    execute("""
+    CREATE TABLE IF NOT EXISTS media_files (
+        filepath TEXT PRIMARY KEY,
+        media_id INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        fingerprint TEXT,
+        full_hash TEXT
+    )
+    """)
+    execute("""
+    CREATE INDEX IF NOT EXISTS idx_media_files_inode
+    ON media_files(inode, size)
+    """)
+    execute("CREATE INDEX IF NOT EXISTS idx_media_filepath ON media(filepath)")
+
+    # Keyset pagination within a category. watch_history lookups by
+    # (user_id, media_id) already use its UNIQUE constraint's index.
+    execute("CREATE INDEX IF NOT EXISTS idx_media_category_id ON media(category, id)")
+
+    # BACKGROUND JOBS (thumbnails, ...)
+    execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        payload TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',
+        priority INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        run_after TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(kind, key)
+    )
+    """)
+    execute("""
+    CREATE INDEX IF NOT EXISTS idx_jobs_status
+    ON jobs(status, priority, id)
+    """)
+
+    # PLAYABLE VARIANTS (MP4 remux/transcode of MKV/AVI sources)
+    execute("""
+    CREATE TABLE IF NOT EXISTS media_variants (
+        media_id INTEGER PRIMARY KEY,
+        filepath TEXT NOT NULL,
+        method TEXT NOT NULL,
+        source_size INTEGER NOT NULL,
+        source_mtime_ns INTEGER NOT NULL,
+        duration REAL,
+        elapsed REAL NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    # THUMBNAIL VARIANTS (files named by content hash)
+    execute("""
+    CREATE TABLE IF NOT EXISTS thumbnails (
+        media_id INTEGER NOT NULL,
+        width INTEGER NOT NULL,
+        format TEXT NOT NULL,
+        name TEXT NOT NULL,
+        PRIMARY KEY (media_id, width, format)
+    )
+    """)
+
+    # FFPROBE METADATA (cached by source size + mtime)
+    execute("""
+    CREATE TABLE IF NOT EXISTS media_probe (
+        media_id INTEGER PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        format_name TEXT,
+        duration REAL,
+        bit_rate INTEGER,
+        width INTEGER,
+        height INTEGER,
+        video_codec TEXT,
+        audio_codec TEXT,
+        probed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    execute("""
+    CREATE TABLE IF NOT EXISTS media_streams (
+        media_id INTEGER NOT NULL,
+        idx INTEGER NOT NULL,
+        codec_type TEXT,
+        codec_name TEXT,
+        profile TEXT,
+        width INTEGER,
+        height INTEGER,
+        pix_fmt TEXT,
+        channels INTEGER,
+        sample_rate INTEGER,
+        bit_rate INTEGER,
+        language TEXT,
+        PRIMARY KEY (media_id, idx)
+    )
+    """)
+
+    # RESUMABLE UPLOADS (one row per received chunk)
+    execute("""
+    CREATE TABLE IF NOT EXISTS uploads (
+        id TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        title TEXT NOT NULL,
+        category TEXT,
+        size INTEGER NOT NULL,
+        chunk_size INTEGER NOT NULL,
+        media_id INTEGER,
+        filepath TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    execute("""
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        upload_id TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        PRIMARY KEY (upload_id, idx)
+    ) WITHOUT ROWID
+    """)
+
+    # BANDWIDTH POLICY (scheduler weight and per-user cap by role)
+    execute("""
+    CREATE TABLE IF NOT EXISTS bandwidth_roles (
+        role TEXT PRIMARY KEY,
+        weight REAL NOT NULL DEFAULT 1,
+        cap_mbps REAL
+    )
+    """)
+
+    # MEDIA CACHE (plays per file, for promotion and eviction)
+    execute("""
+    CREATE TABLE IF NOT EXISTS media_cache (
+        filepath TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+        last_access REAL NOT NULL
+    )
+    """)
+
+    # FEDERATION: the latest change per local media item, for peers to
+    # pull; the remote items mirrored here; the peers' sync state
+    execute("""
+    CREATE TABLE IF NOT EXISTS media_changes (
+        media_id INTEGER PRIMARY KEY,
+        seq INTEGER NOT NULL
+    )
+    """)
+    execute("CREATE INDEX IF NOT EXISTS idx_media_changes_seq ON media_changes(seq)")
+    execute("""
+    CREATE TABLE IF NOT EXISTS remote_media (
+        node TEXT NOT NULL,
+        remote_id INTEGER NOT NULL,
+        media_id INTEGER NOT NULL,
+        filepath TEXT NOT NULL,
+        title TEXT,
+        category TEXT,
+        fingerprint TEXT,
+        size INTEGER,
+        PRIMARY KEY (node, remote_id)
+    )
+    """)
+    execute("CREATE INDEX IF NOT EXISTS idx_remote_media_media ON remote_media(media_id)")
+    execute("CREATE INDEX IF NOT EXISTS idx_remote_media_fingerprint ON remote_media(fingerprint)")
+    execute("""
+    CREATE TABLE IF NOT EXISTS federation_peers (
+        url TEXT PRIMARY KEY,
+        node TEXT,
+        epoch TEXT,
+        seq INTEGER NOT NULL DEFAULT 0,
+        public_url TEXT,
+        capacity REAL,
+        rate REAL,
+        streams INTEGER,
+        last_seen REAL
+    )
+    """)
+    execute("""
+    CREATE TABLE IF NOT EXISTS federation_self (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        epoch TEXT NOT NULL
+    )
+    """)
+    # a new database is a new change log: peers holding our old
+    # sequence numbers start over
+    execute(
+        "INSERT OR IGNORE INTO federation_self (id, epoch) VALUES (1, ?)",
+        (secrets.token_hex(8),)
+    )
+
+    # FULL-TEXT SEARCH (media_fts + sync triggers)
+    init_search()
+
     ensure_root_user()
     ensure_active_column()
+    ensure_position_column()
+    ensure_fingerprint_columns()
+    ensure_origin_column()
+    ensure_upload_result_columns()
+    ensure_run_after_column()
+    ensure_change_log()
 
 
 def ensure_root_user():
@@ -76,3 +286,110 @@ def ensure_active_column():
     if "active" not in col_names:
         execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
         print("[DB] Added missing `active` column to users table")
+
+
+def ensure_position_column():
+    """
+    Migration helper: watch_history.position holds the resume point in
+    seconds (`progress` stays the percentage shown on cards).
+    """
+    cols = query("PRAGMA table_info(watch_history)")
+    col_names = [c["name"] for c in cols]
+
+    if "position" not in col_names:
+        execute("ALTER TABLE watch_history ADD COLUMN position REAL")
+        print("[DB] Added missing `position` column to watch_history table")
+
+
+def ensure_fingerprint_columns():
+    """
+    Migration helper: content fingerprints on the file index, plus the
+    index duplicate and move lookups go through.
+    """
+    cols = query("PRAGMA table_info(media_files)")
+    col_names = [c["name"] for c in cols]
+
+    for col in ("fingerprint", "full_hash"):
+        if col not in col_names:
+            execute(f"ALTER TABLE media_files ADD COLUMN {col} TEXT")
+            print(f"[DB] Added missing `{col}` column to media_files table")
+
+    execute("""
+    CREATE INDEX IF NOT EXISTS idx_media_files_fingerprint
+    ON media_files(fingerprint)
+    """)
+
+
+def ensure_origin_column():
+    """
+    Migration helper: media.origin names the peer a mirrored item
+    lives on (NULL for files in MEDIA_DIR).
+    """
+    cols = query("PRAGMA table_info(media)")
+    col_names = [c["name"] for c in cols]
+
+    if "origin" not in col_names:
+        execute("ALTER TABLE media ADD COLUMN origin TEXT")
+        print("[DB] Added missing `origin` column to media table")
+
+
+def ensure_upload_result_columns():
+    """
+    Migration helper: a completed upload keeps its row with the item it
+    became, so a repeated complete returns the same result.
+    """
+    cols = query("PRAGMA table_info(uploads)")
+    col_names = [c["name"] for c in cols]
+
+    for col, kind in (("media_id", "INTEGER"), ("filepath", "TEXT")):
+        if col not in col_names:
+            execute(f"ALTER TABLE uploads ADD COLUMN {col} {kind}")
+            print(f"[DB] Added missing `{col}` column to uploads table")
+
+
+def ensure_run_after_column():
+    """
+    Migration helper: jobs.run_after holds back a job its handler asked
+    to retry later (NULL = run now).
+    """
+    cols = query("PRAGMA table_info(jobs)")
+    col_names = [c["name"] for c in cols]
+
+    if "run_after" not in col_names:
+        execute("ALTER TABLE jobs ADD COLUMN run_after TIMESTAMP")
+        print("[DB] Added missing `run_after` column to jobs table")
+
+
+def ensure_change_log():
+    """
+    Triggers recording every change to local media (and to their
+    fingerprints) in media_changes, whoever makes it: scanner, watcher,
+    uploads. Plain statements rather than OR REPLACE, which an outer
+    upsert would override. Libraries that predate the log are entered
+    once.
+    """
+    next_seq = "(SELECT IFNULL(MAX(seq), 0) + 1 FROM media_changes)"
+
+    for name, event, row, when in (
+        ("media_changes_insert", "INSERT ON media", "new.id", "WHEN new.origin IS NULL"),
+        ("media_changes_update", "UPDATE ON media", "new.id", "WHEN new.origin IS NULL"),
+        ("media_changes_delete", "DELETE ON media", "old.id", "WHEN old.origin IS NULL"),
+        ("media_changes_file_insert", "INSERT ON media_files", "new.media_id", ""),
+        ("media_changes_file_update", "UPDATE OF fingerprint, size ON media_files",
+         "new.media_id", ""),
+    ):
+        execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} {when}
+        BEGIN
+            UPDATE media_changes SET seq = {next_seq} WHERE media_id = {row};
+            INSERT INTO media_changes (media_id, seq)
+            SELECT {row}, {next_seq}
+            WHERE NOT EXISTS (SELECT 1 FROM media_changes WHERE media_id = {row});
+        END
+        """)
+
+    if not query("SELECT 1 FROM media_changes LIMIT 1", one=True):
+        execute("""
+        INSERT INTO media_changes (media_id, seq)
+        SELECT id, id FROM media WHERE origin IS NULL
+        """)
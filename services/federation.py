@@ -0,0 +1,564 @@
+# services/federation.py
+
+import hmac
+import json
+import math
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import quote, urlencode
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from config import (
+    MEDIA_DIR,
+    VIDEO_EXT,
+    FEDERATION_PEERS,
+    FEDERATION_SECRET,
+    FEDERATION_NODE,
+    FEDERATION_URL,
+    FEDERATION_SYNC_INTERVAL,
+    FEDERATION_CAPACITY_MBPS,
+    FEDERATION_LOCAL_BIAS,
+    FEDERATION_TOKEN_TTL,
+)
+from models.base import query, transaction, release_db
+from services import bandwidth
+from services.cache import bump_catalog
+from services.thumbnails import ensure_thumb
+
+# Items mirrored from a peer have filepath "@<node>/<path on that node>"
+REMOTE_PREFIX = "@"
+FEED_BATCH = 500
+PEER_TIMEOUT = 5.0
+# peers not heard from for this many sync intervals get no streams
+PEER_STALE_INTERVALS = 3
+LOAD_TTL = 1.0
+# assumed rate of a stream sent to a peer since its last report, so a
+# burst of plays is not all sent to the same idle node
+STREAM_ESTIMATE = 8 * bandwidth.MBPS
+
+CAPACITY = FEDERATION_CAPACITY_MBPS * bandwidth.MBPS
+
+_lock = threading.Lock()
+_peers = {"loaded": 0.0, "nodes": {}}
+_local = {"at": 0.0, "load": None}
+_assigned = {}          # node -> {(user, filename): time sent}
+_failing = set()        # peer URLs whose last sync failed
+_thread = None
+
+
+def enabled():
+    return bool(FEDERATION_PEERS and FEDERATION_SECRET)
+
+
+def is_remote(filepath):
+    return filepath.startswith(REMOTE_PREFIX)
+
+
+def split_remote(filepath):
+    node, _, path = filepath[len(REMOTE_PREFIX):].partition("/")
+    return node, path
+
+
+def authorized(header):
+    """
+    True if an Authorization header carries the shared secret.
+    """
+    if not enabled() or not header:
+        return False
+    return hmac.compare_digest(header, f"Bearer {FEDERATION_SECRET}")
+
+
+# ----------------------------
+# Visiting users
+# ----------------------------
+
+def _serializer():
+    return URLSafeTimedSerializer(FEDERATION_SECRET, salt="federation-media")
+
+
+def media_token(user, path):
+    """
+    Lets `user`, signed in here, fetch `path` from a peer.
+    """
+    return _serializer().dumps({
+        "u": user["username"], "r": user["role"], "n": FEDERATION_NODE, "p": path,
+    })
+
+
+def token_user(token, path):
+    """
+    The user a peer's token vouches for, as a user record for the
+    bandwidth scheduler, or None if it is invalid, expired or for
+    another file.
+    """
+    if not enabled():
+        return None
+    try:
+        data = _serializer().loads(token, max_age=FEDERATION_TOKEN_TTL)
+    except BadSignature:
+        return None
+    if data.get("p") != path:
+        return None
+
+    name = f"{data['u']}@{data['n']}"
+    return {"id": name, "username": name, "role": data["r"], "active": 1}
+
+
+# ----------------------------
+# Change feed (served to peers)
+# ----------------------------
+
+def local_load():
+    """
+    (capacity, rate, streams) of this node, all workers together.
+    """
+    now = time.monotonic()
+    if now - _local["at"] > LOAD_TTL:
+        snap = bandwidth.snapshot()
+        _local["load"] = (CAPACITY, snap["total_rate"], len(snap["streams"]))
+        _local["at"] = now
+    return _local["load"]
+
+
+def feed(since, limit=FEED_BATCH):
+    """
+    Local media changed after sequence number `since`, oldest first:
+    current title, path and fingerprint, or filepath None once gone.
+    """
+    rows = query(
+        """
+        SELECT c.seq, c.media_id, m.title, m.filepath, m.category,
+               f.fingerprint, f.size
+        FROM media_changes c
+        LEFT JOIN media m ON m.id = c.media_id
+        LEFT JOIN media_files f ON f.filepath = m.filepath
+        WHERE c.seq > ?
+        ORDER BY c.seq
+        LIMIT ?
+        """,
+        (since, limit)
+    )
+    epoch = query("SELECT epoch FROM federation_self", one=True)["epoch"]
+    capacity, rate, streams = local_load()
+
+    return {
+        "node": FEDERATION_NODE,
+        "epoch": epoch,
+        "url": FEDERATION_URL,
+        "capacity": capacity,
+        "rate": rate,
+        "streams": streams,
+        "changes": [
+            {
+                "seq": row["seq"],
+                "id": row["media_id"],
+                "title": row["title"],
+                "filepath": row["filepath"],
+                "category": row["category"],
+                "fingerprint": row["fingerprint"],
+                "size": row["size"],
+            }
+            for row in rows
+        ],
+    }
+
+
+# ----------------------------
+# Mirroring (pulled from peers)
+# ----------------------------
+
+def _fetch(url, since):
+    req = urllib.request.Request(
+        f"{url}/federation/changes?{urlencode({'since': since})}",
+        headers={"Authorization": f"Bearer {FEDERATION_SECRET}"},
+    )
+    with urllib.request.urlopen(req, timeout=PEER_TIMEOUT) as resp:
+        return json.loads(resp.read())
+
+
+def _holder(db, fingerprint):
+    """
+    The media row already showing this content (a local file or
+    another peer's copy), so each title is listed once.
+    """
+    if not fingerprint:
+        return None
+    row = db.execute(
+        """
+        SELECT media_id FROM media_files WHERE fingerprint = ?
+        UNION ALL
+        SELECT r.media_id FROM remote_media r
+        JOIN media m ON m.id = r.media_id
+        WHERE r.fingerprint = ?
+        LIMIT 1
+        """,
+        (fingerprint, fingerprint)
+    ).fetchone()
+    return row["media_id"] if row else None
+
+
+def _mirror(db, node, item):
+    return db.execute(
+        "INSERT INTO media (title, filepath, category, origin) VALUES (?, ?, ?, ?)",
+        (item["title"], f"{REMOTE_PREFIX}{node}/{item['filepath']}", item["category"], node)
+    ).lastrowid
+
+
+def _remove(db, node, old):
+    """
+    Forgets one remote item. Its media row goes too, unless another
+    peer holds the same content, which then takes the row over.
+    """
+    db.execute(
+        "DELETE FROM remote_media WHERE node = ? AND remote_id = ?",
+        (node, old["remote_id"])
+    )
+    owned = db.execute(
+        "SELECT 1 FROM media WHERE id = ? AND filepath = ?",
+        (old["media_id"], f"{REMOTE_PREFIX}{node}/{old['filepath']}")
+    ).fetchone()
+    if not owned:
+        return  # listed through a local file or another peer's item
+
+    other = db.execute(
+        "SELECT node, filepath FROM remote_media WHERE media_id = ? LIMIT 1",
+        (old["media_id"],)
+    ).fetchone()
+    if other:
+        db.execute(
+            "UPDATE media SET origin = ?, filepath = ? WHERE id = ?",
+            (other["node"], f"{REMOTE_PREFIX}{other['node']}/{other['filepath']}",
+             old["media_id"])
+        )
+    else:
+        db.execute("DELETE FROM media WHERE id = ?", (old["media_id"],))
+
+
+def _apply(db, node, item):
+    old = db.execute(
+        """
+        SELECT remote_id, media_id, filepath, fingerprint FROM remote_media
+        WHERE node = ? AND remote_id = ?
+        """,
+        (node, item["id"])
+    ).fetchone()
+
+    # new content may now duplicate something else, or stop doing so
+    if old is not None and (item["filepath"] is None or old["fingerprint"] != item["fingerprint"]):
+        _remove(db, node, old)
+        old = None
+    if item["filepath"] is None:
+        return
+
+    if old is not None:
+        db.execute(
+            """
+            UPDATE remote_media SET filepath = ?, title = ?, category = ?, size = ?
+            WHERE node = ? AND remote_id = ?
+            """,
+            (item["filepath"], item["title"], item["category"], item["size"], node, item["id"])
+        )
+        db.execute(
+            "UPDATE media SET title = ?, category = ?, filepath = ? WHERE id = ? AND filepath = ?",
+            (item["title"], item["category"], f"{REMOTE_PREFIX}{node}/{item['filepath']}",
+             old["media_id"], f"{REMOTE_PREFIX}{node}/{old['filepath']}")
+        )
+        return
+
+    media_id = _holder(db, item["fingerprint"])
+    if media_id is None:
+        media_id = _mirror(db, node, item)
+    db.execute(
+        """
+        INSERT INTO remote_media
+            (node, remote_id, media_id, filepath, title, category, fingerprint, size)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (node, item["id"], media_id, item["filepath"], item["title"], item["category"],
+         item["fingerprint"], item["size"])
+    )
+
+
+def _repair(db):
+    """
+    Lists remote items again whose row went with a deleted local file.
+    """
+    rows = db.execute(
+        """
+        SELECT r.* FROM remote_media r
+        LEFT JOIN media m ON m.id = r.media_id
+        WHERE m.id IS NULL
+        """
+    ).fetchall()
+
+    rehomed = {}
+    for row in rows:
+        if row["media_id"] not in rehomed:
+            rehomed[row["media_id"]] = _mirror(db, row["node"], row)
+        db.execute(
+            "UPDATE remote_media SET media_id = ? WHERE node = ? AND remote_id = ?",
+            (rehomed[row["media_id"]], row["node"], row["remote_id"])
+        )
+    return len(rows)
+
+
+def _forget(db, node):
+    rows = db.execute(
+        "SELECT remote_id, media_id, filepath FROM remote_media WHERE node = ?", (node,)
+    ).fetchall()
+    for row in rows:
+        _remove(db, node, row)
+    return len(rows)
+
+
+def _save_peer(db, url, node, epoch, seq, data):
+    db.execute(
+        """
+        INSERT INTO federation_peers
+            (url, node, epoch, seq, public_url, capacity, rate, streams, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET
+            node = excluded.node,
+            epoch = excluded.epoch,
+            seq = excluded.seq,
+            public_url = excluded.public_url,
+            capacity = excluded.capacity,
+            rate = excluded.rate,
+            streams = excluded.streams,
+            last_seen = excluded.last_seen
+        """,
+        (url, node, epoch, seq, data["url"] or url, data["capacity"], data["rate"],
+         data["streams"], time.time())
+    )
+
+
+def sync_peer(url):
+    """
+    Pulls a peer's changes since the last sync and records its load.
+    A peer with a new identity or a new database is mirrored afresh.
+    Returns the number of changes applied.
+    """
+    row = query("SELECT node, epoch, seq FROM federation_peers WHERE url = ?", (url,), one=True)
+    node, epoch, since = (row["node"], row["epoch"], row["seq"]) if row else (None, None, 0)
+    applied = 0
+
+    while True:
+        data = _fetch(url, since)
+        if data["node"] == FEDERATION_NODE or "/" in data["node"]:
+            raise ValueError(f"peer reports an unusable node id {data['node']!r}")
+
+        if (data["node"], data["epoch"]) != (node, epoch):
+            if node is not None:
+                with transaction() as db:
+                    applied += _forget(db, node)
+            node, epoch = data["node"], data["epoch"]
+            if since:
+                since = 0
+                continue
+
+        changes = data["changes"]
+        with transaction() as db:
+            for item in changes:
+                _apply(db, node, item)
+            if changes:
+                since = changes[-1]["seq"]
+            # saved with the changes, so a crash never skips or replays a batch
+            _save_peer(db, url, node, epoch, since, data)
+        applied += len(changes)
+
+        if len(changes) < FEED_BATCH:
+            break
+
+    with transaction() as db:
+        applied += _repair(db)
+
+    if applied:
+        bump_catalog()
+        print(f"[FEDERATION] {node}: applied {applied} changes")
+    return applied
+
+
+def _loop():
+    while True:
+        for url in FEDERATION_PEERS:
+            try:
+                sync_peer(url)
+                if url in _failing:
+                    _failing.discard(url)
+                    print(f"[FEDERATION] {url} reachable again")
+            except (OSError, ValueError, KeyError) as e:
+                if url not in _failing:
+                    _failing.add(url)
+                    print(f"[FEDERATION] Sync with {url} failed: {e}")
+            finally:
+                release_db()
+        time.sleep(FEDERATION_SYNC_INTERVAL)
+
+
+def start_sync():
+    """
+    Starts pulling from FEDERATION_PEERS; one puller per deployment.
+    """
+    global _thread
+    if not enabled():
+        if FEDERATION_PEERS:
+            print("[FEDERATION] FEDERATION_PEERS set without FEDERATION_SECRET, not federating")
+        return
+    if _thread is None or not _thread.is_alive():
+        _thread = threading.Thread(target=_loop, name="federation", daemon=True)
+        _thread.start()
+
+
+# ----------------------------
+# Routing
+# ----------------------------
+
+def _peer_nodes():
+    """
+    {node: peer row} for peers heard from lately; reloaded every
+    LOAD_TTL seconds, as the puller may run in another process.
+    """
+    now = time.monotonic()
+    if now - _peers["loaded"] > LOAD_TTL:
+        fresh = time.time() - PEER_STALE_INTERVALS * FEDERATION_SYNC_INTERVAL
+        rows = query(
+            """
+            SELECT node, public_url, capacity, rate, streams, last_seen
+            FROM federation_peers
+            WHERE node IS NOT NULL AND last_seen > ?
+            """,
+            (fresh,)
+        )
+        nodes = {row["node"]: dict(row) for row in rows}
+        with _lock:
+            for node, sent in list(_assigned.items()):
+                seen = nodes.get(node, {}).get("last_seen", math.inf)
+                for key, at in list(sent.items()):
+                    if at < seen:
+                        del sent[key]  # counted in the peer's own report
+        _peers["nodes"] = nodes
+        _peers["loaded"] = now
+    return _peers["nodes"]
+
+
+def _load(node, peers):
+    """
+    Share of its capacity a node is sending (`node` None: this one).
+    """
+    if node is None:
+        capacity, rate, _streams = local_load()
+    else:
+        peer = peers[node]
+        capacity = peer["capacity"]
+        rate = peer["rate"] + len(_assigned.get(node, ())) * STREAM_ESTIMATE
+    return rate / capacity if capacity else math.inf
+
+
+def route(filename, user):
+    """
+    Where to serve /media/<filename> from: (None, path) for a file in
+    this node's MEDIA_DIR, else (URL, None) on the peer that should send
+    it. Every node holding the same content is a candidate; this node
+    keeps the stream unless a peer is FEDERATION_LOCAL_BIAS less loaded.
+    Raises LookupError when the only holders are unreachable.
+    """
+    if not enabled():
+        return None, filename
+
+    peers = _peer_nodes()
+    holders = {}
+    local = None
+
+    if is_remote(filename):
+        node, path = split_remote(filename)
+        row = query(
+            "SELECT fingerprint FROM remote_media WHERE node = ? AND filepath = ?",
+            (node, path),
+            one=True
+        )
+        if not row:
+            return None, filename  # not ours to route; a 404 below
+        holders[node] = path
+        fingerprint = row["fingerprint"]
+    else:
+        local = filename
+        row = query(
+            "SELECT fingerprint FROM media_files WHERE filepath = ?", (filename,), one=True
+        )
+        fingerprint = row["fingerprint"] if row else None
+        if not fingerprint:
+            return None, filename
+
+    if fingerprint:
+        for row in query(
+            "SELECT node, filepath FROM remote_media WHERE fingerprint = ?", (fingerprint,)
+        ):
+            holders.setdefault(row["node"], row["filepath"])
+        if local is None:
+            row = query(
+                "SELECT filepath FROM media_files WHERE fingerprint = ? LIMIT 1",
+                (fingerprint,),
+                one=True
+            )
+            local = row["filepath"] if row else None
+
+    holders = {node: path for node, path in holders.items() if node in peers}
+    best = min(holders, key=lambda node: _load(node, peers), default=None)
+
+    if local is not None and (
+        best is None or _load(None, peers) <= _load(best, peers) + FEDERATION_LOCAL_BIAS
+    ):
+        return None, local
+    if best is None:
+        raise LookupError(f"no reachable node holds {filename}")
+
+    path = holders[best]
+    with _lock:
+        _assigned.setdefault(best, {})[(user["id"], path)] = time.time()
+    url = f"{peers[best]['public_url']}/media/{quote(path)}"
+    return f"{url}?{urlencode({'fed': media_token(user, path)})}", None
+
+
+# ----------------------------
+# Thumbnails
+# ----------------------------
+
+def thumb_url(media_id):
+    """
+    Card image URL of a mirrored item; see thumb_location().
+    """
+    return f"/federation/thumbs/{media_id}"
+
+
+def thumb_location(media_id):
+    """
+    Where /federation/thumbs/<id> points: this node's thumbnail for a
+    local item, or the same route on the peer holding a mirrored one.
+    """
+    row = query("SELECT filepath, origin FROM media WHERE id = ?", (media_id,), one=True)
+    if not row:
+        return None
+
+    if row["origin"] is None:
+        path = MEDIA_DIR / row["filepath"]
+        if path.suffix.lower() in VIDEO_EXT:
+            return ensure_thumb(path, media_id)
+        return "/static/thumbs/file.png"
+
+    node, path = split_remote(row["filepath"])
+    peer = query(
+        """
+        SELECT p.public_url, r.remote_id
+        FROM remote_media r
+        JOIN federation_peers p ON p.node = r.node
+        WHERE r.node = ? AND r.filepath = ?
+        """,
+        (node, path),
+        one=True
+    )
+    if peer is None:
+        return None
+    return f"{peer['public_url']}/federation/thumbs/{peer['remote_id']}"
@@ -0,0 +1,192 @@
+# services/fingerprint.py
+
+import hashlib
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import MEDIA_DIR, SCAN_WORKERS, SCAN_BATCH, FINGERPRINT_FULL
+from models.base import query, execute_many, transaction
+from services import jobs
+from services.cache import bump_catalog, catalog_version
+
+# Bytes sampled at the head, middle and tail of each file
+SAMPLE_SIZE = 64 * 1024
+FULL_HASH_BLOCK = 8 * 1024 * 1024
+
+# alias media_id -> canonical media_id, for duplicates only, and the
+# catalog version it was loaded at (other processes may rescan)
+_aliases = {}
+_aliases_version = None
+_aliases_lock = threading.Lock()
+
+
+# ----------------------------
+# Hashing
+# ----------------------------
+
+def fingerprint(path):
+    """
+    Fast content fingerprint: BLAKE2b over the size and three
+    SAMPLE_SIZE windows (head, middle, tail). Small files are hashed
+    whole. Reads a few pages per file, whatever its size.
+    """
+    h = hashlib.blake2b(digest_size=16)
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(size.to_bytes(8, "little"))
+        if size == 0:
+            return h.hexdigest()
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            if size <= 3 * SAMPLE_SIZE:
+                h.update(mm)
+            else:
+                middle = size // 2 - SAMPLE_SIZE // 2
+                for start in (0, middle, size - SAMPLE_SIZE):
+                    h.update(mm[start:start + SAMPLE_SIZE])
+
+    return h.hexdigest()
+
+
+def full_hash(path):
+    """
+    BLAKE2b-256 of the whole file, for integrity checks.
+    """
+    h = hashlib.blake2b(digest_size=32)
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest()
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            for start in range(0, len(mm), FULL_HASH_BLOCK):
+                h.update(mm[start:start + FULL_HASH_BLOCK])
+
+    return h.hexdigest()
+
+
+def _safe(fn, relpath):
+    try:
+        return fn(MEDIA_DIR / relpath)
+    except (OSError, ValueError):
+        return None  # vanished or unreadable; retried on the next scan
+
+
+def fingerprint_many(relpaths, fn=fingerprint):
+    """
+    {relpath: digest or None}, hashed on SCAN_WORKERS threads (mmap
+    reads release the GIL while they wait on the disk).
+    """
+    relpaths = list(relpaths)
+    if not relpaths:
+        return {}
+
+    with ThreadPoolExecutor(SCAN_WORKERS) as pool:
+        return dict(zip(relpaths, pool.map(lambda p: _safe(fn, p), relpaths)))
+
+
+# ----------------------------
+# Duplicates
+# ----------------------------
+
+def canonical_id(media_id):
+    """
+    The media id whose thumbnails, probe, variants and HLS packages
+    this item shares (itself unless it duplicates an older item).
+    """
+    if _aliases_version != catalog_version():
+        _load_aliases()
+    return _aliases.get(media_id, media_id)
+
+
+def _load_aliases():
+    """
+    Rebuilds the duplicate map from media_files: files with the same
+    content all point at the lowest media id. Returns True if it
+    changed.
+    """
+    global _aliases, _aliases_version
+
+    version = catalog_version()
+    key = "fingerprint || ':' || full_hash" if FINGERPRINT_FULL else "fingerprint"
+    rows = query(
+        f"""
+        SELECT media_id, {key} AS content
+        FROM media_files
+        WHERE {key} IN (
+            SELECT {key} FROM media_files
+            WHERE {key} IS NOT NULL
+            GROUP BY {key}
+            HAVING COUNT(*) > 1
+        )
+        ORDER BY media_id
+        """
+    )
+
+    canonical, aliases = {}, {}
+    for row in rows:
+        first = canonical.setdefault(row["content"], row["media_id"])
+        if first != row["media_id"]:
+            aliases[row["media_id"]] = first
+
+    with _aliases_lock:
+        changed, _aliases = aliases != _aliases, aliases
+        _aliases_version = version
+    return changed
+
+
+def refresh_aliases():
+    """
+    Reloads the duplicate map after the library changed.
+    """
+    if _load_aliases():
+        bump_catalog()  # cards now point at shared thumbnails
+    return len(_aliases)
+
+
+# ----------------------------
+# Backfill
+# ----------------------------
+
+def enqueue_backfill():
+    jobs.enqueue("fingerprint", "backfill", priority=-1)
+
+
+@jobs.handler("fingerprint")
+def backfill_job(payload):
+    """
+    Job handler: fingerprints indexed files that have none yet (and
+    full-hashes them when FINGERPRINT_FULL is on), batch by batch.
+    """
+    todo = [
+        row["filepath"]
+        for row in query(
+            "SELECT filepath FROM media_files WHERE fingerprint IS NULL"
+            + (" OR full_hash IS NULL" if FINGERPRINT_FULL else "")
+        )
+    ]
+
+    for start in range(0, len(todo), SCAN_BATCH):
+        batch = todo[start:start + SCAN_BATCH]
+        fps = fingerprint_many(batch)
+        full = fingerprint_many(batch, full_hash) if FINGERPRINT_FULL else {}
+
+        with transaction():
+            execute_many(
+                """
+                UPDATE media_files
+                SET fingerprint = ?, full_hash = COALESCE(?, full_hash)
+                WHERE filepath = ?
+                """,
+                [(fps[fp], full.get(fp), fp) for fp in batch if fps[fp]]
+            )
+
+    if todo:
+        print(f"[FINGERPRINT] Hashed {len(todo)} files")
+        refresh_aliases()
@@ -0,0 +1,438 @@
+# services/hls.py
+
+import fcntl
+import mimetypes
+import os
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from flask import abort
+from werkzeug.security import safe_join
+
+from config import (
+    MEDIA_DIR,
+    HLS_DIR,
+    HLS_CACHE_BYTES,
+    HLS_LADDER,
+    HLS_SEGMENT_TYPE,
+    HLS_SEGMENT_SECONDS,
+    HLS_MAX_LIVE,
+    HLS_START_TIMEOUT,
+    HLS_PREPACKAGE_WORKERS,
+)
+from models.base import query
+from services import jobs, metrics
+from services.probe import has_audio, video_size
+from services.fingerprint import canonical_id
+
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/iso.segment", ".m4s")
+mimetypes.add_type("video/mp2t", ".ts")
+
+COMPLETE = ".complete"
+ACCESS = ".last_access"
+AUDIO_KBPS = 128
+# Seconds before a prepackage job tries again when every packager is busy
+BUSY_RETRY = 30
+
+jobs.dedicated_pool("hls", HLS_PREPACKAGE_WORKERS)
+
+# media_id -> running ffmpeg Popen, the thread settling the package
+# when it exits, and the lock file descriptor that tells other worker
+# processes this one is packaging it
+_running = {}
+_watchers = {}
+_lock_fds = {}
+_lock = threading.Lock()
+
+
+# ----------------------------
+# Paths
+# ----------------------------
+
+def package_dir(media_id) -> Path:
+    return HLS_DIR / str(media_id)
+
+
+def _source_path(media_id):
+    row = query("SELECT filepath FROM media WHERE id = ?", (media_id,), one=True)
+    if not row:
+        return None
+    path = MEDIA_DIR / row["filepath"]
+    return path if path.is_file() else None
+
+
+def resolve_hls_path(media_id, name) -> Path:
+    joined = safe_join(str(package_dir(media_id)), name)
+    if joined is None:
+        abort(404)
+    return Path(joined)
+
+
+def is_complete(media_id):
+    return (package_dir(media_id) / COMPLETE).exists()
+
+
+def _claim(media_id):
+    """
+    flock()s the package's lock file. Returns the descriptor, or None
+    when another process holds it.
+    """
+    HLS_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(HLS_DIR / f".{media_id}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def is_packaging(media_id):
+    """
+    True while ffmpeg is producing the package, in this process or any
+    other worker.
+    """
+    if media_id in _running:
+        return True
+    fd = _claim(media_id)
+    if fd is None:
+        return True
+    os.close(fd)
+    return False
+
+
+# ----------------------------
+# Packaging
+# ----------------------------
+
+def _has_audio(media_id, path):
+    known = has_audio(media_id)
+    if known is not None:
+        return known
+
+    out = subprocess.run(
+        [
+            "ffprobe", "-v", "error",
+            "-select_streams", "a",
+            "-show_entries", "stream=index",
+            "-of", "csv=p=0",
+            str(path),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    return bool(out.stdout.strip())
+
+
+def _video_size(media_id, path):
+    known = video_size(media_id)
+    if known is not None:
+        return known
+
+    out = subprocess.run(
+        [
+            "ffprobe", "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=width,height",
+            "-of", "csv=p=0",
+            str(path),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    try:
+        width, height = (int(v) for v in out.stdout.split()[0].split(",")[:2])
+    except (IndexError, ValueError):
+        return None
+    return (width, height) if width and height else None
+
+
+def _ladder(size):
+    """
+    The HLS_LADDER rungs worth encoding for a source of `size` (width,
+    height). Rungs are never upscaled, so all those at or above the
+    source height would come out the same: only the first of them is
+    kept, at the source's own size. That also keeps the lowest rung
+    for the smallest sources. All of them when the size is unknown.
+    """
+    if size is None:
+        return list(HLS_LADDER)
+    above = [rung for rung in HLS_LADDER if rung[0] >= size[1]]
+    native = min(above) if above else None
+    return [rung for rung in HLS_LADDER if rung[0] < size[1] or rung == native]
+
+
+def _resolution(height, size):
+    """
+    "WxH" a rung scaled to `height` comes out at (never upscaled,
+    width even, as scale=-2 makes it).
+    """
+    width, source_height = size
+    height = min(height, source_height)
+    return f"{max(2, round(width * height / source_height / 2) * 2)}x{height}"
+
+
+def _write_master(out_dir, audio, rungs, size):
+    """
+    Written before ffmpeg starts so players can fetch it immediately;
+    variant playlists appear as soon as their first segment lands.
+    """
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7", "#EXT-X-INDEPENDENT-SEGMENTS"]
+    for i, (height, kbps) in enumerate(rungs):
+        bandwidth = (kbps + (AUDIO_KBPS if audio else 0)) * 1000
+        attrs = f"BANDWIDTH={bandwidth}"
+        if size is not None:
+            attrs += f",RESOLUTION={_resolution(height, size)}"
+        if size is not None:
+            height = min(height, size[1])
+        lines.append(f"#EXT-X-STREAM-INF:{attrs},NAME=\"{height}p\"")
+        lines.append(f"v{i}/index.m3u8")
+
+    tmp = out_dir / "master.m3u8.tmp"
+    tmp.write_text("\n".join(lines) + "\n")
+    os.replace(tmp, out_dir / "master.m3u8")
+
+
+def _ffmpeg_args(src, out_dir, audio, rungs):
+    args = ["ffmpeg", "-y", "-loglevel", "error", "-i", str(src)]
+
+    for _ in rungs:
+        args += ["-map", "0:v:0"]
+        if audio:
+            args += ["-map", "0:a:0"]
+
+    args += [
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-profile:v", "main",
+        "-sc_threshold", "0",
+        "-force_key_frames", "expr:gte(t,n_forced*2)",
+    ]
+
+    for i, (height, kbps) in enumerate(rungs):
+        args += [
+            f"-filter:v:{i}", f"scale=-2:'min({height},ih)'",
+            f"-b:v:{i}", f"{kbps}k",
+            f"-maxrate:v:{i}", f"{int(kbps * 1.07)}k",
+            f"-bufsize:v:{i}", f"{int(kbps * 1.5)}k",
+        ]
+
+    if audio:
+        args += ["-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k", "-ac", "2"]
+
+    stream_map = " ".join(
+        f"v:{i},a:{i}" if audio else f"v:{i}" for i in range(len(rungs))
+    )
+    ext = "m4s" if HLS_SEGMENT_TYPE == "fmp4" else "ts"
+
+    args += [
+        "-f", "hls",
+        "-hls_time", str(HLS_SEGMENT_SECONDS),
+        "-hls_init_time", "2",
+        "-hls_playlist_type", "event",
+        "-hls_flags", "independent_segments+temp_file",
+        "-hls_segment_type", HLS_SEGMENT_TYPE,
+        "-var_stream_map", stream_map,
+        "-hls_segment_filename", str(out_dir / "v%v" / f"seg_%05d.{ext}"),
+    ]
+    if HLS_SEGMENT_TYPE == "fmp4":
+        args += ["-hls_fmp4_init_filename", "init.mp4"]
+
+    args.append(str(out_dir / "v%v" / "index.m3u8"))
+    return args
+
+
+def _watch(media_id, proc, out_dir):
+    started = time.monotonic()
+    code = proc.wait()
+    metrics.ffmpeg_seconds.observe(time.monotonic() - started, task="hls")
+
+    # settle the directory before the lock goes, so another worker
+    # never sees a half-cleaned package
+    if code == 0:
+        (out_dir / COMPLETE).touch()
+    else:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    with _lock:
+        _running.pop(media_id, None)
+        _watchers.pop(media_id, None)
+        os.close(_lock_fds.pop(media_id))
+
+    if code == 0:
+        evict_hls_cache()
+    else:
+        print(f"[HLS] packaging {media_id} failed (ffmpeg exit {code})")
+
+
+def start_package(media_id):
+    """
+    Starts packaging unless it is done or already running. Returns the
+    running Popen (None when already complete or being packaged by
+    another worker process). Raises RuntimeError when HLS_MAX_LIVE
+    packagers are busy.
+    """
+    with _lock:
+        if media_id in _running:
+            return _running[media_id]
+    if is_complete(media_id):
+        return None
+
+    src = _source_path(media_id)
+    if src is None:
+        raise FileNotFoundError(media_id)
+    audio = _has_audio(media_id, src)
+    size = _video_size(media_id, src)
+    rungs = _ladder(size)
+
+    with _lock:
+        if media_id in _running:
+            return _running[media_id]
+        if len(_running) >= HLS_MAX_LIVE:
+            raise RuntimeError("all HLS packagers busy")
+
+        lock_fd = _claim(media_id)
+        if lock_fd is None or is_complete(media_id):
+            if lock_fd is not None:
+                os.close(lock_fd)
+            return None
+
+        out_dir = package_dir(media_id)
+        shutil.rmtree(out_dir, ignore_errors=True)  # stale partial run
+        for i in range(len(rungs)):
+            (out_dir / f"v{i}").mkdir(parents=True, exist_ok=True)
+
+        _write_master(out_dir, audio, rungs, size)
+
+        try:
+            proc = subprocess.Popen(
+                _ffmpeg_args(src, out_dir, audio, rungs),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError:
+            os.close(lock_fd)
+            raise
+        watcher = threading.Thread(
+            target=_watch, args=(media_id, proc, out_dir),
+            name=f"hls-{media_id}", daemon=True
+        )
+        _running[media_id] = proc
+        _watchers[media_id] = watcher
+        _lock_fds[media_id] = lock_fd
+
+    watcher.start()
+    return proc
+
+
+def enqueue_hls(media_id, priority=0):
+    media_id = canonical_id(media_id)
+    jobs.enqueue("hls", media_id, {"media_id": media_id}, priority=priority)
+
+
+@jobs.handler("hls")
+def package_job(payload):
+    """
+    Job handler: ahead-of-time packaging on the "hls" pool, waits for
+    ffmpeg to finish. Requeued for later while live packagers fill
+    HLS_MAX_LIVE.
+    """
+    media_id = payload["media_id"]
+    try:
+        proc = start_package(media_id)
+    except RuntimeError:
+        raise jobs.Retry(BUSY_RETRY)
+
+    if proc is not None:
+        with _lock:
+            watcher = _watchers.get(media_id)
+        if watcher is not None:
+            watcher.join()  # ffmpeg has exited and the package is settled
+        if not is_complete(media_id):
+            raise RuntimeError(f"packaging {media_id} failed")
+
+
+# ----------------------------
+# Serving
+# ----------------------------
+
+def touch(media_id):
+    marker = package_dir(media_id) / ACCESS
+    try:
+        marker.touch()
+    except FileNotFoundError:
+        pass
+
+
+def wait_for_file(path: Path, media_id, timeout=HLS_START_TIMEOUT):
+    """
+    Blocks until ffmpeg has produced `path`, so a player can request
+    a variant playlist or segment just ahead of the packager.
+    """
+    deadline = time.monotonic() + timeout
+    while not path.exists():
+        if not is_packaging(media_id) or time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+# ----------------------------
+# Cache eviction
+# ----------------------------
+
+def _dir_size(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _last_used(path):
+    for name in (ACCESS, COMPLETE):
+        try:
+            return os.stat(path / name).st_mtime
+        except FileNotFoundError:
+            continue
+    return 0.0
+
+
+def evict_hls_cache(max_bytes=HLS_CACHE_BYTES):
+    """
+    Deletes least recently watched packages until the cache fits.
+    Packages being produced are never evicted.
+    """
+    if not HLS_DIR.exists():
+        return 0
+
+    dirs = [d for d in HLS_DIR.iterdir() if d.is_dir()]
+    busy = {d.name for d in dirs if d.name.isdigit() and is_packaging(int(d.name))}
+
+    entries = [
+        (_last_used(d), _dir_size(d), d)
+        for d in dirs
+        if d.name not in busy
+    ]
+    total = sum(size for _, size, _ in entries) + sum(
+        _dir_size(HLS_DIR / m) for m in busy
+    )
+
+    evicted = 0
+    for _, size, d in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(d, ignore_errors=True)
+        total -= size
+        evicted += 1
+
+    if evicted:
+        print(f"[HLS] Evicted {evicted} packages")
+    return evicted
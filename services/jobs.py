@@ -0,0 +1,344 @@
+# services/jobs.py
+
+import json
+import threading
+import time
+import traceback
+
+from config import JOB_WORKERS, JOB_MAX_ATTEMPTS
+from models.base import query, execute, transaction
+from services import metrics
+
+# kind -> callable(payload: dict)
+HANDLERS = {}
+
+# callables run by a worker that finds nothing to claim, for work
+# batched over many jobs
+IDLE_HOOKS = []
+
+# kind -> worker count, for kinds served by their own pool (long CPU
+# bound jobs that must not starve thumbnails). The shared pool skips them.
+POOLS = {}
+
+# (kind, key) -> time queued, for jobs queued or running, so hot paths
+# skip the DB write. Only the process running the workers sees jobs
+# finish; elsewhere (pre-fork web workers) an entry is trusted for
+# REMOTE_INFLIGHT_TTL seconds.
+_inflight = {}
+_inflight_lock = threading.Lock()
+REMOTE_INFLIGHT_TTL = 60.0
+
+# (kind, key) -> time seen, for jobs that failed JOB_MAX_ATTEMPTS times:
+# enqueue() would not revive them, so hot paths skip the DB for
+# GAVE_UP_TTL seconds instead of writing on every call
+_gave_up = {}
+GAVE_UP_TTL = 600.0
+
+_wake = threading.Event()
+_stop = threading.Event()
+_threads = []
+
+POLL_INTERVAL = 2.0
+
+
+class Retry(Exception):
+    """
+    Raised by a handler to run the job again in `delay` seconds,
+    without counting an attempt (e.g. a resource it needs is busy).
+    """
+
+    def __init__(self, delay):
+        super().__init__(f"retry in {delay}s")
+        self.delay = delay
+
+
+# ----------------------------
+# Registration / enqueue
+# ----------------------------
+
+def handler(kind):
+    """
+    Registers the function that runs jobs of `kind`.
+    """
+    def decorator(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+
+def on_idle(fn):
+    """
+    Registers `fn()` to run whenever a worker finds the queue drained.
+    """
+    IDLE_HOOKS.append(fn)
+    return fn
+
+
+def dedicated_pool(kind, workers):
+    """
+    Runs jobs of `kind` on `workers` threads of their own.
+    """
+    POOLS[kind] = max(1, workers)
+
+
+def enqueue(kind, key, payload=None, priority=0):
+    """
+    Queues a job unless the same (kind, key) is already pending.
+    Finished jobs are re-queued; failed ones only while they have
+    attempts left. A pending job is moved up if `priority` is higher.
+    """
+    key = str(key)
+
+    now = time.monotonic()
+    with _inflight_lock:
+        queued_at = _inflight.get((kind, key))
+        pending = queued_at is not None and (
+            bool(_threads) or now - queued_at < REMOTE_INFLIGHT_TTL
+        )
+        if not pending:
+            _inflight[(kind, key)] = now
+
+    if not pending and _has_given_up(kind, key, now):
+        with _inflight_lock:
+            _inflight.pop((kind, key), None)
+        return False
+
+    if pending:
+        if priority > 0:
+            execute(
+                """
+                UPDATE jobs SET priority = ?
+                WHERE kind = ? AND key = ? AND status = 'queued' AND priority < ?
+                """,
+                (priority, kind, key, priority)
+            )
+        return False
+
+    execute(
+        """
+        INSERT INTO jobs (kind, key, payload, priority)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(kind, key) DO UPDATE SET
+            status = 'queued',
+            payload = excluded.payload,
+            priority = MAX(jobs.priority, excluded.priority),
+            run_after = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE jobs.status = 'done'
+           OR (jobs.status = 'failed' AND jobs.attempts < ?)
+        """,
+        (kind, key, json.dumps(payload or {}), priority, JOB_MAX_ATTEMPTS)
+    )
+
+    _wake.set()
+    return True
+
+
+def _has_given_up(kind, key, now):
+    """
+    True if (kind, key) used up its attempts. Remembered, so a card
+    with a thumbnail that cannot be made costs one read per
+    GAVE_UP_TTL rather than a write per render.
+    """
+    with _inflight_lock:
+        seen = _gave_up.get((kind, key))
+    if seen is not None and now - seen < GAVE_UP_TTL:
+        return True
+
+    row = query(
+        "SELECT status, attempts FROM jobs WHERE kind = ? AND key = ?",
+        (kind, key),
+        one=True
+    )
+    gave_up = bool(row) and row["status"] == "failed" and row["attempts"] >= JOB_MAX_ATTEMPTS
+    with _inflight_lock:
+        if gave_up:
+            _gave_up[(kind, key)] = now
+        else:
+            _gave_up.pop((kind, key), None)
+    return gave_up
+
+
+def queue_depth(kind=None):
+    sql = "SELECT COUNT(*) AS n FROM jobs WHERE status IN ('queued', 'running')"
+    params = ()
+    if kind:
+        sql += " AND kind = ?"
+        params = (kind,)
+    return query(sql, params, one=True)["n"]
+
+
+@metrics.collector
+def _collect_queue_depth():
+    counts = {
+        (r["kind"], r["status"]): r["n"]
+        for r in query(
+            """
+            SELECT kind, status, COUNT(*) AS n FROM jobs
+            WHERE status IN ('queued', 'running', 'failed')
+            GROUP BY kind, status
+            """
+        )
+    }
+    for kind in set(HANDLERS) | {k for k, _ in counts}:
+        for status in ("queued", "running", "failed"):
+            metrics.job_queue_depth.set(
+                counts.get((kind, status), 0), kind=kind, status=status
+            )
+
+
+# ----------------------------
+# Workers
+# ----------------------------
+
+def _kind_filter(kinds):
+    """
+    SQL condition (and params) selecting the kinds one pool serves:
+    `kinds`, or everything without a dedicated pool when None.
+    """
+    if kinds:
+        return f"kind IN ({','.join('?' * len(kinds))})", tuple(kinds)
+    if POOLS:
+        return f"kind NOT IN ({','.join('?' * len(POOLS))})", tuple(POOLS)
+    return "1=1", ()
+
+
+def _claim(kinds=None):
+    """
+    Picks the next queued job. The conditional UPDATE makes the claim
+    safe across threads and processes sharing the DB.
+    """
+    cond, params = _kind_filter(kinds)
+
+    while True:
+        row = query(
+            f"""
+            SELECT id, kind, key, payload, attempts
+            FROM jobs
+            WHERE status = 'queued' AND {cond}
+              AND (run_after IS NULL OR run_after <= CURRENT_TIMESTAMP)
+            ORDER BY priority DESC, id ASC
+            LIMIT 1
+            """,
+            params,
+            one=True
+        )
+        if not row:
+            return None
+
+        with transaction() as db:
+            cur = db.execute(
+                """
+                UPDATE jobs
+                SET status = 'running',
+                    attempts = attempts + 1,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'queued'
+                """,
+                (row["id"],)
+            )
+
+        if cur.rowcount:
+            return row
+
+
+def _finish(job, status, error=None):
+    execute(
+        """
+        UPDATE jobs
+        SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        """,
+        (status, error, job["id"])
+    )
+
+    with _inflight_lock:
+        _inflight.pop((job["kind"], job["key"]), None)
+        if status == "failed" and job["attempts"] + 1 >= JOB_MAX_ATTEMPTS:
+            _gave_up[(job["kind"], job["key"])] = time.monotonic()
+
+
+def _retry_later(job, delay):
+    execute(
+        """
+        UPDATE jobs
+        SET status = 'queued',
+            attempts = attempts - 1,
+            run_after = datetime('now', ?),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        """,
+        (f"+{int(delay)} seconds", job["id"])
+    )
+
+
+def _run(job):
+    fn = HANDLERS.get(job["kind"])
+    if fn is None:
+        _finish(job, "failed", f"no handler for {job['kind']!r}")
+        return
+
+    started = time.perf_counter()
+    try:
+        fn(json.loads(job["payload"] or "{}"))
+    except Retry as e:
+        _retry_later(job, e.delay)  # still pending: keeps its _inflight entry
+        result = "retry"
+    except Exception as e:
+        print(f"[JOBS] {job['kind']} {job['key']} failed: {e}")
+        _finish(job, "failed", traceback.format_exc(limit=3))
+        result = "failed"
+    else:
+        _finish(job, "done")
+        result = "done"
+    metrics.job_seconds.observe(
+        time.perf_counter() - started, kind=job["kind"], result=result
+    )
+
+
+def _idle():
+    for fn in IDLE_HOOKS:
+        try:
+            fn()
+        except Exception as e:
+            print(f"[JOBS] idle hook {fn.__name__} failed: {e}")
+
+
+def _worker(app, kinds=None):
+    with app.app_context():
+        while not _stop.is_set():
+            job = _claim(kinds)
+            if job is None:
+                _idle()
+                _wake.wait(POLL_INTERVAL)
+                _wake.clear()
+                continue
+            _run(job)
+
+
+def start_workers(app, workers=JOB_WORKERS):
+    """
+    Re-queues jobs interrupted by a restart and starts the shared pool
+    plus one pool per dedicated kind.
+    """
+    with app.app_context():
+        execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+
+    pools = [(None, workers, "job-worker")] + [
+        ((kind,), n, f"{kind}-worker") for kind, n in POOLS.items()
+    ]
+    for kinds, n, name in pools:
+        for i in range(n):
+            t = threading.Thread(
+                target=_worker, args=(app, kinds), name=f"{name}-{i}", daemon=True
+            )
+            t.start()
+            _threads.append(t)
+
+
+def stop_workers(timeout=5.0):
+    _stop.set()
+    _wake.set()
+    for t in _threads:
+        t.join(timeout)
+    _threads.clear()
@@ -1,7 +1,10 @@
 from pathlib import Path
 
-from models.base import query, get_db
-from services.thumbnails import ensure_thumb
+from config import MEDIA_DIR, PAGE_SIZE
+from models.base import query
+from services import cache, federation, search
+from services.thumbnails import ensure_thumb, thumb_srcsets
+from services.watch import pending_progress, get_watch_progress
 
 VIDEO_EXTS = {".mp4", ".webm", ".ogg", ".mkv", ".avi"}
 
@@ -43,54 +46,137 @@ def get_episodes(parent_id):
 # Media listing (Home / Browse)
 # ----------------------------
 
-def list_media(user_id=None, q=None, category=None):
+def parse_cursor(cursor):
+    """
+    Cursors are "<id>" when browsing and "<score>:<id>" for ranked
+    search results. Raises ValueError on anything else.
+    """
+    if not cursor:
+        return None
+    if ":" in cursor:
+        score, last_id = cursor.split(":", 1)
+        return float(score), int(last_id)
+    return None, int(cursor)
+
+
+def list_media(user_id=None, q=None, category=None, cursor=None, limit=PAGE_SIZE):
+    """
+    One page of the catalog, newest first (or best match first when
+    searching), seeking past `cursor` instead of using OFFSET.
+    Returns (items, next_cursor); next_cursor is None on the last page.
+
+    Pages are shared by all users and cached until the catalog version
+    moves; the user's progress is overlaid on a copy.
+    """
+    key = (q or None, category or None, cursor or None, limit)
+    version = cache.catalog_version()
+
+    hit = cache.catalog_pages.get(key)
+    if hit and hit[0] == version:
+        _version, items, next_cursor = hit
+    else:
+        items, next_cursor = _catalog_page(q, category, cursor, limit)
+        cache.catalog_pages.put(key, (version, items, next_cursor))
+
+    return _with_progress(user_id, items), next_cursor
+
+
+def _catalog_page(q, category, cursor, limit):
+    after = parse_cursor(cursor)
+
+    expr = None
+    if q and search.FTS_ENABLED:
+        expr = search.match_expression(q, category)
+
+    if q and search.FTS_ENABLED and not expr:
+        return [], None
+
     sql = """
         SELECT
             m.id,
             m.title,
             m.filepath,
-            m.category,
-            w.progress
+            m.category
+    """
+    params = []
+
+    if expr:
+        # ranked full-text search
+        sql += f"""
+            , s.score
+        FROM ({search.RANKED_MATCHES}) s
+        JOIN media m ON m.id = s.id
+        WHERE 1=1
+        """
+        params.append(expr)
+
+        if after:
+            score, last_id = after
+            sql += " AND (s.score > ? OR (s.score = ? AND m.id < ?))"
+            params += [score, score, last_id]
+    else:
+        sql += """
         FROM media m
-        LEFT JOIN watch_history w
-            ON w.media_id = m.id
-            AND w.user_id = ?
         WHERE 1=1
-    """
-    params = [user_id]
+        """
+
+        if q:
+            sql += " AND m.title LIKE ?"
+            params.append(f"%{q}%")
 
-    if q:
-        sql += " AND m.title LIKE ?"
-        params.append(f"%{q}%")
+        if after:
+            sql += " AND m.id < ?"
+            params.append(after[1])
 
     if category:
+        # served by idx_media_category_id
         sql += " AND m.category = ?"
         params.append(category)
 
-    sql += " ORDER BY m.id DESC"
+    if expr:
+        sql += " ORDER BY s.score, m.id DESC"
+    else:
+        sql += " ORDER BY m.id DESC"
+
+    sql += " LIMIT ?"
+    params.append(limit + 1)
 
     rows = query(sql, tuple(params))
-    return [_decorate_media(r) for r in rows]
 
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = f"{last['score']!r}:{last['id']}" if expr else str(last["id"])
+
+    return [_decorate_media(r) for r in rows], next_cursor
 
-def get_media_by_id(media_id):
-    return query(
+
+def get_media_by_id(media_id, user_id=None):
+    row = query(
         """
         SELECT
             m.id,
             m.title,
             m.filepath,
             m.category,
-            w.progress
+            w.progress,
+            w.position
         FROM media m
         LEFT JOIN watch_history w
             ON w.media_id = m.id
+            AND w.user_id = ?
         WHERE m.id = ?
         """,
-        (media_id,),
+        (user_id, media_id),
         one=True
     )
 
+    if not row:
+        return None
+
+    return _overlay_progress(user_id, [_decorate_media(row)])[0]
+
 
 # ----------------------------
 # Auto‑play next video
@@ -117,6 +203,54 @@ def get_next_media(current_id):
     return _decorate_media(row) if row else None
 
 
+# ----------------------------
+# Per-user progress
+# ----------------------------
+
+def _progress_for(user_id):
+    """
+    All of a user's progress (stored + buffered), cached until the
+    user's version moves.
+    """
+    version = cache.user_version(user_id)
+
+    hit = cache.user_progress.get(user_id)
+    if hit and hit[0] == version:
+        return hit[1]
+
+    progress = get_watch_progress(user_id)
+    cache.user_progress.put(user_id, (version, progress))
+    return progress
+
+
+def _with_progress(user_id, items):
+    """
+    Copies of shared catalog items with this user's progress filled in.
+    """
+    progress = _progress_for(user_id) if user_id is not None else {}
+
+    out = []
+    for item in items:
+        pct, position = progress.get(item["id"], (None, None))
+        out.append(dict(item, progress=pct or 0, position=position))
+    return out
+
+
+def _overlay_progress(user_id, items):
+    """
+    Applies progress still sitting in the write buffer.
+    """
+    if user_id is None:
+        return items
+
+    pending = pending_progress(user_id)
+    if pending:
+        for item in items:
+            if item["id"] in pending:
+                item["progress"], item["position"] = pending[item["id"]]
+    return items
+
+
 # ----------------------------
 # Media decorator (CRITICAL)
 # ----------------------------
@@ -132,9 +266,14 @@ def _decorate_media(r):
 
     is_vid = is_video(filepath)
 
-    # Thumbnail handling
-    if is_vid:
-        thumb_url = ensure_thumb(Path(filepath), media_id)
+    # Thumbnail handling: `thumbs` holds srcsets per format once the
+    # sized variants exist
+    thumbs = None
+    if federation.is_remote(filepath):
+        thumb_url = federation.thumb_url(media_id)
+    elif is_vid:
+        thumb_url = ensure_thumb(MEDIA_DIR / filepath, media_id)
+        thumbs = thumb_srcsets(media_id)
     else:
         thumb_url = "/static/thumbs/file.png"
 
@@ -146,6 +285,8 @@ def _decorate_media(r):
         "filepath": filepath,
         "category": r["category"] if "category" in keys else None,
         "progress": r["progress"] if "progress" in keys and r["progress"] is not None else 0,
+        "position": r["position"] if "position" in keys else None,
         "is_video": is_vid,
         "thumb": thumb_url,
+        "thumbs": thumbs,
     }
@@ -0,0 +1,349 @@
+# services/media_cache.py
+
+import hashlib
+import math
+import mmap
+import os
+import threading
+import time
+
+from config import (
+    MEDIA_DIR,
+    MEDIA_CACHE_DIR,
+    MEDIA_CACHE_BYTES,
+    MEDIA_CACHE_POLICY,
+    MEDIA_CACHE_BLOCK,
+    MEDIA_CACHE_ADMIT_HITS,
+    MEDIA_CACHE_FILL_HITS,
+    MEDIA_CACHE_HIT_WINDOW,
+)
+from models.base import query, transaction
+from services import jobs
+
+# Seconds between access records for one file in one process; the
+# range requests of a single play arrive every few seconds
+RECORD_INTERVAL = 30.0
+# Entries kept open per process
+OPEN_ENTRIES = 64
+# Evict down to this share of MEDIA_CACHE_BYTES, so a full cache does
+# not evict on every fill
+EVICT_TO = 0.9
+
+jobs.dedicated_pool("media_cache", 1)  # one sequential NAS reader
+
+_lock = threading.Lock()
+_entries = {}           # key -> Entry, most recently used last
+_seen = {}              # filepath -> (monotonic time recorded, hits, (size, mtime_ns))
+_filled_since_evict = 0
+
+
+def enabled():
+    return MEDIA_CACHE_DIR is not None
+
+
+def _key(filepath, size, mtime_ns):
+    """
+    Names the cached copy of one version of a file: a rewritten
+    source (new size or mtime) never matches its old copy.
+    """
+    name = hashlib.blake2b(filepath.encode(), digest_size=8).hexdigest()
+    return f"{name}-{size:x}-{mtime_ns:x}"
+
+
+# ----------------------------
+# Entries
+# ----------------------------
+
+class Entry:
+    """
+    The cached copy of one file: a sparse data file plus a map with one
+    byte per MEDIA_CACHE_BLOCK, set once the block is written. The map
+    is a shared mapping, so every worker sees blocks as they land.
+    """
+
+    def __init__(self, key, size):
+        self.key = key
+        self.size = size
+        self.blocks = max(1, math.ceil(size / MEDIA_CACHE_BLOCK))
+        self.data_path = MEDIA_CACHE_DIR / f"{key}.data"
+        self.map_path = MEDIA_CACHE_DIR / f"{key}.map"
+        self.users = 0          # open CachedFiles and fills; guarded by _lock
+        self.dropped = False
+
+        MEDIA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0o644)
+        map_fd = os.open(self.map_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(self.fd).st_size != size:
+                os.ftruncate(self.fd, size)  # sparse until filled
+            if os.fstat(map_fd).st_size != self.blocks:
+                os.ftruncate(map_fd, self.blocks)
+            self.map = mmap.mmap(map_fd, self.blocks)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        finally:
+            os.close(map_fd)
+
+    def has(self, block):
+        return self.map[block] == 1
+
+    def complete(self):
+        return self.map.find(b"\0") == -1
+
+    def fill(self, block, data):
+        # data first: a reader that sees the flag must see the bytes
+        os.pwrite(self.fd, data, block * MEDIA_CACHE_BLOCK)
+        self.map[block] = 1
+
+    def stale(self):
+        return not self.data_path.exists()  # evicted by another process
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def _acquire(key, size):
+    """
+    The entry for `key`, opened or created, held until _release().
+    """
+    with _lock:
+        entry = _entries.pop(key, None)
+        if entry is not None and entry.stale():
+            entry.dropped = True
+            if not entry.users:
+                entry.close()
+            entry = None
+        if entry is None:
+            entry = Entry(key, size)
+        _entries[key] = entry
+        entry.users += 1
+
+        idle = [k for k, e in _entries.items() if not e.users]
+        for old in idle[:max(0, len(_entries) - OPEN_ENTRIES)]:
+            _entries.pop(old).close()
+        return entry
+
+
+def _release(entry):
+    with _lock:
+        entry.users -= 1
+        if not entry.users and entry.dropped:
+            entry.close()
+
+
+def _drop_entry(key):
+    with _lock:
+        entry = _entries.pop(key, None)
+        if entry is not None:
+            entry.dropped = True
+            if not entry.users:
+                entry.close()
+    for suffix in (".data", ".map"):
+        (MEDIA_CACHE_DIR / f"{key}{suffix}").unlink(missing_ok=True)
+
+
+# ----------------------------
+# Reads
+# ----------------------------
+
+class CachedFile:
+    """
+    Reads of one response. Blocks in the cache come from local disk;
+    a missing block is fetched whole from the source, kept, and served
+    from memory, so a fill in progress only ever helps.
+    """
+
+    def __init__(self, entry, source):
+        self.entry = entry
+        self.source = source
+        self._source_fd = None
+
+    @property
+    def complete(self):
+        return self.entry.complete()
+
+    def pread(self, n, pos):
+        """
+        Up to `n` bytes at `pos`, never crossing a block boundary.
+        """
+        global _filled_since_evict
+        entry = self.entry
+        block = pos // MEDIA_CACHE_BLOCK
+        block_start = block * MEDIA_CACHE_BLOCK
+        n = min(n, block_start + MEDIA_CACHE_BLOCK - pos)
+
+        if entry.has(block):
+            return os.pread(entry.fd, n, pos)
+
+        if self._source_fd is None:
+            self._source_fd = os.open(self.source, os.O_RDONLY)
+        want = min(MEDIA_CACHE_BLOCK, entry.size - block_start)
+        data = os.pread(self._source_fd, want, block_start)
+        if len(data) == want:
+            entry.fill(block, data)
+            _filled_since_evict += want
+            if _filled_since_evict > MEDIA_CACHE_BYTES * (1 - EVICT_TO):
+                _filled_since_evict = 0
+                jobs.enqueue("media_cache_evict", "all", priority=1)
+        return data[pos - block_start:pos - block_start + n]
+
+    def close(self):
+        if self._source_fd is not None:
+            os.close(self._source_fd)
+            self._source_fd = None
+        if self.entry is not None:
+            _release(self.entry)
+            self.entry = None
+
+
+def _record_access(filepath, size, mtime_ns):
+    """
+    Counts plays: accesses more than MEDIA_CACHE_HIT_WINDOW apart. A new
+    size or mtime starts the count over. Returns the hit count.
+    """
+    now = time.time()
+    with transaction() as db:
+        db.execute(
+            """
+            INSERT INTO media_cache (filepath, size, mtime_ns, hits, last_access)
+            VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT(filepath) DO UPDATE SET
+                hits = CASE
+                    WHEN size != excluded.size OR mtime_ns != excluded.mtime_ns THEN 1
+                    WHEN last_access < excluded.last_access - ? THEN hits + 1
+                    ELSE hits
+                END,
+                size = excluded.size,
+                mtime_ns = excluded.mtime_ns,
+                last_access = excluded.last_access
+            """,
+            (filepath, size, mtime_ns, now, MEDIA_CACHE_HIT_WINDOW)
+        )
+        row = db.execute(
+            "SELECT hits FROM media_cache WHERE filepath = ?", (filepath,)
+        ).fetchone()
+    return row["hits"]
+
+
+def lookup(path, size, mtime_ns):
+    """
+    A CachedFile to read `path` (a file under MEDIA_DIR) through, or
+    None when the tier is off or the file is not hot yet. The caller
+    must close() it. Queues a full copy once the file is hot enough.
+    """
+    if not enabled() or not size:
+        return None
+    try:
+        filepath = path.relative_to(MEDIA_DIR).as_posix()
+    except ValueError:
+        return None
+
+    now = time.monotonic()
+    seen = _seen.get(filepath)
+    if seen and now - seen[0] < RECORD_INTERVAL and seen[2] == (size, mtime_ns):
+        hits = seen[1]
+    else:
+        hits = _record_access(filepath, size, mtime_ns)
+        _seen[filepath] = (now, hits, (size, mtime_ns))
+
+    if hits < MEDIA_CACHE_ADMIT_HITS:
+        return None
+
+    key = _key(filepath, size, mtime_ns)
+    entry = _acquire(key, size)
+    if hits >= MEDIA_CACHE_FILL_HITS and not entry.complete():
+        jobs.enqueue("media_cache", key, {"filepath": filepath}, priority=-1)
+    return CachedFile(entry, path)
+
+
+# ----------------------------
+# Jobs
+# ----------------------------
+
+@jobs.handler("media_cache")
+def fill_job(payload):
+    """
+    Job handler: copies the missing blocks of a hot file, in order.
+    Gives up if the source changes underneath.
+    """
+    source = MEDIA_DIR / payload["filepath"]
+    try:
+        st = os.stat(source)
+    except FileNotFoundError:
+        return
+
+    key = _key(payload["filepath"], st.st_size, st.st_mtime_ns)
+    entry = _acquire(key, st.st_size)
+    started = time.monotonic()
+    copied = 0
+
+    try:
+        with open(source, "rb", buffering=0) as f:
+            for block in range(entry.blocks):
+                if entry.has(block):
+                    continue
+                data = os.pread(f.fileno(), MEDIA_CACHE_BLOCK, block * MEDIA_CACHE_BLOCK)
+                if not data:
+                    break
+                entry.fill(block, data)
+                copied += len(data)
+    finally:
+        _release(entry)
+
+    after = os.stat(source)
+    if (after.st_size, after.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+        _drop_entry(key)
+        return
+
+    elapsed = time.monotonic() - started
+    print(f"[MEDIA CACHE] {payload['filepath']}: copied {copied >> 20} MiB in {elapsed:.1f}s")
+    evict()
+
+
+@jobs.handler("media_cache_evict")
+def evict_job(payload):
+    evict()
+
+
+def evict():
+    """
+    Removes whole entries until the cache is back under EVICT_TO of
+    MEDIA_CACHE_BYTES: copies of old file versions first, then by
+    MEDIA_CACHE_POLICY (least recently or least often played).
+    """
+    if not enabled() or not MEDIA_CACHE_DIR.exists():
+        return
+
+    usage = {}
+    for entry in os.scandir(MEDIA_CACHE_DIR):
+        key, ext = os.path.splitext(entry.name)
+        if ext in (".data", ".map"):
+            # allocated blocks, not the sparse length
+            usage[key] = usage.get(key, 0) + entry.stat().st_blocks * 512
+
+    total = sum(usage.values())
+    if total <= MEDIA_CACHE_BYTES:
+        return
+
+    rank = {}
+    for row in query("SELECT filepath, size, mtime_ns, hits, last_access FROM media_cache"):
+        key = _key(row["filepath"], row["size"], row["mtime_ns"])
+        if MEDIA_CACHE_POLICY == "lfu":
+            rank[key] = (row["hits"], row["last_access"])
+        else:
+            rank[key] = (row["last_access"], row["hits"])
+
+    orphan = (-math.inf, -math.inf)
+    victims = sorted(usage, key=lambda key: rank.get(key, orphan))
+    target = MEDIA_CACHE_BYTES * EVICT_TO
+    freed = 0
+    for key in victims:
+        if total - freed <= target:
+            break
+        _drop_entry(key)
+        freed += usage[key]
+
+    print(f"[MEDIA CACHE] Evicted {freed >> 20} MiB ({MEDIA_CACHE_POLICY})")
+
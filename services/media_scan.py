@@ -1,40 +1,384 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
-from config import MEDIA_DIR, ALLOWED_EXT, VIDEO_EXT
-from models.base import query, execute
-from services.thumbnails import ensure_thumb
 
-def scan_media():
+from config import (
+    MEDIA_DIR, ALLOWED_EXT, VIDEO_EXT, SCAN_WORKERS, SCAN_BATCH, HLS_PREPACKAGE,
+    MEDIA_DIR_MARKER, SCAN_MAX_REMOVE_FRACTION, SCAN_MAX_REMOVE_MIN, FINGERPRINT_FULL,
+)
+from models.base import query, transaction
+from services.thumbnails import enqueue_thumb, drop_thumbs
+from services.trickplay import enqueue_trickplay
+from services.hls import enqueue_hls
+from services.transcode import needs_transcode, enqueue_transcode, drop_variants
+from services.probe import enqueue_probe
+from services.cache import bump_catalog
+from services.fingerprint import (
+    fingerprint_many, full_hash, refresh_aliases, canonical_id, enqueue_backfill,
+)
+
+
+# ----------------------------
+# Directory walk
+# ----------------------------
+
+def _scan_dir(rel_dir):
+    """
+    Lists one directory. Returns ({relpath: (size, mtime_ns, inode)},
+    [sub directories]).
+    """
+    files = {}
+    subdirs = []
+
+    try:
+        with os.scandir(MEDIA_DIR / rel_dir) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+
+                rel = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(rel)
+                    continue
+
+                if os.path.splitext(entry.name)[1].lower() not in ALLOWED_EXT:
+                    continue
+
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # vanished mid-scan
+
+                files[rel] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+
+    return files, subdirs
+
+
+def walk_library(scopes=(("", True),)):
+    """
+    Walks MEDIA_DIR with one os.scandir() per directory, spread over
+    SCAN_WORKERS threads. `scopes` is a list of (sub directory,
+    recursive) pairs.
+    """
+    found = {}
+
+    with ThreadPoolExecutor(SCAN_WORKERS) as pool:
+        pending = {
+            pool.submit(_scan_dir, root): recursive
+            for root, recursive in scopes
+        }
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                recursive = pending.pop(fut)
+                files, subdirs = fut.result()
+                found.update(files)
+                if recursive:
+                    for d in subdirs:
+                        pending[pool.submit(_scan_dir, d)] = True
+
+    return found
+
+
+# ----------------------------
+# Helpers
+# ----------------------------
+
+def _title_for(filepath):
+    return Path(filepath).stem.replace("_", " ").title()
+
+
+def _in_scope(filepath, scopes):
+    for root, recursive in scopes:
+        if not recursive:
+            if os.path.dirname(filepath) == root:
+                return True
+        elif not root or filepath == root or filepath.startswith(root + os.sep):
+            return True
+    return False
+
+
+def _batches(items, size=SCAN_BATCH):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _removal_allowed(missing, indexed):
+    """
+    False when `missing` of `indexed` files vanishing looks like the
+    library is not there (unmounted share, empty root, no marker file)
+    rather than files having been deleted.
+    """
+    if MEDIA_DIR_MARKER and not (MEDIA_DIR / MEDIA_DIR_MARKER).exists():
+        reason = f"{MEDIA_DIR_MARKER} is missing"
+    elif not MEDIA_DIR.is_dir() or not any(MEDIA_DIR.iterdir()):
+        reason = "MEDIA_DIR is empty"
+    elif missing > SCAN_MAX_REMOVE_MIN and missing > indexed * SCAN_MAX_REMOVE_FRACTION:
+        reason = f"{missing} of {indexed} indexed files would go"
+    else:
+        return True
+    print(f"[SCAN] Not removing {missing} missing files: {reason}")
+    return False
+
+
+# ----------------------------
+# Scan
+# ----------------------------
+
+# Job kinds keyed by media id, dropped with the item
+MEDIA_JOBS = ("probe", "thumbnail", "trickplay", "transcode", "hls")
+
+
+def scan_media(roots=None, recursive=True):
+    """
+    Syncs the whole library, or only `roots` (sub directories of
+    MEDIA_DIR; `recursive=False` for just their direct children).
+    """
+    roots = [str(r).strip(os.sep) for r in roots] if roots else [""]
+    return sync_library([(root, recursive) for root in roots])
+
+
+def sync_library(scopes):
+    """
+    Incrementally syncs the `media` table with the library.
+
+    Files are compared against the (filepath, size, mtime, inode)
+    index in `media_files`; only differences touch the DB. A file
+    that disappears from one path and shows up at another with the
+    same inode and size, or failing that the same content fingerprint
+    and whole-file hash (copied across filesystems, rewritten by
+    rsync), is treated as a move, keeping its media id (and with it
+    watch history and thumbnails). New and changed files are
+    fingerprinted so that duplicates share derived artifacts.
+
+    `scopes` is a list of (sub directory, recursive) pairs; files
+    outside them are left alone. Returns a dict of counts.
+    """
     MEDIA_DIR.mkdir(exist_ok=True)
 
-    existing = query("SELECT filepath FROM media")
-    existing_files = {row["filepath"] for row in existing}
+    found = walk_library(scopes)
+
+    index, outside, outside_full = {}, {}, {}
+    for row in query(
+        """
+        SELECT filepath, media_id, size, mtime_ns, inode, fingerprint, full_hash
+        FROM media_files
+        """
+    ):
+        if _in_scope(row["filepath"], scopes):
+            index[row["filepath"]] = row
+        else:
+            outside[(row["inode"], row["size"])] = row
+            if row["fingerprint"] and row["full_hash"]:
+                outside_full[row["full_hash"]] = row
+    legacy = {
+        row["filepath"]: row["id"]
+        for row in query(
+            """
+            SELECT m.id, m.filepath
+            FROM media m
+            LEFT JOIN media_files f ON f.media_id = m.id
+            WHERE f.media_id IS NULL AND m.origin IS NULL
+            """
+        )
+        if _in_scope(row["filepath"], scopes)
+    }
+
+    new, modified, adopted = {}, [], []
+    unchanged = 0
 
-    added = 0
+    for filepath, stat in found.items():
+        row = index.get(filepath)
+        if row is None:
+            if filepath in legacy:
+                adopted.append((filepath, legacy.pop(filepath), stat))
+            else:
+                new[filepath] = stat
+        elif (row["size"], row["mtime_ns"], row["inode"]) != stat:
+            modified.append((filepath, stat))
+        else:
+            unchanged += 1
 
-    for path in MEDIA_DIR.rglob("*"):
-        if not path.is_file():
+    missing = {fp: row for fp, row in index.items() if fp not in found}
+
+    # Moves: same inode + size at a new path. The old path may also be
+    # outside the scanned scopes, as long as it no longer exists.
+    by_inode = {(row["inode"], row["size"]): fp for fp, row in missing.items()}
+    moved, kept_fps, kept_full = [], {}, {}
+    for filepath, stat in list(new.items()):
+        key = (stat[2], stat[0])
+        old = by_inode.pop(key, None)
+        row = missing.pop(old) if old is not None else outside.pop(key, None)
+
+        if row is not None and (old is not None or not (MEDIA_DIR / row["filepath"]).exists()):
+            moved.append((row["filepath"], filepath, row["media_id"], stat))
+            kept_fps[filepath] = row["fingerprint"]
+            kept_full[filepath] = row["full_hash"]
+            del new[filepath]
+
+    # Everything else new or changed gets (re)fingerprinted
+    fps = fingerprint_many(
+        list(new) + [fp for fp, _stat in modified] + [fp for fp, *_rest in adopted]
+    )
+    fps.update(kept_fps)
+
+    # Moves the inode missed: same content at a new path. The sampled
+    # fingerprint only picks the files worth reading whole (two encodes
+    # can share their samples); a media id moves only when the whole
+    # file hashes the same as one that went away.
+    by_full = {
+        row["full_hash"]: fp
+        for fp, row in missing.items()
+        if row["fingerprint"] and row["full_hash"]
+    }
+    sampled = {missing[fp]["fingerprint"] for fp in by_full.values()}
+    sampled.update(row["fingerprint"] for row in outside_full.values())
+    wholes = fingerprint_many([fp for fp in new if fps.get(fp) in sampled], full_hash)
+
+    moved_ids = {media_id for _old, _new, media_id, _stat in moved}
+    for filepath, whole in wholes.items():
+        if not whole:
             continue
 
-        ext = path.suffix.lower()
-        if ext not in ALLOWED_EXT:
+        old = by_full.pop(whole, None)
+        if old is not None:
+            moved.append((old, filepath, missing.pop(old)["media_id"], new.pop(filepath)))
+            kept_full[filepath] = whole
             continue
 
-        filepath = str(path.relative_to(MEDIA_DIR))
+        row = outside_full.pop(whole, None)
+        if (
+            row is not None
+            and row["media_id"] not in moved_ids
+            and not (MEDIA_DIR / row["filepath"]).exists()
+        ):
+            moved.append((row["filepath"], filepath, row["media_id"], new.pop(filepath)))
+            kept_full[filepath] = whole
 
-        if filepath in existing_files:
-            continue
+    for batch in _batches(moved):
+        with transaction() as db:
+            for old, filepath, media_id, (size, mtime_ns, inode) in batch:
+                db.execute("DELETE FROM media_files WHERE filepath = ?", (old,))
+                db.execute(
+                    "UPDATE media SET filepath = ? WHERE id = ?",
+                    (filepath, media_id)
+                )
+                db.execute(
+                    """
+                    INSERT OR REPLACE INTO media_files
+                        (filepath, media_id, size, mtime_ns, inode, fingerprint, full_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (filepath, media_id, size, mtime_ns, inode, fps.get(filepath),
+                     kept_full.get(filepath))
+                )
 
-        title = path.stem.replace("_", " ").title()
+    for batch in _batches(modified + adopted):
+        with transaction() as db:
+            db.executemany(
+                """
+                INSERT INTO media_files
+                    (filepath, media_id, size, mtime_ns, inode, fingerprint)
+                VALUES (?, (SELECT id FROM media WHERE filepath = ?), ?, ?, ?, ?)
+                ON CONFLICT(filepath) DO UPDATE SET
+                    size = excluded.size,
+                    mtime_ns = excluded.mtime_ns,
+                    inode = excluded.inode,
+                    fingerprint = excluded.fingerprint,
+                    full_hash = NULL
+                """,
+                [
+                    (fp, fp, size, mtime_ns, inode, fps.get(fp))
+                    for fp, *_rest, (size, mtime_ns, inode) in batch
+                ]
+            )
 
-        # Generate thumbnail for videos
-        if ext in VIDEO_EXT:
-            ensure_thumb(path, None)
+    added = []
+    for batch in _batches(sorted(new.items())):
+        with transaction() as db:
+            for filepath, (size, mtime_ns, inode) in batch:
+                media_id = db.execute(
+                    "INSERT INTO media (title, filepath) VALUES (?, ?)",
+                    (_title_for(filepath), filepath)
+                ).lastrowid
+                db.execute(
+                    """
+                    INSERT INTO media_files
+                        (filepath, media_id, size, mtime_ns, inode, fingerprint)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (filepath, media_id, size, mtime_ns, inode, fps.get(filepath))
+                )
+                added.append((media_id, filepath))
 
-        execute(
-            "INSERT INTO media (title, filepath) VALUES (?, ?)",
-            [title, filepath]
-        )
+    # Gone: indexed files that vanished, unless the whole library seems
+    # to have. Legacy rows were never indexed, so a missing file is no
+    # evidence against them: they are kept.
+    gone = [row["media_id"] for row in missing.values()]
+    if gone and not _removal_allowed(len(gone), len(index) + len(outside)):
+        gone = []
+    thumbs = []
+    for batch in _batches(gone):
+        ids = [(media_id,) for media_id in batch]
+        with transaction() as db:
+            for media_id in batch:
+                thumbs += [
+                    row["name"] for row in db.execute(
+                        "SELECT name FROM thumbnails WHERE media_id = ?", (media_id,)
+                    )
+                ]
+            for table in (
+                "media_files", "media_probe", "media_streams", "thumbnails", "watch_history"
+            ):
+                db.executemany(f"DELETE FROM {table} WHERE media_id = ?", ids)
+            db.executemany(
+                f"DELETE FROM jobs WHERE key = ? AND kind IN ({','.join('?' * len(MEDIA_JOBS))})",
+                [(str(media_id), *MEDIA_JOBS) for media_id in batch]
+            )
+            db.executemany("DELETE FROM media WHERE id = ?", ids)
+
+    drop_variants(gone)
+    drop_thumbs(gone, thumbs)
+
+    if added or gone or moved:
+        bump_catalog()
+    if added or gone or modified or adopted:
+        refresh_aliases()
+    if FINGERPRINT_FULL and (added or modified or adopted):
+        enqueue_backfill()  # whole-file hashes, so a later move is recognised
 
-        added += 1
+    # Metadata, thumbnails, playable variants (and optionally HLS) are
+    # produced by the job workers; duplicates share the original's
+    for media_id, filepath in added:
+        if canonical_id(media_id) != media_id:
+            continue
+        enqueue_probe(media_id)
+        if Path(filepath).suffix.lower() in VIDEO_EXT:
+            enqueue_thumb(MEDIA_DIR / filepath, media_id)
+            enqueue_trickplay(media_id)
+            if needs_transcode(filepath):
+                enqueue_transcode(media_id)
+            if HLS_PREPACKAGE:
+                enqueue_hls(media_id, priority=-1)
+
+    # a rewritten source makes its metadata and variant stale
+    for filepath, _stat in modified:
+        row = query("SELECT id FROM media WHERE filepath = ?", (filepath,), one=True)
+        if not row:
+            continue
+        enqueue_probe(row["id"])
+        if needs_transcode(filepath):
+            enqueue_transcode(row["id"])
 
-    print(f"[MEDIA SCAN] Added {added} new items")
+    return {
+        "added": len(added),
+        "removed": len(gone),
+        "moved": len(moved),
+        "modified": len(modified),
+        "unchanged": unchanged + len(adopted),
+    }
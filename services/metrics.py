@@ -0,0 +1,367 @@
+# services/metrics.py
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from config import (
+    SLOW_QUERY_MS,
+    SLOW_QUERY_KEEP,
+    METRICS_STATE_DIR,
+    METRICS_PUBLISH_INTERVAL,
+)
+from services.cache import shared_setting, set_shared_setting
+
+# Seconds; request and query latencies cluster in the low milliseconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds; ffmpeg runs take anywhere from a frame grab to a full encode
+FFMPEG_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+_registry = []
+_collectors = []
+_publisher = None
+
+
+# ----------------------------
+# Metric types
+# ----------------------------
+
+def _labels_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for n, v in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), shared=True):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        # False for values a collector sets at scrape time: every
+        # process would report the same number
+        self.shared = shared
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def merge(self, values, other):
+        for key, value in other:
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values):
+        lines = self._header()
+        for key, value in values.items():
+            lines.append(f"{self.name}{_labels_text(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    def values(self):
+        with self._lock:
+            return {k: [list(v[0]), v[1], v[2]] for k, v in self._values.items()}
+
+    def merge(self, values, other):
+        for key, (counts, count, total) in other:
+            if len(counts) != len(self.buckets):
+                continue  # published by a different version of the app
+            entry = values.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += count
+            entry[2] += total
+
+    def render(self, values):
+        lines = self._header()
+        for key, (counts, count, total) in values.items():
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                le = _labels_text(self.labels + ("le",), key + (repr(float(bound)),))
+                lines.append(f"{self.name}_bucket{le} {running}")
+            le = _labels_text(self.labels + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{le} {count}")
+            labels = _labels_text(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+@contextmanager
+def timed(histogram, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+def collector(fn):
+    """
+    Registers fn() to run at scrape time (e.g. to set gauges from the
+    DB). Used as a decorator.
+    """
+    _collectors.append(fn)
+    return fn
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format, summed over
+    this process and the ones that published lately.
+    """
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception as e:
+            print(f"[METRICS] collector {fn.__name__} failed: {e}")
+
+    published = _read_published()
+    lines = []
+    for metric in _registry:
+        values = metric.values()
+        if metric.shared:
+            for state in published:
+                other = state["metrics"].get(metric.name, ())
+                metric.merge(values, [(tuple(key), value) for key, value in other])
+        lines += metric.render(values)
+    return "\n".join(lines) + "\n"
+
+
+# ----------------------------
+# Other processes
+# ----------------------------
+
+def _state_file(pid):
+    return METRICS_STATE_DIR / f"{pid}.json"
+
+
+def publish():
+    """
+    Writes this process's values and slow-query log where the others
+    read them.
+    """
+    state = {
+        "at": time.time(),
+        "metrics": {
+            metric.name: [[list(key), value] for key, value in metric.values().items()]
+            for metric in _registry if metric.shared
+        },
+        "slow": _local_slow_log(),
+    }
+    path = _state_file(os.getpid())
+    METRICS_STATE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state))
+    os.replace(tmp, path)
+
+
+def _read_published():
+    """
+    States published by live processes; stale files are removed.
+    """
+    states = []
+    now = time.time()
+    try:
+        entries = list(os.scandir(METRICS_STATE_DIR))
+    except FileNotFoundError:
+        return states
+
+    for entry in entries:
+        if not entry.name.endswith(".json"):
+            continue
+        if entry.name == f"{os.getpid()}.json":
+            continue
+        try:
+            state = json.loads(open(entry.path).read())
+        except (OSError, ValueError):
+            continue
+        age = now - state["at"]
+        if age > 60:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+        elif age < 4 * METRICS_PUBLISH_INTERVAL:
+            states.append(state)
+    return states
+
+
+def _publish_loop():
+    while True:
+        time.sleep(METRICS_PUBLISH_INTERVAL)
+        try:
+            publish()
+        except Exception as e:
+            print(f"[METRICS] publish failed: {e}")
+
+
+def start_publishing():
+    """
+    Publishes every METRICS_PUBLISH_INTERVAL seconds; serve.py starts
+    this in each worker and the background process.
+    """
+    global _publisher
+    if _publisher is None or not _publisher.is_alive():
+        publish()
+        _publisher = threading.Thread(target=_publish_loop, name="metrics-publisher", daemon=True)
+        _publisher.start()
+
+
+# ----------------------------
+# Metrics
+# ----------------------------
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time to produce a response (streamed bodies excluded).",
+    ("route", "method", "status"),
+)
+streams_active = Gauge(
+    "media_streams_active", "Media responses currently being sent."
+)
+stream_bytes = Counter(
+    "media_bytes_served_total", "Bytes of media sent to clients."
+)
+stream_throttled_seconds = Counter(
+    "media_stream_throttled_seconds_total",
+    "Time media streams were paused by the bandwidth scheduler.",
+)
+remux_live = Gauge(
+    "media_remux_live", "ffmpeg processes feeding live remux streams."
+)
+remux_bytes = Counter(
+    "media_remux_bytes_total", "Bytes of live remux streams sent, by source.", ("source",)
+)
+db_seconds = Histogram(
+    "db_query_duration_seconds", "SQLite statement time.", ("op",)
+)
+slow_queries = Counter(
+    "db_slow_queries_total", "Statements slower than the slow-query threshold."
+)
+job_queue_depth = Gauge(
+    "job_queue_depth", "Background jobs by kind and status.", ("kind", "status"),
+    shared=False,
+)
+job_seconds = Histogram(
+    "job_duration_seconds", "Background job run time.", ("kind", "result"),
+    buckets=FFMPEG_BUCKETS,
+)
+ffmpeg_seconds = Histogram(
+    "ffmpeg_duration_seconds", "ffmpeg/ffprobe subprocess run time.", ("task",),
+    buckets=FFMPEG_BUCKETS,
+)
+
+
+# ----------------------------
+# Slow-query log
+# ----------------------------
+
+_slow_lock = threading.Lock()
+_slow_log = deque(maxlen=SLOW_QUERY_KEEP)
+
+
+def slow_query_threshold_ms():
+    return shared_setting("slow_query_ms") or None
+
+
+def set_slow_query_threshold(ms):
+    """
+    Turns the slow-query log on (ms > 0) or off (None / 0) in every
+    process.
+    """
+    set_shared_setting("slow_query_ms", ms if ms and ms > 0 else 0)
+
+
+set_slow_query_threshold(SLOW_QUERY_MS)
+
+
+def observe_query(op, sql, elapsed):
+    db_seconds.observe(elapsed, op=op)
+
+    threshold = shared_setting("slow_query_ms")
+    if not threshold or elapsed * 1000 < threshold:
+        return
+
+    slow_queries.inc()
+    statement = " ".join(sql.split())
+    with _slow_lock:
+        _slow_log.appendleft({
+            "at": time.time(),
+            "ms": elapsed * 1000,
+            "op": op,
+            "sql": statement,
+        })
+    print(f"[SLOW QUERY] {elapsed * 1000:.1f}ms {op}: {statement[:200]}")
+
+
+def _local_slow_log():
+    with _slow_lock:
+        return list(_slow_log)
+
+
+def slow_query_log():
+    """
+    Slow statements of every process, newest first.
+    """
+    entries = _local_slow_log()
+    for state in _read_published():
+        entries += state.get("slow", ())
+    entries.sort(key=lambda q: -q["at"])
+    return entries[:SLOW_QUERY_KEEP]
@@ -1,17 +1,88 @@
+import time
 from functools import wraps
 from flask import session, redirect, url_for, abort
+
+from config import USER_CACHE_TTL, USER_CACHE_SIZE
 from models.base import query
+from services.cache import LRUCache, account_version, bump_account
+
+# user_id -> (expires at, account version, user dict without the
+# password hash)
+_users = LRUCache(max_items=USER_CACHE_SIZE)
+
+
+# ----------------------------
+# User records
+# ----------------------------
+
+def get_user(user_id):
+    """
+    Cached user record (id, username, role, active), or None.
+    """
+    version = account_version(user_id)
+    hit = _users.get(user_id)
+    if hit and hit[0] > time.monotonic() and hit[1] == version:
+        return hit[2]
+
+    row = query(
+        "SELECT id, username, role, active FROM users WHERE id = ?",
+        (user_id,),
+        one=True
+    )
+    user = dict(row) if row else None
+    _users.put(user_id, (time.monotonic() + USER_CACHE_TTL, version, user))
+    return user
+
+
+def invalidate_user(user_id=None):
+    """
+    Drops one cached record (or all of them) after it changed, in
+    every worker: their cached copies no longer match the version.
+    """
+    bump_account(user_id)
+    if user_id is None:
+        _users.clear()
+    else:
+        _users.discard(user_id)
+
+
+def active_user(user_id):
+    """
+    The user if they still exist and are active, else None.
+    """
+    if not user_id:
+        return None
+    user = get_user(user_id)
+    return user if user and user["active"] else None
+
 
 def get_current_user():
+    """
+    The logged-in user if they still exist and are active. A revoked
+    session is cleared on the spot.
+    """
     user_id = session.get("user_id")
     if not user_id:
         return None
-    return query("SELECT * FROM users WHERE id = ?", (user_id,), one=True)
+
+    user = active_user(user_id)
+    if not user:
+        session.clear()
+        return None
+
+    if session.get("role") != user["role"]:
+        session["role"] = user["role"]  # keep the nav in step
+    return user
+
+
+# ----------------------------
+# Decorators
+# ----------------------------
 
 def login_required(view):
     @wraps(view)
     def wrapped(*args, **kwargs):
-        if "user_id" not in session:
+        if not get_current_user():
             return redirect(url_for("login_view"))
         return view(*args, **kwargs)
     return wrapped
@@ -0,0 +1,234 @@
+# services/probe.py
+
+import json
+import subprocess
+
+from config import MEDIA_DIR, PROBE_WORKERS
+from models.base import query, transaction
+from services import jobs, metrics
+from services.fingerprint import canonical_id
+
+# Columns copied from each ffprobe stream into media_streams
+STREAM_FIELDS = (
+    "codec_type", "codec_name", "profile", "width", "height",
+    "pix_fmt", "channels", "sample_rate", "bit_rate",
+)
+
+jobs.dedicated_pool("probe", PROBE_WORKERS)
+
+
+# ----------------------------
+# ffprobe
+# ----------------------------
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def probe_file(path):
+    """
+    Runs ffprobe and returns {"format": {...}, "streams": [...]} with
+    the fields we store, numbers already converted.
+    """
+    with metrics.timed(metrics.ffmpeg_seconds, task="ffprobe"):
+        out = subprocess.run(
+            [
+                "ffprobe", "-v", "error",
+                "-show_format", "-show_streams",
+                "-of", "json",
+                str(path),
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    info = json.loads(out.stdout or "{}")
+    fmt = info.get("format", {})
+
+    streams = []
+    for s in info.get("streams", []):
+        stream = {f: s.get(f) for f in STREAM_FIELDS}
+        stream["index"] = s.get("index", len(streams))
+        for f in ("width", "height", "channels", "sample_rate", "bit_rate"):
+            stream[f] = _int(stream[f])
+        stream["language"] = (s.get("tags") or {}).get("language")
+        streams.append(stream)
+
+    return {
+        "format": {
+            "format_name": fmt.get("format_name"),
+            "duration": _float(fmt.get("duration")),
+            "bit_rate": _int(fmt.get("bit_rate")),
+        },
+        "streams": streams,
+    }
+
+
+# ----------------------------
+# Storage
+# ----------------------------
+
+def _first(streams, codec_type):
+    return next((s for s in streams if s["codec_type"] == codec_type), None)
+
+
+def store_probe(media_id, st, info):
+    fmt, streams = info["format"], info["streams"]
+    video = _first(streams, "video") or {}
+    audio = _first(streams, "audio") or {}
+
+    with transaction() as db:
+        db.execute(
+            """
+            INSERT OR REPLACE INTO media_probe
+                (media_id, size, mtime_ns, format_name, duration, bit_rate,
+                 width, height, video_codec, audio_codec)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                media_id, st.st_size, st.st_mtime_ns,
+                fmt["format_name"], fmt["duration"], fmt["bit_rate"],
+                video.get("width"), video.get("height"),
+                video.get("codec_name"), audio.get("codec_name"),
+            )
+        )
+        db.execute("DELETE FROM media_streams WHERE media_id = ?", (media_id,))
+        db.executemany(
+            f"""
+            INSERT INTO media_streams
+                (media_id, idx, language, {", ".join(STREAM_FIELDS)})
+            VALUES (?, ?, ?, {", ".join("?" * len(STREAM_FIELDS))})
+            """,
+            [
+                (media_id, s["index"], s["language"], *(s[f] for f in STREAM_FIELDS))
+                for s in streams
+            ]
+        )
+
+
+def get_probe(media_id):
+    """
+    Stored metadata as {"format": ..., "streams": [...]}, or None if
+    the item was never probed.
+    """
+    media_id = canonical_id(media_id)
+    row = query("SELECT * FROM media_probe WHERE media_id = ?", (media_id,), one=True)
+    if not row:
+        return None
+
+    streams = query(
+        "SELECT * FROM media_streams WHERE media_id = ? ORDER BY idx",
+        (media_id,)
+    )
+    return {
+        "format": dict(row),
+        "streams": [dict(s, index=s["idx"]) for s in streams],
+    }
+
+
+def ensure_probe(media_id):
+    """
+    Probes the item unless the stored result was taken from a file of
+    the same size and mtime. Returns the metadata (None if the media
+    row is gone). Duplicates resolve to their canonical item.
+    """
+    media_id = canonical_id(media_id)
+    row = query(
+        """
+        SELECT m.filepath, p.size, p.mtime_ns
+        FROM media m
+        LEFT JOIN media_probe p ON p.media_id = m.id
+        WHERE m.id = ?
+        """,
+        (media_id,),
+        one=True
+    )
+    if not row:
+        return None
+
+    st = (MEDIA_DIR / row["filepath"]).stat()
+    if (row["size"], row["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+        store_probe(media_id, st, probe_file(MEDIA_DIR / row["filepath"]))
+
+    return get_probe(media_id)
+
+
+# ----------------------------
+# Request-time lookups (no file access)
+# ----------------------------
+
+def duration_of(media_id):
+    row = query(
+        "SELECT duration FROM media_probe WHERE media_id = ?",
+        (canonical_id(media_id),),
+        one=True
+    )
+    return row["duration"] if row else None
+
+
+def video_size(media_id):
+    """
+    (width, height) from stored metadata, None when not probed yet or
+    without a video stream.
+    """
+    row = query(
+        "SELECT width, height FROM media_probe WHERE media_id = ?",
+        (canonical_id(media_id),),
+        one=True
+    )
+    if not row or not row["width"] or not row["height"]:
+        return None
+    return row["width"], row["height"]
+
+
+def has_audio(media_id):
+    """
+    True/False from stored metadata, None when not probed yet.
+    """
+    row = query(
+        "SELECT audio_codec FROM media_probe WHERE media_id = ?",
+        (canonical_id(media_id),),
+        one=True
+    )
+    return None if not row else row["audio_codec"] is not None
+
+
+# ----------------------------
+# Jobs
+# ----------------------------
+
+def enqueue_probe(media_id, priority=0):
+    jobs.enqueue("probe", media_id, {"media_id": media_id}, priority=priority)
+
+
+@jobs.handler("probe")
+def probe_job(payload):
+    ensure_probe(payload["media_id"])
+
+
+def backfill_probes():
+    """
+    Queues every item that has no stored metadata (libraries scanned
+    before probing existed).
+    """
+    rows = query(
+        """
+        SELECT m.id FROM media m
+        LEFT JOIN media_probe p ON p.media_id = m.id
+        WHERE p.media_id IS NULL AND m.origin IS NULL
+        """
+    )
+    rows = [row for row in rows if canonical_id(row["id"]) == row["id"]]
+    for row in rows:
+        enqueue_probe(row["id"], priority=-1)
+    return len(rows)
@@ -0,0 +1,257 @@
+# services/profiler.py
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from config import PROFILE_INTERVAL, PROFILE_MAX_SECONDS, PROFILE_STATE_DIR
+from services.cache import BOOT_ID, shared_setting, set_shared_setting
+
+# Seconds between a process publishing its stacks, and between checks
+# for runs started or stopped in another process
+PUBLISH_INTERVAL = 1.0
+FOLLOW_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_stop = threading.Event()
+_thread = None
+_follower = None
+_stacks = Counter()
+_state = {"run": None, "started": None, "stopped": None, "samples": 0}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+# Leaf frames of threads parked waiting for work; they would drown
+# out the busy ones
+IDLE_FRAMES = {
+    "threading.py:wait",
+    "selectors.py:select",
+    "queue.py:get",
+    "socket.py:readinto",
+}
+
+
+def _sample(own_ident):
+    frames = sys._current_frames()
+    for ident, frame in frames.items():
+        if ident == own_ident:
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        if not stack or stack[0] in IDLE_FRAMES:
+            continue
+        stack.reverse()
+        with _lock:
+            _stacks[";".join(stack)] += 1
+            _state["samples"] += 1
+
+
+def _run(deadline):
+    own = threading.get_ident()
+    published = time.monotonic()
+    while not _stop.wait(PROFILE_INTERVAL):
+        _sample(own)
+        now = time.monotonic()
+        if now > deadline:
+            break
+        if now - published > PUBLISH_INTERVAL:
+            _publish()
+            published = now
+    with _lock:
+        _state["stopped"] = time.time()
+    _publish()
+    print(f"[PROFILER] Stopped after {_state['samples']} samples")
+
+
+# ----------------------------
+# Other processes
+# ----------------------------
+
+def _current_run():
+    # the counter restarts with the master image; BOOT_ID tells runs apart
+    return f"{BOOT_ID}-{int(shared_setting('profile_run'))}"
+
+
+def _state_file(pid):
+    return PROFILE_STATE_DIR / f"{pid}.json"
+
+
+def _publish():
+    with _lock:
+        state = {**_state, "stacks": dict(_stacks)}
+    try:
+        PROFILE_STATE_DIR.mkdir(parents=True, exist_ok=True)
+        path = _state_file(os.getpid())
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[PROFILER] publish failed: {e}")
+
+
+def _read_published():
+    """
+    This process's state plus what other processes published for the
+    current run.
+    """
+    run = _current_run()
+    with _lock:
+        states = [{**_state, "stacks": dict(_stacks)}] if _state["run"] == run else []
+    try:
+        entries = list(os.scandir(PROFILE_STATE_DIR))
+    except FileNotFoundError:
+        return states
+
+    for entry in entries:
+        if not entry.name.endswith(".json") or entry.name == f"{os.getpid()}.json":
+            continue
+        try:
+            state = json.loads(open(entry.path).read())
+        except (OSError, ValueError):
+            continue
+        if state["run"] == run:
+            states.append(state)
+    return states
+
+
+def _clear_published():
+    try:
+        entries = list(os.scandir(PROFILE_STATE_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def _follow():
+    while True:
+        time.sleep(FOLLOW_INTERVAL)
+        remaining = shared_setting("profile_until") - time.time()
+        try:
+            if remaining > 0 and _state["run"] != _current_run():
+                _start_local(remaining)
+            elif remaining <= 0 and is_running():
+                _stop_local()
+        except Exception as e:
+            print(f"[PROFILER] follow failed: {e}")
+
+
+def start_follower():
+    """
+    Samples this process whenever a run is started in another one;
+    serve.py starts this in each worker and the background process.
+    """
+    global _follower
+    if _follower is None or not _follower.is_alive():
+        _follower = threading.Thread(target=_follow, name="profiler-follower", daemon=True)
+        _follower.start()
+
+
+# ----------------------------
+# Control
+# ----------------------------
+
+def is_running():
+    return _thread is not None and _thread.is_alive()
+
+
+def _start_local(seconds):
+    global _thread
+    _stop_local()
+    with _lock:
+        _stacks.clear()
+        _state.update(run=_current_run(), started=time.time(), stopped=None, samples=0)
+
+    _stop.clear()
+    _thread = threading.Thread(
+        target=_run, args=(time.monotonic() + seconds,),
+        name="profiler", daemon=True
+    )
+    _thread.start()
+    print(f"[PROFILER] Sampling every {PROFILE_INTERVAL * 1000:.0f}ms for up to {seconds:.0f}s")
+
+
+def _stop_local():
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=2)
+
+
+def start(seconds=PROFILE_MAX_SECONDS):
+    """
+    Samples every thread's stack each PROFILE_INTERVAL seconds, in
+    every process, until stop() or `seconds` (capped at
+    PROFILE_MAX_SECONDS) have passed. Clears the previous profile.
+    """
+    if shared_setting("profile_until") > time.time():
+        return False
+
+    seconds = min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+    set_shared_setting("profile_run", shared_setting("profile_run") + 1)
+    set_shared_setting("profile_until", time.time() + seconds)
+    _clear_published()
+    _start_local(seconds)
+    return True
+
+
+def stop():
+    set_shared_setting("profile_until", 0)
+    _stop_local()
+
+
+# ----------------------------
+# Reports
+# ----------------------------
+
+def _merged(states=None):
+    stacks = Counter()
+    for state in states if states is not None else _read_published():
+        stacks.update(state["stacks"])
+    return stacks
+
+
+def status():
+    states = _read_published()
+    stopped = [s["stopped"] for s in states]
+    return {
+        "started": min((s["started"] for s in states), default=None),
+        "stopped": max(stopped) if stopped and None not in stopped else None,
+        "samples": sum(s["samples"] for s in states),
+        "running": shared_setting("profile_until") > time.time(),
+        "stacks": len(_merged(states)),
+    }
+
+
+def top_functions(limit=30):
+    """
+    [(function, self samples, total samples)], hottest first.
+    """
+    own, total = Counter(), Counter()
+    for stack, n in _merged().items():
+        frames = stack.split(";")
+        own[frames[-1]] += n
+        for frame in set(frames):
+            total[frame] += n
+
+    return [(fn, n, total[fn]) for fn, n in own.most_common(limit)]
+
+
+def collapsed():
+    """
+    The profile as "frame;frame;frame count" lines, the input format
+    of flamegraph.pl and speedscope.
+    """
+    items = sorted(_merged().items(), key=lambda kv: -kv[1])
+    return "".join(f"{stack} {n}\n" for stack, n in items)
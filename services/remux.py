@@ -0,0 +1,426 @@
+# services/remux.py
+
+import fcntl
+import hashlib
+import math
+import os
+import struct
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from config import (
+    STREAM_CHUNK_SIZE,
+    REMUX_ENABLED,
+    REMUX_DIR,
+    REMUX_CACHE_BYTES,
+    REMUX_MAX_LIVE,
+    REMUX_FRAGMENT_SECONDS,
+)
+from models.base import query
+from services import metrics
+from services.cache import LRUCache
+from services.probe import get_probe, duration_of
+from services.transcode import needs_transcode, plan
+
+# How often a reader checks a cache file another request is writing,
+# and how long it waits on one that stopped growing (its viewer paused)
+# before running ffmpeg for itself
+TAIL_POLL = 0.05
+TAIL_STALL = 5.0
+# Bytes of a restarted stream compared with the cached copy it resumes
+VERIFY_BYTES = 64 * 1024
+# Top-level boxes that end an init segment or a fragment: a cache file
+# cut after one of these is always valid
+FRAGMENT_END = {b"moov", b"mdat"}
+
+_keyframes = LRUCache(max_items=4096)   # (path, size, mtime, t) -> keyframe time
+_live_lock = threading.Lock()
+_live = 0
+
+
+def remux_method(filepath, media_id=None):
+    """
+    "remux" (both streams copied) or "audio" (video copied, audio to
+    AAC) when a live stream can be made without encoding video; None
+    when the container plays as is, the item is not probed yet, or the
+    video needs encoding.
+    """
+    if not REMUX_ENABLED or not needs_transcode(filepath):
+        return None
+    if media_id is None:
+        media_id = _media_id(filepath)
+        if media_id is None:
+            return None
+    info = get_probe(media_id)
+    if not info:
+        return None
+    method = plan(info)
+    return method if method in ("remux", "audio") else None
+
+
+def _media_id(filepath):
+    row = query("SELECT media_id FROM media_files WHERE filepath = ?", (filepath,), one=True)
+    return row["media_id"] if row else None
+
+
+def _reserve():
+    """
+    Takes one of the REMUX_MAX_LIVE ffmpeg slots; False when all are
+    in use.
+    """
+    global _live
+    with _live_lock:
+        if _live >= REMUX_MAX_LIVE:
+            return False
+        _live += 1
+    metrics.remux_live.inc()
+    return True
+
+
+def _release():
+    global _live
+    with _live_lock:
+        _live -= 1
+    metrics.remux_live.dec()
+
+
+# ----------------------------
+# Start points
+# ----------------------------
+
+def clamp_start(filepath, t):
+    """
+    `t` limited to the probed duration of `filepath` (as is when that
+    is unknown).
+    """
+    media_id = _media_id(filepath)
+    duration = duration_of(media_id) if media_id is not None else None
+    return min(t, duration) if duration else t
+
+
+def keyframe_before(path, st, t):
+    """
+    Time of the video keyframe at or before `t` seconds: where a
+    stream copy asked to start at `t` really starts. One ffprobe seek.
+    """
+    if t <= 0:
+        return 0.0
+
+    key = (str(path), st.st_size, st.st_mtime_ns, round(t, 1))
+    hit = _keyframes.get(key)
+    if hit is not None:
+        return hit
+
+    try:
+        with metrics.timed(metrics.ffmpeg_seconds, task="keyframe"):
+            out = subprocess.run(
+                [
+                    "ffprobe", "-v", "error",
+                    "-select_streams", "v:0",
+                    "-read_intervals", f"{t:.3f}%+#1",
+                    "-show_entries", "packet=pts_time",
+                    "-of", "csv=p=0",
+                    str(path),
+                ],
+                capture_output=True,
+                text=True,
+                timeout=10,
+            )
+    except subprocess.TimeoutExpired:
+        # slow storage: start at `t` as asked (not cached, try again next time)
+        print(f"[REMUX] {path}: keyframe lookup at {t:.1f}s timed out")
+        return t
+
+    try:
+        keyframe = float(out.stdout.split()[0].strip(","))
+    except (IndexError, ValueError):
+        keyframe = t  # no video stream: audio starts anywhere
+    # ms precision, rounded up so ffmpeg's own seek lands on the same frame
+    keyframe = min(t, max(0.0, math.ceil(keyframe * 1000) / 1000))
+
+    _keyframes.put(key, keyframe)
+    return keyframe
+
+
+def _ffmpeg_args(path, start, method):
+    args = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+    if start:
+        args += ["-ss", f"{start:.3f}"]
+    args += [
+        "-i", str(path),
+        "-map", "0:v:0?", "-map", "0:a:0?",
+        "-map_metadata", "-1",
+        "-c:v", "copy",
+    ]
+    if method == "remux":
+        args += ["-c:a", "copy"]
+    else:
+        args += ["-c:a", "aac", "-b:a", "160k", "-ac", "2", "-flags:a", "+bitexact"]
+    # byte-identical output on every run, so a cached prefix can be resumed
+    args += [
+        "-avoid_negative_ts", "make_zero",
+        "-fflags", "+bitexact",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+        "-frag_duration", str(int(REMUX_FRAGMENT_SECONDS * 1_000_000)),
+        "-f", "mp4", "pipe:1",
+    ]
+    return args
+
+
+# ----------------------------
+# Streams
+# ----------------------------
+
+def _valid_length(fd):
+    """
+    End of the last complete init segment or fragment in a cache file;
+    whatever an interrupted writer left after it is cut off.
+    """
+    size = os.fstat(fd).st_size
+    pos = safe = 0
+    while pos + 8 <= size:
+        header = os.pread(fd, 16, pos)
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        if box_size == 1 and len(header) == 16:
+            box_size = struct.unpack(">Q", header[8:])[0]
+        if box_size < 8 or pos + box_size > size:
+            break
+        pos += box_size
+        if box_type in FRAGMENT_END:
+            safe = pos
+    return safe
+
+
+def _source_key(filepath, st):
+    name = hashlib.blake2b(filepath.encode(), digest_size=8).hexdigest()
+    return f"{name}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+class _Ffmpeg:
+    """
+    One remux process, run in a slot its stream reserved. Reading its
+    stdout only as fast as the client takes the stream keeps buffering
+    down to the pipe.
+    """
+
+    def __init__(self, path, start, method):
+        self.proc = subprocess.Popen(
+            _ffmpeg_args(path, start, method),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def read(self):
+        return os.read(self.proc.stdout.fileno(), STREAM_CHUNK_SIZE)
+
+    def close(self, finished=False):
+        """
+        Stops ffmpeg, or waits for it once its output has `finished`;
+        True if it exited cleanly on its own.
+        """
+        proc = self.proc
+        if proc is None:
+            return False
+        self.proc = None
+        try:
+            clean = proc.wait(5 if finished else 0) == 0
+        except subprocess.TimeoutExpired:
+            clean = False
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        return clean
+
+
+class RemuxStream:
+    """
+    Body of one live remux response: fragmented MP4 from the keyframe
+    `start`, also written to a cache file per start point. Whoever
+    holds the file's lock runs ffmpeg; other requests for the same
+    start follow the file as it grows. A stream cut short is resumed
+    from its cached fragments by running ffmpeg again and skipping
+    the bytes already there (the output is bit-exact). A stream that
+    may run ffmpeg holds an ffmpeg slot until it is closed.
+    """
+
+    def __init__(self, path, filepath, st, start, method):
+        self.path = path
+        self.start = start
+        self.method = method
+        folder = REMUX_DIR / _source_key(filepath, st)
+        folder.mkdir(parents=True, exist_ok=True)
+        name = f"{round(start * 1000)}-{method}"
+        self.cache_path = folder / f"{name}.mp4"
+        self.done_path = folder / f"{name}.done"
+        self.fd = os.open(self.cache_path, os.O_RDWR | os.O_CREAT, 0o644)
+        os.utime(self.fd)  # last use, for eviction
+        self.sent = 0
+        self._ffmpeg = None
+        self._locked = False
+        self._slot = False
+
+    def __iter__(self):
+        stalled_since = None
+        while True:
+            if self._try_lock():
+                if not self.done_path.exists():
+                    os.ftruncate(self.fd, _valid_length(self.fd))
+                yield from self._from_cache()
+                if not self.done_path.exists():
+                    yield from self._from_ffmpeg(cache=True)
+                return
+
+            before = self.sent
+            yield from self._from_cache()
+            if self.done_path.exists():
+                yield from self._from_cache()
+                return
+            if self.sent > before:
+                stalled_since = None
+            elif stalled_since is None:
+                stalled_since = time.monotonic()
+            elif time.monotonic() - stalled_since > TAIL_STALL:
+                # the writer's viewer paused: stop waiting on them
+                yield from self._from_ffmpeg(cache=False)
+                return
+            time.sleep(TAIL_POLL)
+
+    def _try_lock(self):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self._locked = True
+        return True
+
+    def _from_cache(self):
+        while True:
+            data = os.pread(self.fd, STREAM_CHUNK_SIZE, self.sent)
+            if not data:
+                return
+            self.sent += len(data)
+            metrics.remux_bytes.inc(len(data), source="cache")
+            yield data
+
+    def _from_ffmpeg(self, cache):
+        """
+        Runs ffmpeg from `start`. Output the cache file already holds
+        is compared with it, the rest appended (when `cache`); only
+        bytes past `sent` go to the client.
+        """
+        if not self._slot:
+            # its cache file was complete when the stream opened
+            self._slot = _reserve()
+            if not self._slot:
+                print(f"[REMUX] {self.path}: too many live remux streams")
+                return
+        self._ffmpeg = _Ffmpeg(self.path, self.start, self.method)
+
+        cached = os.fstat(self.fd).st_size if cache else 0
+        checked = min(cached, VERIFY_BYTES)
+        pos = 0
+        while data := self._ffmpeg.read():
+            end = pos + len(data)
+            if pos < checked and os.pread(self.fd, min(end, checked) - pos, pos) != data[:checked - pos]:
+                print(f"[REMUX] {self.path}: output differs from its cache, discarding it")
+                self._discard()
+                return
+            if cache and end > cached:
+                os.pwrite(self.fd, data[max(0, cached - pos):], max(pos, cached))
+            if end > self.sent:
+                data = data[max(0, self.sent - pos):]
+                self.sent = end
+                metrics.remux_bytes.inc(len(data), source="ffmpeg")
+                yield data
+            pos = end
+
+        if self._ffmpeg.close(finished=True) and cache:
+            self.done_path.touch()
+            evict()
+        self._ffmpeg = None
+
+    def _discard(self):
+        self.cache_path.unlink(missing_ok=True)
+        self.done_path.unlink(missing_ok=True)
+        os.ftruncate(self.fd, 0)
+
+    def close(self):
+        try:
+            if self._ffmpeg is not None:
+                self._ffmpeg.close()
+                self._ffmpeg = None
+            if self._locked and not self.done_path.exists():
+                # keep whole fragments only, for the next viewer to resume
+                os.ftruncate(self.fd, _valid_length(self.fd))
+        finally:
+            os.close(self.fd)  # drops the lock
+            if self._slot:
+                self._slot = False
+                _release()
+
+
+def open_stream(path, filepath, st, start, method):
+    """
+    A RemuxStream, or None when it may have to run ffmpeg and all
+    REMUX_MAX_LIVE slots are taken. The slot is reserved here, before
+    the response starts, so a full server answers 503 rather than an
+    empty stream.
+    """
+    stream = RemuxStream(path, filepath, st, start, method)
+    if not stream.done_path.exists():
+        stream._slot = _reserve()
+        if not stream._slot:
+            stream.close()
+            return None
+    return stream
+
+
+# ----------------------------
+# Cache
+# ----------------------------
+
+def evict():
+    """
+    Deletes least recently used streams until the cache is under
+    REMUX_CACHE_BYTES; streams being written are skipped.
+    """
+    files = []
+    total = 0
+    for folder in os.scandir(REMUX_DIR) if REMUX_DIR.exists() else ():
+        if not folder.is_dir():
+            continue
+        for entry in os.scandir(folder.path):
+            if entry.name.endswith(".mp4"):
+                st = entry.stat()
+                total += st.st_blocks * 512
+                files.append((st.st_mtime, st.st_blocks * 512, entry.path))
+
+    if total <= REMUX_CACHE_BYTES:
+        return
+
+    freed = 0
+    for _mtime, size, path in sorted(files):
+        if total - freed <= REMUX_CACHE_BYTES:
+            break
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.unlink(path)
+        except BlockingIOError:
+            continue  # being written or read
+        finally:
+            os.close(fd)
+        Path(path).with_suffix(".done").unlink(missing_ok=True)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass  # other start points left
+        freed += size
+
+    print(f"[REMUX] Evicted {freed >> 20} MiB")
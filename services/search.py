@@ -0,0 +1,137 @@
+# services/search.py
+
+import re
+import sqlite3
+
+from models.base import query, execute, transaction
+
+# Diacritics folded ("cafe" finds "Café"); emoji are tokens rather than
+# separators so titles like "A Mood ✨" stay searchable by emoji too.
+TOKENIZER = "unicode61 remove_diacritics 2 categories 'L* N* Co M* So'"
+
+# bm25 weights: title, category, path. Every match is scored, so a
+# good match among thousands of weaker ones still comes first; callers
+# order by (score, id) and page with a keyset on both. Params: (match,)
+RANKED_MATCHES = """
+    SELECT rowid AS id, title, bm25(media_fts, 10.0, 2.0, 1.0) AS score
+    FROM media_fts
+    WHERE media_fts MATCH ?
+"""
+
+# media.filepath with separators turned into word breaks
+_PATH_WORDS = "replace(replace(replace({col}, '/', ' '), '_', ' '), '.', ' ')"
+
+FTS_ENABLED = False
+
+
+def init_search():
+    """
+    Creates the FTS5 index over media and the triggers that keep it in
+    sync with every insert/update/delete (scanner, upload, edits).
+    Falls back to LIKE search when SQLite lacks FTS5.
+    """
+    global FTS_ENABLED
+
+    try:
+        execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(
+            title, category, path,
+            tokenize = "{TOKENIZER}",
+            prefix = '2 3'
+        )
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"[SEARCH] FTS5 unavailable ({e}), using LIKE search")
+        FTS_ENABLED = False
+        return
+
+    new_path = _PATH_WORDS.format(col="new.filepath")
+
+    execute(f"""
+    CREATE TRIGGER IF NOT EXISTS media_fts_insert AFTER INSERT ON media
+    BEGIN
+        INSERT INTO media_fts (rowid, title, category, path)
+        VALUES (new.id, new.title, new.category, {new_path});
+    END
+    """)
+    execute(f"""
+    CREATE TRIGGER IF NOT EXISTS media_fts_update AFTER UPDATE ON media
+    BEGIN
+        DELETE FROM media_fts WHERE rowid = old.id;
+        INSERT INTO media_fts (rowid, title, category, path)
+        VALUES (new.id, new.title, new.category, {new_path});
+    END
+    """)
+    execute("""
+    CREATE TRIGGER IF NOT EXISTS media_fts_delete AFTER DELETE ON media
+    BEGIN
+        DELETE FROM media_fts WHERE rowid = old.id;
+    END
+    """)
+
+    FTS_ENABLED = True
+
+    indexed = query("SELECT COUNT(*) AS n FROM media_fts", one=True)["n"]
+    total = query("SELECT COUNT(*) AS n FROM media", one=True)["n"]
+    if indexed != total:
+        rebuild_search()
+
+
+def rebuild_search():
+    with transaction():
+        execute("DELETE FROM media_fts")
+        execute(f"""
+        INSERT INTO media_fts (rowid, title, category, path)
+        SELECT id, title, category, {_PATH_WORDS.format(col="filepath")}
+        FROM media
+        """)
+    print("[SEARCH] Rebuilt search index")
+
+
+def _phrase(text):
+    return '"' + text.replace('"', "") + '"'
+
+
+def match_expression(q, category=None):
+    """
+    Turns free text into an FTS5 query: every word must match as a
+    prefix, in any order ("car mo" -> "Cardi B A Mood"). Returns None
+    if nothing searchable is left.
+    """
+    words = [w.replace('"', "") for w in q.split()]
+    words = [w for w in words if re.search(r"\w|[^\x00-\x7f]", w)]
+    if not words:
+        return None
+
+    expr = " ".join(f"{_phrase(w)}*" for w in words)
+    if category:
+        # narrows the matches to score; callers still compare exactly
+        expr += f" AND category : {_phrase(category)}"
+    return expr
+
+
+def suggest(q, limit=8):
+    """
+    Autocomplete: best matching titles for a partial query.
+    """
+    if not FTS_ENABLED:
+        rows = query(
+            "SELECT id, title FROM media WHERE title LIKE ? ORDER BY id DESC LIMIT ?",
+            (f"%{q}%", limit)
+        )
+        return [{"id": r["id"], "title": r["title"]} for r in rows]
+
+    expr = match_expression(q)
+    if not expr:
+        return []
+
+    rows = query(
+        f"""
+        SELECT id, title
+        FROM ({RANKED_MATCHES})
+        ORDER BY score, id DESC
+        LIMIT ?
+        """,
+        (expr, limit)
+    )
+    return [{"id": r["id"], "title": r["title"]} for r in rows]
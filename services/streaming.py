@@ -0,0 +1,462 @@
+# services/streaming.py
+
+import mimetypes
+import mmap
+import os
+import time
+import urllib.error
+import urllib.request
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import NamedTuple
+
+from flask import Response, abort, request
+from werkzeug.security import safe_join
+
+from config import (
+    MEDIA_DIR,
+    STREAM_CHUNK_SIZE,
+    STREAM_MAX_RANGE,
+    STREAM_MAX_RANGES,
+)
+from services import bandwidth, media_cache, metrics, remux
+from services.permissions import get_current_user
+
+
+# Request headers passed on to a peer when proxying, and response
+# headers passed back
+PROXY_REQUEST_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+PROXY_RESPONSE_HEADERS = (
+    "Content-Type", "Content-Length", "Content-Range", "Accept-Ranges",
+    "ETag", "Last-Modified", "Cache-Control",
+)
+PROXY_TIMEOUT = 10.0
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+# ----------------------------
+# Helpers
+# ----------------------------
+
+def resolve_media_path(filename) -> Path:
+    """
+    Maps a /media/<path> URL onto MEDIA_DIR, refusing anything
+    that escapes the library.
+    """
+    joined = safe_join(str(MEDIA_DIR), filename)
+    if joined is None or not os.path.isfile(joined):
+        abort(404)
+    return Path(joined)
+
+
+def make_etag(st) -> str:
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """
+    Parses a `Range: bytes=...` header into a sorted list of
+    inclusive (start, end) tuples, merging overlaps.
+
+    Returns None when the header should be ignored (missing,
+    malformed, not bytes, too many ranges). Raises
+    RangeNotSatisfiable when no range overlaps the file.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+
+    specs = header[len("bytes="):].split(",")
+    if len(specs) > STREAM_MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        spec = spec.strip()
+        first, sep, last = spec.partition("-")
+        if not sep:
+            return None
+
+        try:
+            if not first:
+                # suffix range: last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                if last:
+                    end = min(int(last), size - 1)
+                else:
+                    end = min(start + STREAM_MAX_RANGE, size) - 1
+        except ValueError:
+            return None
+
+        if start < 0 or (last and first and int(last) < start):
+            return None
+        if start >= size:
+            continue
+
+        ranges.append((start, end))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        prev_start, prev_end = merged[-1]
+        if start <= prev_end + 1:
+            merged[-1] = (prev_start, max(prev_end, end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def _http_date(ts):
+    return formatdate(ts, usegmt=True)
+
+
+def _parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _not_modified(req_headers, etag, mtime):
+    inm = req_headers.get("If-None-Match")
+    if inm:
+        tags = [t.strip() for t in inm.split(",")]
+        weak = etag if etag.startswith("W/") else f"W/{etag}"
+        return "*" in tags or etag in tags or weak in tags
+
+    ims = _parse_http_date(req_headers.get("If-Modified-Since"))
+    return ims is not None and int(mtime) <= ims
+
+
+def _if_range_matches(req_headers, etag, mtime):
+    value = req_headers.get("If-Range")
+    if not value:
+        return True
+
+    if value.startswith('"') or value.startswith("W/"):
+        # strong comparison only
+        return value == etag
+
+    since = _parse_http_date(value)
+    return since is not None and int(mtime) == int(since)
+
+
+# ----------------------------
+# Bodies
+# ----------------------------
+
+def _can_sendfile(environ, start, length, size):
+    """
+    A server's wsgi.file_wrapper reads until EOF, so it is only safe
+    for ranges that run to the end of the file. Gunicorn bounds its
+    os.sendfile() loop by Content-Length, so any range works there.
+    """
+    if "wsgi.file_wrapper" not in environ:
+        return False
+    if start + length == size:
+        return True
+    return environ.get("SERVER_SOFTWARE", "").startswith("gunicorn")
+
+
+def _sendfile_body(environ, path, start, length):
+    f = open(path, "rb")
+    f.seek(start)
+    return environ["wsgi.file_wrapper"](_TrackedFile(f, length), STREAM_CHUNK_SIZE)
+
+
+def _mmap_body(path, parts):
+    """
+    Yields (prefix, start, end) parts as mmap slices, capped at
+    STREAM_CHUNK_SIZE per write.
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+
+            for prefix, start, end in parts:
+                if prefix:
+                    yield prefix
+                pos = start
+                while pos <= end:
+                    stop = min(pos + STREAM_CHUNK_SIZE, end + 1)
+                    yield mm[pos:stop]
+                    pos = stop
+        finally:
+            mm.close()
+
+
+class _CachedBody:
+    """
+    Like _mmap_body, reading through the local media cache; releases
+    the cache entry on close.
+    """
+
+    def __init__(self, cached, parts, trailer=b""):
+        self._cached = cached
+        self._parts = parts
+        self._trailer = trailer
+
+    def __iter__(self):
+        for prefix, start, end in self._parts:
+            if prefix:
+                yield prefix
+            pos = start
+            while pos <= end:
+                data = self._cached.pread(min(STREAM_CHUNK_SIZE, end - pos + 1), pos)
+                if not data:
+                    return  # truncated under us
+                yield data
+                pos += len(data)
+        if self._trailer:
+            yield self._trailer
+
+    def close(self):
+        self._cached.close()
+
+
+class _TrackedBody:
+    """
+    Response iterable counted as an active stream until the server
+    closes it; bytes are counted as they are yielded, paced by the
+    bandwidth scheduler.
+    """
+
+    def __init__(self, body, stream):
+        self._body = body
+        self._stream = stream
+        self._open = True
+        metrics.streams_active.inc()
+
+    def __iter__(self):
+        for chunk in self._body:
+            delay = self._stream.consume(len(chunk))
+            if delay:
+                time.sleep(delay)
+            metrics.stream_bytes.inc(len(chunk))
+            yield chunk
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self._stream.close()
+            metrics.streams_active.dec()
+        if hasattr(self._body, "close"):
+            self._body.close()
+
+
+class _TrackedFile:
+    """
+    File handed to wsgi.file_wrapper (which must stay the response
+    itself for sendfile to kick in); counts `length` bytes once the
+    server closes it.
+    """
+
+    def __init__(self, f, length):
+        self._f = f
+        self._length = length
+        self._open = True
+        metrics.streams_active.inc()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def close(self):
+        if self._open:
+            self._open = False
+            metrics.streams_active.dec()
+            metrics.stream_bytes.inc(self._length)
+        self._f.close()
+
+
+# ----------------------------
+# Response
+# ----------------------------
+
+class FilePlan(NamedTuple):
+    """
+    What to answer for a file of `size` bytes: status and headers,
+    then `parts` as (prefix, start, end) byte ranges followed by
+    `trailer` (empty unless multipart). No parts means no body.
+    """
+    status: int
+    headers: dict
+    parts: list
+    size: int = 0
+    trailer: bytes = b""
+    mtime_ns: int = 0
+
+
+def plan_file(path: Path, req_headers) -> FilePlan:
+    """
+    Applies conditional GET, If-Range and Range to a file. Shared by
+    the WSGI view below and the ASGI server; `req_headers` is any
+    case-insensitive mapping.
+    """
+    st = os.stat(path)
+    size = st.st_size
+    etag = make_etag(st)
+    mimetype = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": _http_date(st.st_mtime),
+        "Cache-Control": "private, no-cache",
+    }
+
+    if _not_modified(req_headers, etag, st.st_mtime):
+        return FilePlan(304, headers, [])
+
+    ranges = None
+    if size and _if_range_matches(req_headers, etag, st.st_mtime):
+        try:
+            ranges = parse_range(req_headers.get("Range"), size)
+        except RangeNotSatisfiable:
+            headers["Content-Range"] = f"bytes */{size}"
+            return FilePlan(416, headers, [])
+
+    headers["Content-Type"] = mimetype
+
+    # ---- full body ----
+    if ranges is None:
+        headers["Content-Length"] = str(size)
+        parts = [(b"", 0, size - 1)] if size else []
+        return FilePlan(200, headers, parts, size, mtime_ns=st.st_mtime_ns)
+
+    # ---- single range ----
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return FilePlan(206, headers, [(b"", start, end)], size, mtime_ns=st.st_mtime_ns)
+
+    # ---- multiple ranges ----
+    boundary = uuid.uuid4().hex
+    parts = []
+    total = 0
+    for start, end in ranges:
+        prefix = (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode()
+        parts.append((prefix, start, end))
+        total += len(prefix) + end - start + 1
+
+    closing = f"\r\n--{boundary}--\r\n".encode()
+    total += len(closing)
+
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["Content-Length"] = str(total)
+    return FilePlan(206, headers, parts, size, closing, st.st_mtime_ns)
+
+
+def stream_file(path: Path, user=None) -> Response:
+    """
+    Serves a file with Range, If-Range and conditional GET support.
+    `user` defaults to the logged-in user.
+    """
+    plan = plan_file(path, request.headers)
+    parts = plan.parts
+
+    # HEAD responses are never iterated or closed; don't open the file
+    if not parts or request.method == "HEAD":
+        return Response((), plan.status, plan.headers, direct_passthrough=True)
+
+    environ = request.environ
+    user = user or get_current_user()
+
+    # hot files on a slow MEDIA_DIR are read through the local cache
+    cached = media_cache.lookup(path, plan.size, plan.mtime_ns)
+    if cached is not None:
+        body = _CachedBody(cached, parts, plan.trailer)
+        stream = bandwidth.open_stream(user, request.path)
+        return Response(_TrackedBody(body, stream), plan.status, plan.headers,
+                        direct_passthrough=True)
+
+    if len(parts) == 1:
+        _prefix, start, end = parts[0]
+        if not bandwidth.paced(user) and _can_sendfile(environ, start, end - start + 1, plan.size):
+            body = _sendfile_body(environ, path, start, end - start + 1)
+        else:
+            body = _TrackedBody(
+                _mmap_body(path, parts), bandwidth.open_stream(user, request.path)
+            )
+        return Response(body, plan.status, plan.headers, direct_passthrough=True)
+
+    def body():
+        yield from _mmap_body(path, parts)
+        yield plan.trailer
+
+    stream = bandwidth.open_stream(user, request.path)
+    return Response(_TrackedBody(body(), stream), plan.status, plan.headers,
+                    direct_passthrough=True)
+
+
+def stream_remux(path: Path, filepath, method, t, user=None) -> Response:
+    """
+    Serves a live fragmented MP4 remux of `path` from the keyframe at or
+    before `t` seconds, named in X-Remux-Start. Not seekable: players
+    ask for a new start point instead.
+    """
+    st = os.stat(path)
+    start = remux.keyframe_before(path, st, remux.clamp_start(filepath, t))
+    headers = {
+        "Content-Type": "video/mp4",
+        "Accept-Ranges": "none",
+        "Cache-Control": "private, no-store",
+        "X-Remux-Start": f"{start:.3f}",
+    }
+    if request.method == "HEAD":
+        return Response((), 200, headers, direct_passthrough=True)
+
+    body = remux.open_stream(path, filepath, st, start, method)
+    if body is None:
+        abort(503)
+    stream = bandwidth.open_stream(user or get_current_user(), request.path)
+    return Response(_TrackedBody(body, stream), 200, headers, direct_passthrough=True)
+
+
+def proxy_stream(url, user) -> Response:
+    """
+    Relays this request to a peer (federation proxy mode): ranges and
+    validators go through, and the body is paced like a local one.
+    """
+    headers = {k: request.headers[k] for k in PROXY_REQUEST_HEADERS if k in request.headers}
+    req = urllib.request.Request(url, headers=headers, method=request.method)
+    try:
+        upstream = urllib.request.urlopen(req, timeout=PROXY_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        upstream = e  # 304, 416 and 404 are answers too
+    except OSError:
+        abort(502)
+
+    out = {k: upstream.headers[k] for k in PROXY_RESPONSE_HEADERS if k in upstream.headers}
+    if request.method == "HEAD" or upstream.status in (304, 416):
+        upstream.close()
+        return Response((), upstream.status, out, direct_passthrough=True)
+
+    def body():
+        try:
+            while chunk := upstream.read(STREAM_CHUNK_SIZE):
+                yield chunk
+        finally:
+            upstream.close()
+
+    stream = bandwidth.open_stream(user, request.path)
+    return Response(_TrackedBody(body(), stream), upstream.status, out,
+                    direct_passthrough=True)
@@ -1,34 +1,250 @@
 # services/thumbnails.py
 
 from pathlib import Path
+import hashlib
+import os
 import subprocess
+import threading
+import time
+
+from config import THUMB_WIDTHS, THUMB_FORMATS, THUMB_WIDTH
+from models.base import query, transaction
+from services import jobs, metrics
+from services.cache import bump_catalog, catalog_version
+from services.fingerprint import canonical_id
+
+THUMB_DIR = Path("static/thumbs/videos")    # one full-size frame per video
+VARIANT_DIR = Path("static/thumbs/sized")   # <content hash>.<format>
+PLACEHOLDER_URL = "/static/thumbs/placeholder.svg"
+
+ENCODER_ARGS = {
+    "webp": ["-c:v", "libwebp", "-quality", "75"],
+    "jpg": ["-q:v", "4"],
+}
+
+# media_id -> {format: [(width, name), ...]}, smallest first
+_manifest = {}
+_manifest_version = None
+_manifest_lock = threading.Lock()
+
+# Thumbnails finished since the catalog version last moved. Every bump
+# invalidates all cached pages, so a backfill bumps once per drained
+# queue or BUMP_INTERVAL seconds rather than once per thumbnail.
+BUMP_INTERVAL = 5.0
+_unpublished = 0
+_bumped_at = 0.0
+_bump_lock = threading.Lock()
+
+
+def variant_url(name) -> str:
+    return f"/thumbs/{name}"
+
+
+# ----------------------------
+# Manifest
+# ----------------------------
+
+def _variants(media_id):
+    """
+    Generated variants of a canonical item. The whole table is held in
+    memory and reloaded when the catalog version moves (finished
+    thumbnails bump it, see _publish), so card rendering never touches
+    the disk.
+    """
+    global _manifest, _manifest_version
+
+    version = catalog_version()
+    if _manifest_version != version:
+        manifest = {}
+        for row in query("SELECT media_id, width, format, name FROM thumbnails ORDER BY width"):
+            formats = manifest.setdefault(row["media_id"], {})
+            formats.setdefault(row["format"], []).append((row["width"], row["name"]))
+        with _manifest_lock:
+            _manifest, _manifest_version = manifest, version
+    return _manifest.get(media_id)
+
+
+def _fallback(variants):
+    """
+    The variant given as `src`: THUMB_WIDTH (or the next size up) in
+    JPEG, which every browser decodes.
+    """
+    sizes = variants.get("jpg") or next(iter(variants.values()))
+    return next((name for width, name in sizes if width >= THUMB_WIDTH), sizes[-1][1])
 
-THUMB_DIR = Path("static/thumbs/videos")
 
 def ensure_thumb(video_path: Path, media_id: int) -> str:
     """
-    Generate a thumbnail for a video if it doesn't exist.
-    Returns the public URL.
+    Returns the thumbnail URL if it exists, otherwise queues
+    generation and returns the placeholder. Duplicates share the
+    thumbnail of their canonical item.
     """
-    THUMB_DIR.mkdir(parents=True, exist_ok=True)
+    media_id = canonical_id(media_id)
+    variants = _variants(media_id)
+
+    if variants:
+        return variant_url(_fallback(variants))
+
+    enqueue_thumb(video_path, media_id)
+    return PLACEHOLDER_URL
+
+
+def thumb_srcsets(media_id):
+    """
+    {format: srcset} of a video's thumbnail for <picture>, or None
+    until it is generated.
+    """
+    variants = _variants(canonical_id(media_id))
+    if not variants:
+        return None
+    return {
+        fmt: ", ".join(f"{variant_url(name)} {width}w" for width, name in sizes)
+        for fmt, sizes in variants.items()
+    }
+
+
+def drop_thumbs(media_ids, names):
+    """
+    Deletes the frames of removed media and those of their variant
+    `names` no other item uses (identical thumbnails share a file).
+    Their rows are gone already.
+    """
+    for media_id in media_ids:
+        (THUMB_DIR / f"{media_id}.jpg").unlink(missing_ok=True)
+    for name in set(names):
+        if not query("SELECT 1 FROM thumbnails WHERE name = ? LIMIT 1", (name,), one=True):
+            (VARIANT_DIR / name).unlink(missing_ok=True)
 
-    thumb_file = THUMB_DIR / f"{media_id}.jpg"
-
-    if thumb_file.exists():
-        return f"/static/thumbs/videos/{media_id}.jpg"
-
-    subprocess.run(
-        [
-            "ffmpeg",
-            "-y",
-            "-ss", "00:00:05",
-            "-i", str(video_path),
-            "-frames:v", "1",
-            "-q:v", "2",
-            str(thumb_file),
-        ],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
+
+# ----------------------------
+# Generation
+# ----------------------------
+
+def enqueue_thumb(video_path: Path, media_id: int, priority=0):
+    jobs.enqueue(
+        "thumbnail",
+        media_id,
+        {"path": str(video_path), "media_id": media_id},
+        priority=priority,
+    )
+
+
+def _grab_frame(video_path, frame_file, tmp_file):
+    """
+    Grabs one full-size frame with ffmpeg. Writes to a temp name first
+    so a half-written JPEG is never used.
+    """
+    # clips shorter than the seek point produce no frame; retry at 0
+    for offset in ("00:00:05", "00:00:00"):
+        with metrics.timed(metrics.ffmpeg_seconds, task="thumbnail"):
+            subprocess.run(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-ss", offset,
+                    "-i", video_path,
+                    "-frames:v", "1",
+                    "-q:v", "2",
+                    str(tmp_file),
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+        if tmp_file.exists() and tmp_file.stat().st_size:
+            os.replace(tmp_file, frame_file)
+            return
+
+    raise RuntimeError(f"ffmpeg produced no frame for {video_path}")
+
+
+def _encode(frame_file, fmt, prefix):
+    """
+    [(width, name)] of `frame_file` scaled to every THUMB_WIDTHS in one
+    ffmpeg run. Files are named by content hash, so identical
+    thumbnails (and re-runs) end up as one file.
+    """
+    outputs = [VARIANT_DIR / f"{prefix}-{width}.tmp.{fmt}" for width in THUMB_WIDTHS]
+    graph = f"[0:v]split={len(THUMB_WIDTHS)}" + "".join(
+        f"[s{i}]" for i in range(len(THUMB_WIDTHS))
+    ) + "".join(
+        f";[s{i}]scale={width}:-2[o{i}]" for i, width in enumerate(THUMB_WIDTHS)
     )
+    args = ["ffmpeg", "-y", "-i", str(frame_file), "-filter_complex", graph]
+    for i, out in enumerate(outputs):
+        args += ["-map", f"[o{i}]", "-frames:v", "1", *ENCODER_ARGS[fmt], str(out)]
+
+    try:
+        with metrics.timed(metrics.ffmpeg_seconds, task="thumbnail"):
+            subprocess.run(
+                args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+            )
+
+        variants = []
+        for width, out in zip(THUMB_WIDTHS, outputs):
+            name = f"{hashlib.blake2b(out.read_bytes(), digest_size=10).hexdigest()}.{fmt}"
+            os.replace(out, VARIANT_DIR / name)
+            variants.append((width, name))
+        return variants
+    finally:
+        for out in outputs:
+            out.unlink(missing_ok=True)
 
-    return f"/static/thumbs/videos/{media_id}.jpg"
+
+@jobs.handler("thumbnail")
+def generate_thumb(payload):
+    """
+    Job handler: grabs one frame (kept, so new sizes never need the
+    video again) and encodes it in every THUMB_WIDTHS and
+    THUMB_FORMATS. A format this ffmpeg cannot encode is skipped.
+    """
+    THUMB_DIR.mkdir(parents=True, exist_ok=True)
+    VARIANT_DIR.mkdir(parents=True, exist_ok=True)
+
+    media_id = payload["media_id"]
+    if query("SELECT 1 FROM thumbnails WHERE media_id = ? LIMIT 1", (media_id,), one=True):
+        return
+
+    frame_file = THUMB_DIR / f"{media_id}.jpg"
+    tmp_file = THUMB_DIR / f"{media_id}.tmp.jpg"
+    try:
+        if not frame_file.exists():
+            _grab_frame(payload["path"], frame_file, tmp_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+    rows = []
+    for fmt in THUMB_FORMATS:
+        try:
+            rows += [(media_id, width, fmt, name) for width, name in _encode(frame_file, fmt, media_id)]
+        except subprocess.CalledProcessError:
+            print(f"[THUMBS] ffmpeg could not encode {fmt} thumbnails for {media_id}")
+    if not rows:
+        raise RuntimeError(f"no thumbnail variants for {payload['path']}")
+
+    with transaction() as db:
+        db.executemany(
+            "INSERT OR REPLACE INTO thumbnails (media_id, width, format, name) VALUES (?, ?, ?, ?)",
+            rows
+        )
+
+    global _unpublished
+    with _bump_lock:
+        _unpublished += 1
+    _publish(drained=False)
+
+
+@jobs.on_idle
+def _publish(drained=True):
+    """
+    Bumps the catalog version (cached pages still show placeholders)
+    if thumbnails finished since the last bump and the queue drained
+    or BUMP_INTERVAL passed.
+    """
+    global _unpublished, _bumped_at
+    now = time.monotonic()
+    with _bump_lock:
+        if not _unpublished or (not drained and now - _bumped_at < BUMP_INTERVAL):
+            return
+        _unpublished, _bumped_at = 0, now
+    bump_catalog()
@@ -0,0 +1,265 @@
+# services/transcode.py
+
+import os
+import subprocess
+import time
+from pathlib import Path
+
+from config import (
+    MEDIA_DIR,
+    TRANSCODE_EXT,
+    TRANSCODE_WORKERS,
+    TRANSCODE_THREADS,
+    TRANSCODE_CRF,
+)
+from models.base import query, execute
+from services import jobs, metrics
+from services.probe import ensure_probe
+from services.fingerprint import canonical_id
+
+# Codecs every mainstream browser decodes inside MP4
+VIDEO_COPY = {"h264"}
+AUDIO_COPY = {"aac", "mp3"}
+
+# Queue order: watched right now > freshly uploaded > library backfill
+PRIORITY_LIBRARY = 0
+PRIORITY_UPLOAD = 10
+PRIORITY_REQUESTED = 20
+
+jobs.dedicated_pool("transcode", TRANSCODE_WORKERS)
+
+
+# ----------------------------
+# Variants
+# ----------------------------
+
+def needs_transcode(filepath) -> bool:
+    return Path(filepath).suffix.lower() in TRANSCODE_EXT
+
+
+def variant_path(filepath) -> str:
+    """
+    "show/ep1.mkv" -> "show/.ep1.mkv.mp4": next to the original, hidden
+    so the scanner and watcher never list it as media of its own.
+    """
+    p = Path(filepath)
+    return str(p.with_name(f".{p.name}.mp4"))
+
+
+def playable_path(media_id, filepath):
+    """
+    What the player should be given for a media item. Returns
+    (filepath, preparing); while no variant exists the original is
+    returned and the job is moved to the front of the queue.
+    """
+    if not needs_transcode(filepath):
+        return filepath, False
+
+    media_id = canonical_id(media_id)  # duplicates share one variant
+    row = query(
+        "SELECT filepath FROM media_variants WHERE media_id = ?",
+        (media_id,),
+        one=True
+    )
+    if row and (MEDIA_DIR / row["filepath"]).exists():
+        return row["filepath"], False
+
+    enqueue_transcode(media_id, PRIORITY_REQUESTED)
+    return filepath, True
+
+
+def drop_variants(media_ids):
+    """
+    Deletes the variants of removed media.
+    """
+    for media_id in media_ids:
+        row = query(
+            "SELECT filepath FROM media_variants WHERE media_id = ?",
+            (media_id,),
+            one=True
+        )
+        if not row:
+            continue
+        (MEDIA_DIR / row["filepath"]).unlink(missing_ok=True)
+        execute("DELETE FROM media_variants WHERE media_id = ?", (media_id,))
+
+
+def enqueue_transcode(media_id, priority=PRIORITY_LIBRARY):
+    media_id = canonical_id(media_id)
+    jobs.enqueue("transcode", media_id, {"media_id": media_id}, priority=priority)
+
+
+# ----------------------------
+# Plan
+# ----------------------------
+
+def plan(info):
+    """
+    "remux" when both streams can be copied into MP4, "audio" when only
+    the audio needs re-encoding (AC3/DTS soundtracks), else "transcode".
+    """
+    streams = info.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+
+    video_ok = video is None or (
+        video.get("codec_name") in VIDEO_COPY
+        and video.get("pix_fmt") in (None, "yuv420p", "yuvj420p")
+    )
+    audio_ok = audio is None or audio.get("codec_name") in AUDIO_COPY
+
+    if video_ok and audio_ok:
+        return "remux"
+    if video_ok:
+        return "audio"
+    return "transcode"
+
+
+def _ffmpeg_args(src, dst, method):
+    args = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-i", str(src),
+        "-map", "0:v:0?", "-map", "0:a:0?",
+        "-threads", str(TRANSCODE_THREADS),
+    ]
+
+    if method == "transcode":
+        args += [
+            "-c:v", "libx264",
+            "-preset", "veryfast",
+            "-crf", str(TRANSCODE_CRF),
+            "-pix_fmt", "yuv420p",
+        ]
+    else:
+        args += ["-c:v", "copy"]
+
+    if method == "remux":
+        args += ["-c:a", "copy"]
+    else:
+        args += ["-c:a", "aac", "-b:a", "160k", "-ac", "2"]
+
+    args += ["-movflags", "+faststart", "-f", "mp4", str(dst)]
+    return args
+
+
+# ----------------------------
+# Job
+# ----------------------------
+
+@jobs.handler("transcode")
+def transcode_job(payload):
+    """
+    Job handler: plans from the stored probe and writes the MP4
+    variant. Skips work when the variant still matches the source.
+    """
+    media_id = payload["media_id"]
+
+    row = query("SELECT filepath FROM media WHERE id = ?", (media_id,), one=True)
+    if not row or not needs_transcode(row["filepath"]):
+        return
+
+    src = MEDIA_DIR / row["filepath"]
+    st = src.stat()
+
+    current = query(
+        """
+        SELECT filepath, source_size, source_mtime_ns
+        FROM media_variants WHERE media_id = ?
+        """,
+        (media_id,),
+        one=True
+    )
+    if (
+        current
+        and (current["source_size"], current["source_mtime_ns"]) == (st.st_size, st.st_mtime_ns)
+        and (MEDIA_DIR / current["filepath"]).exists()
+    ):
+        return
+
+    info = ensure_probe(media_id)
+    method = plan(info)
+    duration = info["format"]["duration"]
+
+    rel = variant_path(row["filepath"])
+    dst = MEDIA_DIR / rel
+    tmp = dst.with_name(dst.name + ".part")
+
+    started = time.monotonic()
+    try:
+        # niced so playback stays responsive; nice(1) rather than a
+        # preexec_fn, which is unsafe in this threaded process
+        subprocess.run(
+            ["nice", "-n", "10", *_ffmpeg_args(src, tmp, method)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+    elapsed = time.monotonic() - started
+    metrics.ffmpeg_seconds.observe(elapsed, task="transcode")
+
+    execute(
+        """
+        INSERT OR REPLACE INTO media_variants
+            (media_id, filepath, method, source_size, source_mtime_ns,
+             duration, elapsed)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (media_id, rel, method, st.st_size, st.st_mtime_ns, duration, elapsed)
+    )
+    print(f"[TRANSCODE] {row['filepath']}: {method} in {elapsed:.1f}s")
+
+
+# ----------------------------
+# Dashboard
+# ----------------------------
+
+def transcode_stats(window=20):
+    """
+    Queue depth, throughput over the last `window` variants and an
+    ETA for the backlog.
+    """
+    counts = {
+        r["status"]: r["n"]
+        for r in query(
+            "SELECT status, COUNT(*) AS n FROM jobs WHERE kind = 'transcode' GROUP BY status"
+        )
+    }
+
+    recent = query(
+        "SELECT duration, elapsed FROM media_variants ORDER BY created_at DESC LIMIT ?",
+        (window,)
+    )
+    avg_elapsed = sum(r["elapsed"] for r in recent) / len(recent) if recent else None
+
+    timed = [r for r in recent if r["duration"]]
+    speed = None
+    if timed:
+        speed = sum(r["duration"] for r in timed) / max(sum(r["elapsed"] for r in timed), 0.001)
+
+    last_hour = query(
+        """
+        SELECT COUNT(*) AS n FROM media_variants
+        WHERE created_at >= datetime('now', '-1 hour')
+        """,
+        one=True
+    )["n"]
+
+    queued = counts.get("queued", 0)
+    running = counts.get("running", 0)
+    eta = None
+    if avg_elapsed is not None:
+        eta = (queued + running) * avg_elapsed / TRANSCODE_WORKERS
+
+    return {
+        "queued": queued,
+        "running": running,
+        "failed": counts.get("failed", 0),
+        "last_hour": last_hour,
+        "avg_seconds": avg_elapsed,
+        "speed": speed,
+        "eta_seconds": eta,
+        "workers": TRANSCODE_WORKERS,
+    }
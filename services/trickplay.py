@@ -0,0 +1,179 @@
+# services/trickplay.py
+
+from pathlib import Path
+import math
+import os
+import subprocess
+
+from config import (
+    MEDIA_DIR,
+    TRICKPLAY_ENABLED,
+    TRICKPLAY_INTERVAL,
+    TRICKPLAY_WIDTH,
+    TRICKPLAY_COLUMNS,
+    TRICKPLAY_MAX_TILES,
+)
+from models.base import query
+from services import jobs, metrics
+from services.fingerprint import canonical_id
+from services.probe import ensure_probe
+
+# Content-addressed: files are named after the source fingerprint and
+# the sheet geometry, so duplicates and moved files reuse them and a
+# rewritten file gets new ones
+TRICKPLAY_DIR = Path("static/thumbs/trickplay")
+TRICKPLAY_URL = "/static/thumbs/trickplay"
+
+
+# ----------------------------
+# Lookups
+# ----------------------------
+
+def _cache_key(media_id):
+    row = query(
+        """
+        SELECT fingerprint FROM media_files
+        WHERE media_id = ? AND fingerprint IS NOT NULL
+        LIMIT 1
+        """,
+        (media_id,),
+        one=True
+    )
+    if not row:
+        return None
+    return f"{row['fingerprint']}-{TRICKPLAY_WIDTH}w{TRICKPLAY_INTERVAL:g}s"
+
+
+def trickplay_url(media_id):
+    """
+    URL of the WebVTT thumbnail track if the sprite sheet exists,
+    otherwise queues generation and returns None.
+    """
+    if not TRICKPLAY_ENABLED:
+        return None
+
+    media_id = canonical_id(media_id)
+    key = _cache_key(media_id)
+    if key is None:
+        return None  # not fingerprinted yet
+
+    if (TRICKPLAY_DIR / f"{key}.vtt").exists():
+        return f"{TRICKPLAY_URL}/{key}.vtt"
+
+    enqueue_trickplay(media_id)
+    return None
+
+
+def enqueue_trickplay(media_id, priority=-1):
+    # below thumbnails: a card image matters more than seek previews
+    if TRICKPLAY_ENABLED:
+        jobs.enqueue("trickplay", media_id, {"media_id": media_id}, priority=priority)
+
+
+# ----------------------------
+# Generation
+# ----------------------------
+
+def _timestamp(seconds):
+    ms = round(seconds * 1000)
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+
+def sheet_layout(duration, width, height):
+    """
+    (interval, tiles, tile width, tile height) for a video. Long videos
+    get a wider interval so the sheet stays under TRICKPLAY_MAX_TILES.
+    """
+    interval = max(TRICKPLAY_INTERVAL, duration / TRICKPLAY_MAX_TILES)
+    tiles = max(1, math.ceil(duration / interval))
+
+    tile_w = TRICKPLAY_WIDTH
+    if width and height:
+        tile_h = max(2, round(tile_w * height / width / 2) * 2)
+    else:
+        tile_h = tile_w * 9 // 16
+    return interval, tiles, tile_w, tile_h
+
+
+def build_vtt(sprite_url, duration, interval, tiles, tile_w, tile_h):
+    lines = ["WEBVTT", ""]
+    for i in range(tiles):
+        row, col = divmod(i, TRICKPLAY_COLUMNS)
+        start, end = i * interval, min((i + 1) * interval, duration)
+        lines += [
+            f"{_timestamp(start)} --> {_timestamp(end)}",
+            f"{sprite_url}#xywh={col * tile_w},{row * tile_h},{tile_w},{tile_h}",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+@jobs.handler("trickplay")
+def generate_trickplay(payload):
+    """
+    Job handler: one ffmpeg pass decodes keyframes only, samples one
+    frame per interval and tiles them into a single JPEG; the VTT
+    track maps each interval to its tile. The VTT is written last, so
+    its presence means the sheet is complete.
+    """
+    media_id = canonical_id(payload["media_id"])
+    key = _cache_key(media_id)
+    if key is None:
+        return
+
+    sprite = TRICKPLAY_DIR / f"{key}.jpg"
+    vtt = TRICKPLAY_DIR / f"{key}.vtt"
+    if vtt.exists():
+        return
+
+    row = query("SELECT filepath FROM media WHERE id = ?", (media_id,), one=True)
+    info = ensure_probe(media_id)
+    if not row or not info:
+        return
+    fmt = info["format"]
+    if not fmt.get("duration") or not fmt.get("width"):
+        return  # audio only, or nothing to seek in
+
+    source = MEDIA_DIR / row["filepath"]
+
+    duration = fmt["duration"]
+    interval, tiles, tile_w, tile_h = sheet_layout(duration, fmt["width"], fmt["height"])
+    rows = math.ceil(tiles / TRICKPLAY_COLUMNS)
+
+    TRICKPLAY_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_sprite = TRICKPLAY_DIR / f"{key}.tmp.jpg"
+    tmp_vtt = TRICKPLAY_DIR / f"{key}.tmp.vtt"
+
+    try:
+        with metrics.timed(metrics.ffmpeg_seconds, task="trickplay"):
+            subprocess.run(
+                [
+                    "ffmpeg", "-y",
+                    "-skip_frame", "nokey",
+                    "-i", str(source),
+                    "-an", "-sn", "-dn",
+                    "-vf", (
+                        f"fps=1/{interval:.3f},"
+                        f"scale={tile_w}:{tile_h},"
+                        f"tile={TRICKPLAY_COLUMNS}x{rows}"
+                    ),
+                    "-frames:v", "1",
+                    "-q:v", "5",
+                    str(tmp_sprite),
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+        if not tmp_sprite.exists() or not tmp_sprite.stat().st_size:
+            raise RuntimeError(f"ffmpeg produced no sprite sheet for {source}")
+
+        tmp_vtt.write_text(build_vtt(
+            f"{TRICKPLAY_URL}/{sprite.name}", duration, interval, tiles, tile_w, tile_h
+        ))
+        os.replace(tmp_sprite, sprite)
+        os.replace(tmp_vtt, vtt)
+        print(f"[TRICKPLAY] {row['filepath']}: {tiles} tiles every {interval:.0f}s")
+    finally:
+        tmp_sprite.unlink(missing_ok=True)
+        tmp_vtt.unlink(missing_ok=True)
@@ -0,0 +1,399 @@
+# services/uploads.py
+
+import base64
+import fcntl
+import hashlib
+import os
+import secrets
+import threading
+import time
+
+from werkzeug.utils import secure_filename
+
+from config import (
+    MEDIA_DIR,
+    ALLOWED_EXT,
+    VIDEO_EXT,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_MIN_CHUNK,
+    UPLOAD_MAX_CHUNK,
+    UPLOAD_EXPIRY_HOURS,
+    UPLOAD_EXPIRY_INTERVAL,
+)
+from models.base import query, execute, transaction, release_db
+from services.cache import bump_catalog
+from services.fingerprint import fingerprint, refresh_aliases, canonical_id
+from services.probe import enqueue_probe
+from services.thumbnails import enqueue_thumb
+from services.transcode import needs_transcode, enqueue_transcode, PRIORITY_UPLOAD
+
+READ_SIZE = 256 * 1024
+CHECKSUMS = {"md5", "sha1", "sha256"}
+
+_expiry_thread = None
+
+
+class UploadError(Exception):
+    """
+    Client error; `status` is the HTTP code to answer with.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+# ----------------------------
+# Helpers
+# ----------------------------
+
+def part_path(upload_id):
+    # hidden, and on the same filesystem as the library so the
+    # finished file is linked into place rather than copied
+    return MEDIA_DIR / f".upload-{upload_id}.part"
+
+
+def _chunk_count(size, chunk_size):
+    return max(1, -(-size // chunk_size))
+
+
+def _chunk_length(upload, index):
+    start = index * upload["chunk_size"]
+    return min(upload["chunk_size"], upload["size"] - start)
+
+
+def reserve_name(filename, src=None):
+    """
+    Claims a free name in MEDIA_DIR for `filename` (adding -1, -2, ...)
+    by hard-linking `src` there, or creating an empty file to write
+    into. Both fail rather than replace, so two workers never end up
+    with the same name.
+    """
+    stem, ext = os.path.splitext(filename)
+    candidate, n = filename, 1
+    while True:
+        target = MEDIA_DIR / candidate
+        try:
+            if src is None:
+                os.close(os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            else:
+                os.link(src, target)
+            return candidate
+        except FileExistsError:
+            candidate = f"{stem}-{n}{ext}"
+            n += 1
+
+
+def get_upload(upload_id):
+    row = query("SELECT * FROM uploads WHERE id = ?", (upload_id,), one=True)
+    if not row:
+        raise UploadError("unknown upload", 404)
+    return row
+
+
+def upload_status(upload_id):
+    """
+    What a client needs to resume: received chunk indexes and the
+    contiguous byte offset (tus' Upload-Offset).
+    """
+    upload = get_upload(upload_id)
+    received = [
+        r["idx"] for r in query(
+            "SELECT idx FROM upload_chunks WHERE upload_id = ? ORDER BY idx",
+            (upload_id,)
+        )
+    ]
+
+    contiguous = 0
+    for i, idx in enumerate(received):
+        if idx != i:
+            break
+        contiguous = i + 1
+
+    return {
+        "id": upload_id,
+        "filename": upload["filename"],
+        "size": upload["size"],
+        "chunk_size": upload["chunk_size"],
+        "chunks": _chunk_count(upload["size"], upload["chunk_size"]),
+        "received": received,
+        "offset": min(contiguous * upload["chunk_size"], upload["size"]),
+    }
+
+
+# ----------------------------
+# Protocol
+# ----------------------------
+
+def create_upload(filename, size, title, category=None, chunk_size=None):
+    """
+    Registers an upload and preallocates its file so chunks can be
+    written at their final offsets in any order.
+    """
+    filename = secure_filename(filename or "")
+    if os.path.splitext(filename)[1].lower() not in ALLOWED_EXT:
+        raise UploadError("file type not allowed")
+    if not title:
+        raise UploadError("title is required")
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise UploadError("size must be a positive integer")
+
+    if chunk_size is None:
+        chunk_size = UPLOAD_CHUNK_SIZE
+    elif (
+        not isinstance(chunk_size, int)
+        or isinstance(chunk_size, bool)
+        or chunk_size < UPLOAD_MIN_CHUNK
+    ):
+        raise UploadError(f"chunk_size must be an integer of at least {UPLOAD_MIN_CHUNK}")
+    chunk_size = min(chunk_size, UPLOAD_MAX_CHUNK)
+
+    upload_id = secrets.token_hex(16)
+    MEDIA_DIR.mkdir(exist_ok=True)
+
+    fd = os.open(part_path(upload_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.ftruncate(fd, size)  # filesystem without fallocate
+        else:
+            os.ftruncate(fd, size)
+    except OSError:
+        os.close(fd)
+        part_path(upload_id).unlink(missing_ok=True)
+        raise UploadError("not enough space for this file", 507)
+    os.close(fd)
+
+    execute(
+        """
+        INSERT INTO uploads (id, filename, title, category, size, chunk_size)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (upload_id, filename, title, category or "general", size, chunk_size)
+    )
+    return upload_status(upload_id)
+
+
+def _parse_checksum(header):
+    """
+    "sha256 <base64 digest>" -> (hashlib object, expected digest).
+    """
+    if not header:
+        return None, None
+    try:
+        algo, digest = header.split(None, 1)
+        expected = base64.b64decode(digest, validate=True)
+    except ValueError:
+        raise UploadError("malformed Upload-Checksum")
+    algo = algo.lower()
+    if algo not in CHECKSUMS:
+        raise UploadError(f"unsupported checksum {algo!r}")
+    return hashlib.new(algo), expected
+
+
+def write_chunk(upload_id, index, stream, length, checksum=None):
+    """
+    Streams one chunk from the request body straight to its offset.
+    Chunks of the same upload may arrive concurrently; each writes
+    its own region through its own descriptor.
+    """
+    upload = get_upload(upload_id)
+    if upload["media_id"] is not None:
+        raise UploadError("upload already completed", 409)
+
+    if not 0 <= index < _chunk_count(upload["size"], upload["chunk_size"]):
+        raise UploadError("chunk index out of range", 416)
+
+    expected_len = _chunk_length(upload, index)
+    if length is not None and length != expected_len:
+        raise UploadError(f"chunk {index} must be {expected_len} bytes")
+
+    digest, expected = _parse_checksum(checksum)
+    offset = index * upload["chunk_size"]
+    written = 0
+
+    try:
+        fd = os.open(part_path(upload_id), os.O_WRONLY)
+    except FileNotFoundError:
+        # completed or expired since it was looked up
+        upload = get_upload(upload_id)
+        if upload["media_id"] is not None:
+            raise UploadError("upload already completed", 409)
+        raise UploadError("upload file is missing", 409)
+    try:
+        while written < expected_len:
+            data = stream.read(min(READ_SIZE, expected_len - written))
+            if not data:
+                break
+            if digest:
+                digest.update(data)
+            view = memoryview(data)
+            while view:
+                n = os.pwrite(fd, view, offset + written)
+                view = view[n:]
+                written += n
+    finally:
+        os.close(fd)
+
+    if written != expected_len:
+        raise UploadError(f"chunk {index} truncated ({written}/{expected_len} bytes)")
+    if digest and digest.digest() != expected:
+        raise UploadError("checksum mismatch", 460)
+
+    execute(
+        "INSERT OR IGNORE INTO upload_chunks (upload_id, idx) VALUES (?, ?)",
+        (upload_id, index)
+    )
+    execute(
+        "UPDATE uploads SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+        (upload_id,)
+    )
+    return upload_status(upload_id)
+
+
+def _completed(upload):
+    return {"media_id": upload["media_id"], "filepath": upload["filepath"]}
+
+
+def complete_upload(upload_id):
+    """
+    Links the finished file into the library and registers it.
+    Probe, thumbnail and transcode work is queued, not waited for.
+    Completing again (a retried request, or another worker racing
+    this one) returns the same result.
+    """
+    upload = get_upload(upload_id)
+    if upload["media_id"] is not None:
+        return _completed(upload)
+
+    status = upload_status(upload_id)
+    if len(status["received"]) != status["chunks"]:
+        raise UploadError(
+            f"{status['chunks'] - len(status['received'])} chunks missing", 409
+        )
+
+    src = part_path(upload_id)
+    try:
+        fd = os.open(src, os.O_RDONLY)
+    except FileNotFoundError:
+        fd = None
+    if fd is None:
+        # finished by another request between the two reads
+        upload = get_upload(upload_id)
+        if upload["media_id"] is not None:
+            return _completed(upload)
+        raise UploadError("upload file is missing", 409)
+
+    try:
+        # one completion per upload, across workers
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        upload = get_upload(upload_id)
+        if upload["media_id"] is not None:
+            return _completed(upload)
+
+        os.fsync(fd)
+        filename = reserve_name(upload["filename"], src=src)
+        try:
+            media_id = register_media(filename, upload["title"], upload["category"])
+        except BaseException:
+            (MEDIA_DIR / filename).unlink(missing_ok=True)
+            raise
+
+        # the row is kept (until expiry) to answer repeated completes
+        execute(
+            """
+            UPDATE uploads SET media_id = ?, filepath = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            (media_id, filename, upload_id)
+        )
+        src.unlink()
+    finally:
+        os.close(fd)
+
+    return {"media_id": media_id, "filepath": filename}
+
+
+def abort_upload(upload_id):
+    get_upload(upload_id)
+    part_path(upload_id).unlink(missing_ok=True)
+    with transaction() as db:
+        db.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+        db.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+
+
+def expire_uploads(hours=UPLOAD_EXPIRY_HOURS):
+    """
+    Drops uploads nobody touched for `hours` along with their files.
+    """
+    stale = query(
+        "SELECT id FROM uploads WHERE updated_at < datetime('now', ?)",
+        (f"-{hours} hours",)
+    )
+    for row in stale:
+        abort_upload(row["id"])
+    if stale:
+        print(f"[UPLOAD] Expired {len(stale)} unfinished uploads")
+    return len(stale)
+
+
+def _expiry_loop():
+    while True:
+        time.sleep(UPLOAD_EXPIRY_INTERVAL)
+        try:
+            expire_uploads()
+        except Exception as e:
+            print(f"[UPLOAD] Expiry failed: {e}")
+        finally:
+            release_db()
+
+
+def start_expiry():
+    """
+    Expires abandoned uploads every UPLOAD_EXPIRY_INTERVAL seconds;
+    one timer per deployment.
+    """
+    global _expiry_thread
+    if _expiry_thread is None or not _expiry_thread.is_alive():
+        _expiry_thread = threading.Thread(target=_expiry_loop, name="upload-expiry", daemon=True)
+        _expiry_thread.start()
+
+
+# ----------------------------
+# Library registration
+# ----------------------------
+
+def register_media(filename, title, category):
+    """
+    Adds a file already in MEDIA_DIR to the catalog and the scanner's
+    index (so the watcher sees it as known) and queues its jobs.
+    """
+    st = (MEDIA_DIR / filename).stat()
+    content = fingerprint(MEDIA_DIR / filename)  # pages are still cached
+
+    with transaction() as db:
+        media_id = db.execute(
+            "INSERT INTO media (title, filepath, category) VALUES (?, ?, ?)",
+            (title, filename, category)
+        ).lastrowid
+        db.execute(
+            """
+            INSERT OR REPLACE INTO media_files
+                (filepath, media_id, size, mtime_ns, inode, fingerprint)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (filename, media_id, st.st_size, st.st_mtime_ns, st.st_ino, content)
+        )
+
+    bump_catalog()
+    refresh_aliases()
+    if canonical_id(media_id) != media_id:
+        return media_id  # a re-upload: artifacts already exist
+    enqueue_probe(media_id, PRIORITY_UPLOAD)
+    if os.path.splitext(filename)[1].lower() in VIDEO_EXT:
+        enqueue_thumb(MEDIA_DIR / filename, media_id, priority=PRIORITY_UPLOAD)
+        if needs_transcode(filename):
+            enqueue_transcode(media_id, PRIORITY_UPLOAD)
+    return media_id
@@ -1,16 +1,250 @@
-from models.base import query, execute
+import atexit
+import json
+import math
+import os
+import threading
+import time
+
+from config import PROGRESS_FLUSH_INTERVAL, PROGRESS_FLUSH_SIZE, PROGRESS_STATE_DIR
+from models.base import query, execute_many, transaction
+from services.cache import bump_user
+from services.probe import duration_of
+
+# Latest unsaved progress: user_id -> {media_id: (progress, position,
+# time)}. `_flushing` holds the batch being written so reads still see it.
+_pending = {}
+_flushing = {}
+_pending_count = 0
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_publish_lock = threading.Lock()
+
+_wake = threading.Event()
+_stop = threading.Event()
+
+
+# ----------------------------
+# Reads
+# ----------------------------
+
+def _own_pending(user_id):
+    with _lock:
+        merged = dict(_flushing.get(user_id, {}))
+        merged.update(_pending.get(user_id, {}))
+    return merged
+
+
+def _published(user_id):
+    """
+    {media_id: (progress, position, time)} other processes hold
+    unflushed for one user. Files of processes that died are removed.
+    """
+    try:
+        entries = list(os.scandir(PROGRESS_STATE_DIR / str(user_id)))
+    except FileNotFoundError:
+        return {}
+
+    merged = {}
+    for entry in entries:
+        pid, ext = os.path.splitext(entry.name)
+        if ext != ".json" or pid == str(os.getpid()):
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            os.unlink(entry.path)
+            continue
+        except (ValueError, PermissionError):
+            pass
+        try:
+            rows = json.loads(open(entry.path).read())
+        except (OSError, ValueError):
+            continue
+        for media_id, progress, position, at in rows:
+            if media_id not in merged or at > merged[media_id][2]:
+                merged[media_id] = (progress, position, at)
+    return merged
+
+
+def pending_progress(user_id):
+    """
+    Unflushed progress for one user in any process, newest value
+    winning.
+    """
+    merged = _published(user_id)
+    for media_id, entry in _own_pending(user_id).items():
+        if media_id not in merged or entry[2] >= merged[media_id][2]:
+            merged[media_id] = entry
+    return {media_id: (progress, position) for media_id, (progress, position, _at) in merged.items()}
+
 
 def get_watch_progress(user_id):
+    """
+    media_id -> (percent, position in seconds) for one user.
+    """
     rows = query(
-        "SELECT media_id, progress FROM watch_history WHERE user_id=?",
+        "SELECT media_id, progress, position FROM watch_history WHERE user_id=?",
         [user_id]
     )
-    return {row["media_id"]: row["progress"] for row in rows}
-
-def update_progress(user_id, media_id, progress):
-    execute("""
-        INSERT INTO watch_history (user_id, media_id, progress)
-        VALUES (?, ?, ?)
-        ON CONFLICT(user_id, media_id)
-        DO UPDATE SET progress=excluded.progress
-    """, [user_id, media_id, progress])
+    progress = {row["media_id"]: (row["progress"], row["position"]) for row in rows}
+    progress.update(pending_progress(user_id))
+    return progress
+
+
+# ----------------------------
+# Writes
+# ----------------------------
+
+def _publish(user_id):
+    """
+    Writes this process's unflushed entries for one user where the
+    other workers read them; removes the file once none are left.
+    """
+    path = PROGRESS_STATE_DIR / str(user_id) / f"{os.getpid()}.json"
+    with _publish_lock:
+        rows = [
+            [media_id, progress, position, at]
+            for media_id, (progress, position, at) in _own_pending(user_id).items()
+        ]
+        if not rows:
+            path.unlink(missing_ok=True)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(rows))
+        os.replace(tmp, path)
+
+
+def _seconds(value):
+    seconds = float(value)
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(f"{value!r} is not a time")
+    return seconds
+
+
+def parse_progress(data):
+    """
+    (media_id, percent, position) from a /progress body. Current pages
+    post {"media_id", "position", "duration"} in seconds, older ones
+    {"media_id", "progress"} as a percentage. Raises ValueError, also
+    for negative or non-finite numbers.
+    """
+    try:
+        media_id = int(data["media_id"])
+        if "position" in data:
+            position = _seconds(data["position"])
+            duration = _seconds(data.get("duration") or 0) or duration_of(media_id)
+            progress = min(100, int(position / duration * 100)) if duration else 0
+        else:
+            position = None
+            progress = int(data["progress"])
+            if not 0 <= progress <= 100:
+                raise ValueError(f"progress {progress} out of range")
+    except (KeyError, TypeError, ValueError, OverflowError) as e:
+        raise ValueError(f"bad progress payload: {e}") from None
+    return media_id, progress, position
+
+
+def update_progress(user_id, media_id, progress, position=None):
+    """
+    Buffers the value; only the latest per (user, media) is written.
+    `progress` is a percentage, `position` the resume point in seconds.
+    """
+    global _pending_count
+
+    with _lock:
+        user = _pending.setdefault(user_id, {})
+        if media_id not in user:
+            _pending_count += 1
+        user[media_id] = (progress, position, time.time())
+        full = _pending_count >= PROGRESS_FLUSH_SIZE
+
+    _publish(user_id)  # before the bump, so no worker caches a view without it
+    bump_user(user_id)
+
+    if full:
+        _wake.set()
+
+
+def flush_progress():
+    """
+    Writes everything buffered in a single transaction.
+    """
+    global _pending, _flushing, _pending_count
+
+    with _flush_lock:
+        with _lock:
+            if not _pending:
+                return 0
+            _flushing, _pending = _pending, {}
+            _pending_count = 0
+
+        rows = [
+            (user_id, media_id, progress, position, at)
+            for user_id, entries in _flushing.items()
+            for media_id, (progress, position, at) in entries.items()
+        ]
+
+        try:
+            with transaction():
+                # stamped with when the value was posted: another worker
+                # may flush an older one for the same item after us
+                execute_many(
+                    """
+                    INSERT INTO watch_history (user_id, media_id, progress, position, updated_at)
+                    VALUES (?, ?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', ?, 'unixepoch'))
+                    ON CONFLICT(user_id, media_id)
+                    DO UPDATE SET
+                        progress = excluded.progress,
+                        position = excluded.position,
+                        updated_at = excluded.updated_at
+                    WHERE watch_history.updated_at IS NULL
+                       OR excluded.updated_at >= watch_history.updated_at
+                    """,
+                    rows
+                )
+        except Exception:
+            # put the batch back under anything newer and retry later
+            with _lock:
+                for user_id, entries in _flushing.items():
+                    user = _pending.setdefault(user_id, {})
+                    for media_id, progress in entries.items():
+                        if media_id not in user:
+                            user[media_id] = progress
+                            _pending_count += 1
+                _flushing = {}
+            raise
+
+        with _lock:
+            users, _flushing = list(_flushing), {}
+
+        # readers racing the hand-over may have cached a stale view
+        for user_id in users:
+            _publish(user_id)
+            bump_user(user_id)
+
+        return len(rows)
+
+
+def _flusher(app):
+    with app.app_context():
+        while not _stop.is_set():
+            _wake.wait(PROGRESS_FLUSH_INTERVAL)
+            _wake.clear()
+            try:
+                flush_progress()
+            except Exception as e:
+                print(f"[PROGRESS] flush failed: {e}")
+
+
+def start_progress_flusher(app):
+    def final_flush():
+        _stop.set()
+        _wake.set()
+        with app.app_context():
+            flush_progress()
+
+    threading.Thread(
+        target=_flusher, args=(app,), name="progress-flusher", daemon=True
+    ).start()
+    atexit.register(final_flush)
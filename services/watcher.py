@@ -0,0 +1,257 @@
+# services/watcher.py
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from config import MEDIA_DIR, WATCH_MODE, WATCH_DEBOUNCE, WATCH_POLL_INTERVAL
+from services.media_scan import walk_library, sync_library
+
+NETWORK_FS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "fuse.sshfs", "fuse.rclone"}
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# No IN_MODIFY: a long copy would otherwise keep the tree from ever
+# going quiet. Growing files are caught by the snapshot comparison.
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+_stop = threading.Event()
+
+
+# ----------------------------
+# Debounce + size-stable sync
+# ----------------------------
+
+class Debouncer:
+    """
+    Collects dirty (directory, recursive) scopes. Once no event has
+    arrived for WATCH_DEBOUNCE seconds the dirty scopes are
+    snapshotted; a scope is synced only when the next snapshot is
+    identical, so files still being copied are picked up once their
+    size settles. Stable scopes are synced in one batch so both
+    halves of a move are seen together.
+    """
+
+    def __init__(self, app, debounce=WATCH_DEBOUNCE):
+        self.app = app
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.snapshots = {}   # scope -> walk result
+        self.last_event = 0.0
+
+    def mark(self, rel_dir, recursive=False):
+        with self.lock:
+            self.dirty.add((rel_dir, recursive))
+            self.last_event = time.monotonic()
+
+    def run(self):
+        with self.app.app_context():
+            while not _stop.wait(0.5):
+                try:
+                    self._tick()
+                except Exception as e:
+                    print(f"[WATCH] sync failed: {e}")
+
+    def _tick(self):
+        with self.lock:
+            if time.monotonic() - self.last_event < self.debounce:
+                return
+            pending = list(self.dirty)
+        if not pending:
+            return
+
+        stable = []
+        for scope in pending:
+            snapshot = walk_library([scope])
+            if self.snapshots.get(scope) == snapshot:
+                stable.append(scope)
+            else:
+                self.snapshots[scope] = snapshot
+
+        if not stable:
+            # check again after another quiet period
+            with self.lock:
+                self.last_event = time.monotonic()
+            return
+
+        with self.lock:
+            for scope in stable:
+                self.dirty.discard(scope)
+                self.snapshots.pop(scope, None)
+
+        # one sync for the whole batch so cross-directory moves pair up
+        report = sync_library(stable)
+        if any(report[k] for k in ("added", "removed", "moved", "modified")):
+            print(
+                "[WATCH] Added {added}, removed {removed}, moved {moved}, "
+                "modified {modified}".format(**report)
+            )
+
+
+# ----------------------------
+# inotify
+# ----------------------------
+
+class InotifyWatcher:
+    def __init__(self, debouncer):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.debouncer = debouncer
+        self.paths = {}  # wd -> relative directory
+
+        self._add_tree("")
+
+    def _add(self, rel_dir):
+        path = os.fsencode(MEDIA_DIR / rel_dir)
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd >= 0:
+            self.paths[wd] = rel_dir
+
+    def _add_tree(self, rel_dir):
+        self._add(rel_dir)
+        for root, dirs, _files in os.walk(MEDIA_DIR / rel_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for d in dirs:
+                self._add(os.path.relpath(os.path.join(root, d), MEDIA_DIR))
+
+    def run(self):
+        while not _stop.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 1.0)
+            if ready:
+                self._handle(os.read(self.fd, 64 * 1024))
+        os.close(self.fd)
+
+    def _handle(self, buf):
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b"\0").decode(
+                "utf-8", "surrogateescape"
+            )
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.debouncer.mark("", recursive=True)
+                continue
+
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+
+            rel_dir = self.paths.get(wd)
+            if rel_dir is None or name.startswith("."):
+                continue
+
+            if mask & IN_ISDIR:
+                child = os.path.join(rel_dir, name) if rel_dir else name
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(child)
+                if mask & (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+                    self.debouncer.mark(child, recursive=True)
+                continue
+
+            self.debouncer.mark(rel_dir)
+
+
+# ----------------------------
+# Polling (network mounts)
+# ----------------------------
+
+class PollingWatcher:
+    def __init__(self, debouncer, interval=WATCH_POLL_INTERVAL):
+        self.debouncer = debouncer
+        self.interval = interval
+
+    def run(self):
+        previous = walk_library()
+        while not _stop.wait(self.interval):
+            current = walk_library()
+            changed = {
+                fp for fp in previous.keys() | current.keys()
+                if previous.get(fp) != current.get(fp)
+            }
+            for rel_dir in {os.path.dirname(fp) for fp in changed}:
+                self.debouncer.mark(rel_dir)
+            previous = current
+
+
+# ----------------------------
+# Startup
+# ----------------------------
+
+def _is_network_mount(path):
+    """
+    Finds the fs type of the longest /proc/mounts entry containing
+    `path`. inotify never sees changes made by other NFS/SMB clients.
+    """
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                _dev, mnt, kind = line.split()[:3]
+                mnt = mnt.replace("\\040", " ")
+                if str(path).startswith(mnt) and len(mnt) > len(best):
+                    best, fstype = mnt, kind
+    except OSError:
+        return False
+    return fstype in NETWORK_FS
+
+
+def start_watcher(app, mode=WATCH_MODE):
+    """
+    Starts the library watcher threads. Returns the mode in use.
+    """
+    if mode == "off":
+        return mode
+
+    MEDIA_DIR.mkdir(exist_ok=True)
+    debouncer = Debouncer(app)
+
+    if mode == "auto":
+        mode = "poll" if _is_network_mount(MEDIA_DIR) else "inotify"
+
+    watcher = None
+    if mode == "inotify":
+        try:
+            watcher = InotifyWatcher(debouncer)
+        except (AttributeError, OSError) as e:
+            print(f"[WATCH] inotify unavailable ({e}), polling instead")
+            mode = "poll"
+
+    if watcher is None:
+        watcher = PollingWatcher(debouncer)
+
+    for name, target in (("watch-debounce", debouncer.run),
+                         (f"watch-{mode}", watcher.run)):
+        threading.Thread(target=target, name=name, daemon=True).start()
+
+    print(f"[WATCH] Watching {MEDIA_DIR} ({mode})")
+    return mode
+
+
+def stop_watcher():
+    _stop.set()
@@ -0,0 +1,30 @@
+# tests/conftest.py
+#
+# config.py reads the environment at import time, so the test database
+# and library are pointed at a scratch directory before anything from
+# the app is imported.
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+SCRATCH = Path(tempfile.mkdtemp(prefix="miniflix-tests-"))
+
+os.environ.update(
+    DB_PATH=str(SCRATCH / "test.db"),
+    MEDIA_DIR=str(SCRATCH / "media"),
+    WATCH_MODE="off",
+)
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture(scope="session")
+def db():
+    from services.db_init import init_db
+
+    init_db()
+    return SCRATCH / "test.db"
@@ -0,0 +1,54 @@
+# tests/test_bandwidth.py
+
+import math
+
+import pytest
+
+from services import bandwidth
+
+
+def test_fair_share_splits_by_weight():
+    alloc = bandwidth.fair_share(300, {"a": (1, math.inf), "b": (2, math.inf)})
+    assert alloc == {"a": 100, "b": 200}
+
+
+def test_fair_share_redistributes_unused_limit():
+    alloc = bandwidth.fair_share(300, {"a": (1, 50), "b": (1, math.inf), "c": (1, math.inf)})
+    assert alloc == {"a": 50, "b": 125, "c": 125}
+
+
+def test_fair_share_never_exceeds_capacity():
+    alloc = bandwidth.fair_share(100, {k: (w, 40) for k, w in zip("abcd", (1, 2, 3, 4))})
+    assert sum(alloc.values()) == pytest.approx(100)
+    assert all(v <= 40 for v in alloc.values())
+
+
+def test_fair_share_unlimited_capacity_gives_limits():
+    assert bandwidth.fair_share(math.inf, {"a": (1, 10), "b": (3, 20)}) == {"a": 10, "b": 20}
+
+
+def _stream(id, user, weight=1.0, limit=None, user_cap=None):
+    return {"id": id, "user": user, "weight": weight, "limit": limit, "user_cap": user_cap}
+
+
+def test_allocate_shares_users_then_streams(monkeypatch):
+    monkeypatch.setattr(bandwidth, "GLOBAL_RATE", 400)
+    alloc = bandwidth.allocate([
+        _stream(1, "alice"),
+        _stream(2, "alice"),
+        _stream(3, "bob"),
+    ])
+    # each user gets half, alice's half split between her two streams
+    assert alloc == {1: 100, 2: 100, 3: 200}
+
+
+def test_allocate_applies_role_weight_and_user_cap(monkeypatch):
+    monkeypatch.setattr(bandwidth, "GLOBAL_RATE", 400)
+    alloc = bandwidth.allocate([
+        _stream(1, "admin", weight=3.0),
+        _stream(2, "guest", user_cap=50),
+        _stream(3, "viewer"),
+    ])
+    assert alloc[2] == 50
+    assert alloc[1] == pytest.approx(3 * alloc[3])
+    assert sum(alloc.values()) == pytest.approx(400)
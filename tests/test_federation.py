@@ -0,0 +1,171 @@
+# tests/test_federation.py
+
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from models.base import execute
+from services import federation
+
+USER = {"id": 7, "username": "ana", "role": "user"}
+
+
+@pytest.fixture
+def fed(db, monkeypatch):
+    monkeypatch.setattr(federation, "FEDERATION_PEERS", ["http://peer:5000"])
+    monkeypatch.setattr(federation, "FEDERATION_SECRET", "s3cret")
+    monkeypatch.setattr(federation, "FEDERATION_NODE", "here")
+    monkeypatch.setattr(federation, "_peers", {"loaded": 0.0, "nodes": {}})
+    monkeypatch.setattr(federation, "_assigned", {})
+    monkeypatch.setattr(federation, "local_load", lambda: (100.0, 50.0, 1))
+    for table in ("media_files", "remote_media", "federation_peers"):
+        execute(f"DELETE FROM {table}")
+    yield
+    for table in ("media_files", "remote_media", "federation_peers"):
+        execute(f"DELETE FROM {table}")
+
+
+def _peer(node="there", rate=0.0, seen=None):
+    execute(
+        """
+        INSERT INTO federation_peers (url, node, public_url, capacity, rate, streams, last_seen)
+        VALUES (?, ?, ?, 100.0, ?, 0, ?)
+        """,
+        (f"http://{node}:5000", node, f"http://{node}.lan:5000", rate,
+         time.time() if seen is None else seen)
+    )
+
+
+def _local(filepath, fingerprint="fp"):
+    execute(
+        """
+        INSERT INTO media_files (filepath, media_id, size, mtime_ns, inode, fingerprint)
+        VALUES (?, 0, 1, 1, 1, ?)
+        """,
+        (filepath, fingerprint)
+    )
+
+
+def _remote(node, filepath, fingerprint="fp", remote_id=1):
+    execute(
+        """
+        INSERT INTO remote_media (node, remote_id, media_id, filepath, fingerprint)
+        VALUES (?, ?, 0, ?, ?)
+        """,
+        (node, remote_id, filepath, fingerprint)
+    )
+
+
+# ----------------------------
+# Tokens
+# ----------------------------
+
+def test_token_round_trip(fed):
+    token = federation.media_token(USER, "movies/a.mp4")
+    user = federation.token_user(token, "movies/a.mp4")
+    assert user == {"id": "ana@here", "username": "ana@here", "role": "user", "active": 1}
+
+
+def test_token_is_for_one_file(fed):
+    token = federation.media_token(USER, "movies/a.mp4")
+    assert federation.token_user(token, "movies/b.mp4") is None
+
+
+def test_tampered_token(fed):
+    token = federation.media_token(USER, "movies/a.mp4")
+    assert federation.token_user(token[:-2] + "xx", "movies/a.mp4") is None
+
+
+def test_token_from_another_secret(fed, monkeypatch):
+    token = federation.media_token(USER, "movies/a.mp4")
+    monkeypatch.setattr(federation, "FEDERATION_SECRET", "other")
+    assert federation.token_user(token, "movies/a.mp4") is None
+
+
+def test_expired_token(fed, monkeypatch):
+    token = federation.media_token(USER, "movies/a.mp4")
+    monkeypatch.setattr(federation, "FEDERATION_TOKEN_TTL", -1)
+    assert federation.token_user(token, "movies/a.mp4") is None
+
+
+def test_tokens_need_federation(fed, monkeypatch):
+    token = federation.media_token(USER, "movies/a.mp4")
+    monkeypatch.setattr(federation, "FEDERATION_PEERS", [])
+    assert federation.token_user(token, "movies/a.mp4") is None
+
+
+def test_authorized(fed):
+    assert federation.authorized("Bearer s3cret")
+    assert not federation.authorized("Bearer nope")
+    assert not federation.authorized(None)
+
+
+# ----------------------------
+# Routing
+# ----------------------------
+
+def test_route_disabled(fed, monkeypatch):
+    monkeypatch.setattr(federation, "FEDERATION_SECRET", None)
+    assert federation.route("a.mp4", USER) == (None, "a.mp4")
+
+
+def test_route_keeps_local_when_not_much_busier(fed):
+    _local("a.mp4")
+    _remote("there", "b.mp4")
+    _peer(rate=40.0)  # 0.4 vs our 0.5: within the local bias
+    assert federation.route("a.mp4", USER) == (None, "a.mp4")
+
+
+def test_route_sends_to_idle_peer(fed):
+    _local("a.mp4")
+    _remote("there", "films/b c.mp4")
+    _peer(rate=0.0)
+
+    url, path = federation.route("a.mp4", USER)
+    assert path is None
+    parts = urlsplit(url)
+    assert f"{parts.scheme}://{parts.netloc}{parts.path}" == "http://there.lan:5000/media/films/b%20c.mp4"
+    token = parse_qs(parts.query)["fed"][0]
+    assert federation.token_user(token, "films/b c.mp4")["username"] == "ana@here"
+
+
+def test_route_counts_streams_already_sent(fed):
+    _local("a.mp4")
+    _remote("there", "b.mp4")
+    _peer(rate=0.0)
+
+    assert federation.route("a.mp4", USER)[0] is not None
+    # the peer has not reported that stream yet, but it is counted
+    assert federation.route("a.mp4", dict(USER, id=8)) == (None, "a.mp4")
+
+
+def test_route_skips_stale_peers(fed):
+    _local("a.mp4")
+    _remote("there", "b.mp4")
+    _peer(seen=time.time() - 3600)
+    assert federation.route("a.mp4", USER) == (None, "a.mp4")
+
+
+def test_route_remote_item_to_its_holder(fed):
+    _remote("there", "b.mp4")
+    _peer(rate=90.0)
+    url, path = federation.route("@there/b.mp4", USER)
+    assert path is None and url.startswith("http://there.lan:5000/media/b.mp4?fed=")
+
+
+def test_route_remote_item_served_locally_when_we_hold_it(fed):
+    _local("copy.mp4")
+    _remote("there", "b.mp4")
+    _peer(rate=90.0)
+    assert federation.route("@there/b.mp4", USER) == (None, "copy.mp4")
+
+
+def test_route_unreachable_holder(fed):
+    _remote("there", "b.mp4")
+    with pytest.raises(LookupError):
+        federation.route("@there/b.mp4", USER)
+
+
+def test_route_unknown_remote_item(fed):
+    assert federation.route("@there/nope.mp4", USER) == (None, "@there/nope.mp4")
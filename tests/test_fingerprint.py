@@ -0,0 +1,150 @@
+# tests/test_fingerprint.py
+
+import os
+import shutil
+
+import pytest
+
+from config import MEDIA_DIR
+from models.base import query
+from services import fingerprint, media_scan, thumbnails
+from services.fingerprint import SAMPLE_SIZE
+
+ROOT = "moves"
+
+
+@pytest.fixture
+def library(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails, "THUMB_DIR", tmp_path / "frames")
+    monkeypatch.setattr(thumbnails, "VARIANT_DIR", tmp_path / "sized")
+    folder = MEDIA_DIR / ROOT
+    folder.mkdir(parents=True)
+    yield folder
+    shutil.rmtree(folder, ignore_errors=True)
+    # keep other tests' media dir non-empty so this removal is allowed
+    (MEDIA_DIR / ".keep").touch()
+    media_scan.scan_media([ROOT])
+    (MEDIA_DIR / ".keep").unlink()
+
+
+@pytest.fixture
+def full_hashes(monkeypatch):
+    monkeypatch.setattr(fingerprint, "FINGERPRINT_FULL", True)
+    monkeypatch.setattr(media_scan, "FINGERPRINT_FULL", True)
+
+
+def _content():
+    return bytearray(os.urandom(SAMPLE_SIZE * 8))
+
+
+def _twin(data):
+    """Same size and sampled windows, different bytes in between."""
+    other = bytearray(data)
+    other[SAMPLE_SIZE + 1] ^= 0xFF
+    return other
+
+
+def _write(folder, name, data):
+    (folder / name).write_bytes(bytes(data))
+
+
+def _scan():
+    report = media_scan.scan_media([ROOT])
+    fingerprint.backfill_job({})  # what the queued backfill does
+    return report
+
+
+def _ids():
+    rows = query(
+        "SELECT filepath, media_id FROM media_files WHERE filepath LIKE ?", (f"{ROOT}/%",)
+    )
+    return {row["filepath"].split("/", 1)[1]: row["media_id"] for row in rows}
+
+
+def _move_by_copy(folder, old, new):
+    # a copy across filesystems: same bytes, new inode
+    shutil.copyfile(folder / old, folder / new)
+    assert (folder / new).stat().st_ino != (folder / old).stat().st_ino
+    (folder / old).unlink()
+
+
+def test_fingerprint_samples_but_full_hash_does_not(tmp_path):
+    data = _content()
+    (tmp_path / "a").write_bytes(bytes(data))
+    (tmp_path / "b").write_bytes(bytes(_twin(data)))
+    assert fingerprint.fingerprint(tmp_path / "a") == fingerprint.fingerprint(tmp_path / "b")
+    assert fingerprint.full_hash(tmp_path / "a") != fingerprint.full_hash(tmp_path / "b")
+
+
+def test_rename_keeps_media_id(library):
+    _write(library, "a.mkv", _content())
+    _scan()
+    before = _ids()["a.mkv"]
+
+    os.rename(library / "a.mkv", library / "b.mkv")
+    assert _scan()["moved"] == 1
+    assert _ids() == {"b.mkv": before}
+
+
+def test_copy_keeps_media_id_when_whole_file_matches(library, full_hashes):
+    _write(library, "a.mkv", _content())
+    _scan()
+    before = _ids()["a.mkv"]
+
+    _move_by_copy(library, "a.mkv", "b.mkv")
+    report = _scan()
+    assert report["moved"] == 1 and report["added"] == 0
+    assert _ids() == {"b.mkv": before}
+    row = query("SELECT full_hash FROM media_files WHERE media_id = ?", (before,), one=True)
+    assert row["full_hash"] == fingerprint.full_hash(library / "b.mkv")
+
+
+def test_copy_without_stored_hash_is_new(library):
+    _write(library, "a.mkv", _content())
+    _scan()
+    before = _ids()["a.mkv"]
+
+    _move_by_copy(library, "a.mkv", "b.mkv")
+    report = _scan()
+    assert report["moved"] == 0 and report["added"] == 1
+    assert _ids()["b.mkv"] != before
+
+
+def test_sample_collision_is_not_a_move(library, full_hashes):
+    data = _content()
+    _write(library, "a.mkv", data)
+    _scan()
+    before = _ids()["a.mkv"]
+
+    _write(library, "other.mkv", _twin(data))
+    (library / "a.mkv").unlink()
+    report = _scan()
+    assert report["moved"] == 0 and report["added"] == 1
+    assert _ids()["other.mkv"] != before
+
+
+def test_colliding_files_each_keep_their_id(library, full_hashes):
+    data = _content()
+    _write(library, "a.mkv", data)
+    _write(library, "b.mkv", _twin(data))
+    _scan()
+    before = _ids()
+
+    for name in ("a", "b"):
+        shutil.copyfile(library / f"{name}.mkv", library / f"{name}2.mkv")
+    for name in ("a", "b"):
+        (library / f"{name}.mkv").unlink()
+    assert _scan()["moved"] == 2
+    assert _ids() == {"a2.mkv": before["a.mkv"], "b2.mkv": before["b.mkv"]}
+
+
+def test_duplicates_share_canonical_item(library):
+    data = _content()
+    _write(library, "a.mkv", data)
+    _scan()
+    _write(library, "copy.mkv", data)
+    _scan()
+    ids = _ids()
+
+    assert fingerprint.canonical_id(ids["copy.mkv"]) == ids["a.mkv"]
+    assert fingerprint.canonical_id(ids["a.mkv"]) == ids["a.mkv"]
@@ -0,0 +1,119 @@
+# tests/test_jobs.py
+
+import json
+
+import pytest
+
+from config import JOB_MAX_ATTEMPTS
+from models.base import execute, query
+from services import jobs
+
+
+@pytest.fixture
+def queue(db):
+    execute("DELETE FROM jobs")
+    jobs._inflight.clear()
+    jobs._gave_up.clear()
+    yield
+    execute("DELETE FROM jobs")
+    jobs._inflight.clear()
+    jobs._gave_up.clear()
+
+
+def _rows(kind="test"):
+    return query("SELECT * FROM jobs WHERE kind = ? ORDER BY id", (kind,))
+
+
+def _forget():
+    # what a job finishing in another process looks like from here
+    jobs._inflight.clear()
+
+
+def test_enqueue_dedupes_pending(queue):
+    assert jobs.enqueue("test", 1, {"n": 1})
+    assert not jobs.enqueue("test", 1, {"n": 2})
+    _forget()
+    assert jobs.enqueue("test", 1, {"n": 3})
+
+    rows = _rows()
+    assert len(rows) == 1
+    assert json.loads(rows[0]["payload"]) == {"n": 1}
+
+
+def test_enqueue_raises_priority_of_pending(queue):
+    jobs.enqueue("test", 1)
+    jobs.enqueue("test", 1, priority=5)
+    assert _rows()[0]["priority"] == 5
+
+
+def test_done_job_is_requeued(queue):
+    jobs.enqueue("test", 1, {"n": 1})
+    job = jobs._claim()
+    jobs._finish(job, "done")
+
+    assert jobs.enqueue("test", 1, {"n": 2})
+    row = _rows()[0]
+    assert row["status"] == "queued"
+    assert json.loads(row["payload"]) == {"n": 2}
+
+
+def test_failed_job_requeued_while_attempts_left(queue):
+    jobs.enqueue("test", 1)
+    jobs._finish(jobs._claim(), "failed", "boom")
+
+    assert jobs.enqueue("test", 1)
+    assert _rows()[0]["status"] == "queued"
+
+
+def test_failed_job_given_up_after_max_attempts(queue):
+    for _ in range(JOB_MAX_ATTEMPTS):
+        jobs.enqueue("test", 1)
+        jobs._finish(jobs._claim(), "failed", "boom")
+
+    assert not jobs.enqueue("test", 1)
+    row = _rows()[0]
+    assert row["status"] == "failed"
+    assert row["attempts"] == JOB_MAX_ATTEMPTS
+
+
+def test_given_up_job_found_without_local_history(queue):
+    for _ in range(JOB_MAX_ATTEMPTS):
+        jobs.enqueue("test", 1)
+        jobs._finish(jobs._claim(), "failed", "boom")
+    jobs._gave_up.clear()  # failed in another process
+
+    assert not jobs.enqueue("test", 1)
+    assert ("test", "1") in jobs._gave_up
+    assert ("test", "1") not in jobs._inflight
+
+
+def test_claim_order_and_state(queue):
+    jobs.enqueue("test", "low")
+    jobs.enqueue("test", "high", priority=3)
+    jobs.enqueue("test", "later")
+
+    claimed = [jobs._claim()["key"] for _ in range(3)]
+    assert claimed == ["high", "low", "later"]
+    assert jobs._claim() is None
+    assert {row["status"] for row in _rows()} == {"running"}
+    assert {row["attempts"] for row in _rows()} == {1}
+
+
+def test_claim_skips_jobs_held_back(queue):
+    jobs.enqueue("test", 1)
+    jobs._retry_later(jobs._claim(), 60)
+
+    assert jobs._claim() is None
+    row = _rows()[0]
+    assert row["status"] == "queued"
+    assert row["attempts"] == 0
+
+
+def test_claim_respects_dedicated_pools(queue, monkeypatch):
+    monkeypatch.setitem(jobs.POOLS, "slow", 1)
+    jobs.enqueue("slow", 1)
+    jobs.enqueue("test", 1)
+
+    assert jobs._claim()["kind"] == "test"
+    assert jobs._claim() is None
+    assert jobs._claim(("slow",))["kind"] == "slow"
@@ -0,0 +1,22 @@
+# tests/test_media.py
+
+import pytest
+
+from services.media import parse_cursor
+
+
+@pytest.mark.parametrize("cursor, expected", [
+    (None, None),
+    ("", None),
+    ("42", (None, 42)),
+    ("-3.5:17", (-3.5, 17)),
+    ("1e-05:9", (1e-05, 9)),
+])
+def test_parse_cursor(cursor, expected):
+    assert parse_cursor(cursor) == expected
+
+
+@pytest.mark.parametrize("cursor", ["abc", "1.5", "x:1", "1:y", "1:2:3"])
+def test_parse_cursor_rejects_garbage(cursor):
+    with pytest.raises(ValueError):
+        parse_cursor(cursor)
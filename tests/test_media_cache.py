@@ -0,0 +1,191 @@
+# tests/test_media_cache.py
+
+import os
+import shutil
+
+import pytest
+
+from config import MEDIA_DIR
+from models.base import execute
+from services import media_cache
+
+BLOCK = 4096
+
+
+@pytest.fixture
+def tier(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_DIR", tmp_path / "ssd")
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_BLOCK", BLOCK)
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_ADMIT_HITS", 2)
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_FILL_HITS", 3)
+    monkeypatch.setattr(media_cache, "_entries", {})
+    monkeypatch.setattr(media_cache, "_seen", {})
+    execute("DELETE FROM media_cache")
+    execute("DELETE FROM jobs WHERE kind LIKE 'media_cache%'")
+    folder = MEDIA_DIR / "cached"
+    folder.mkdir(parents=True, exist_ok=True)
+    yield folder
+    for entry in list(media_cache._entries.values()):
+        entry.close()
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def _source(folder, name, blocks=3):
+    path = folder / name
+    path.write_bytes(os.urandom(BLOCK * blocks - 100))
+    return path
+
+
+def _play(path, plays=1):
+    """lookup() after `plays` plays, each past the hit window."""
+    st = path.stat()
+    for _ in range(plays):
+        media_cache._seen.clear()
+        execute("UPDATE media_cache SET last_access = last_access - 3600")
+        cached = media_cache.lookup(path, st.st_size, st.st_mtime_ns)
+        if cached is not None and _ < plays - 1:
+            cached.close()
+    return cached
+
+
+def _key(path):
+    st = path.stat()
+    return media_cache._key(path.relative_to(MEDIA_DIR).as_posix(), st.st_size, st.st_mtime_ns)
+
+
+def test_disabled_tier_is_bypassed(tier, monkeypatch):
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_DIR", None)
+    path = _source(tier, "a.mp4")
+    assert _play(path, 5) is None
+
+
+def test_admitted_after_enough_plays(tier):
+    path = _source(tier, "a.mp4")
+    assert _play(path) is None
+    cached = _play(path)
+    assert cached is not None
+    cached.close()
+
+
+def test_requests_within_a_play_count_once(tier):
+    path = _source(tier, "a.mp4")
+    st = path.stat()
+    for _ in range(5):
+        media_cache._seen.clear()
+        assert media_cache.lookup(path, st.st_size, st.st_mtime_ns) is None
+
+
+def test_reads_fill_blocks(tier):
+    path = _source(tier, "a.mp4")
+    data = path.read_bytes()
+    cached = _play(path, 2)
+    try:
+        assert not cached.entry.has(1)
+        # never crosses a block boundary
+        assert cached.pread(BLOCK * 2, BLOCK + 10) == data[BLOCK + 10:BLOCK * 2]
+        assert cached.entry.has(1) and not cached.entry.has(0)
+        # served from the copy from now on
+        source = os.open(path, os.O_WRONLY)
+        os.pwrite(source, b"\0" * BLOCK, BLOCK)
+        os.close(source)
+        assert cached.pread(BLOCK, BLOCK) == data[BLOCK:BLOCK * 2]
+    finally:
+        cached.close()
+
+
+def test_short_last_block(tier):
+    path = _source(tier, "a.mp4")
+    data = path.read_bytes()
+    cached = _play(path, 2)
+    try:
+        assert cached.pread(BLOCK, BLOCK * 2) == data[BLOCK * 2:]
+        assert cached.entry.has(2)
+    finally:
+        cached.close()
+
+
+def test_hot_file_is_copied_in_background(tier):
+    path = _source(tier, "a.mp4")
+    cached = _play(path, 3)
+    cached.close()
+
+    assert media_cache.jobs.queue_depth("media_cache") == 1
+    media_cache.fill_job({"filepath": "cached/a.mp4"})
+
+    cached = _play(path)
+    try:
+        assert cached.complete
+        assert (media_cache.MEDIA_CACHE_DIR / f"{_key(path)}.data").read_bytes() == path.read_bytes()
+    finally:
+        cached.close()
+
+
+def test_rewritten_source_gets_a_new_copy(tier):
+    path = _source(tier, "a.mp4")
+    old = _key(path)
+    _play(path, 2).close()
+
+    path.write_bytes(os.urandom(BLOCK))
+    assert _key(path) != old
+    assert _play(path) is None  # plays counted again from the start
+
+
+def test_evicted_entry_is_recreated(tier):
+    path = _source(tier, "a.mp4")
+    cached = _play(path, 2)
+    cached.pread(BLOCK, 0)
+    cached.close()
+
+    # another process evicted it
+    media_cache._drop_entry(_key(path))
+    cached = _play(path)
+    try:
+        assert not cached.entry.has(0)
+    finally:
+        cached.close()
+
+
+def _fill(path):
+    media_cache.fill_job({"filepath": path.relative_to(MEDIA_DIR).as_posix()})
+
+
+@pytest.mark.parametrize("policy, victim", [("lru", "old.mp4"), ("lfu", "rare.mp4")])
+def test_evict_by_policy(tier, monkeypatch, policy, victim):
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_POLICY", policy)
+    old, rare = _source(tier, "old.mp4"), _source(tier, "rare.mp4")
+    for path in (old, rare):
+        _play(path, 2).close()
+        _fill(path)
+    # "old" is played more often, "rare" more recently
+    execute(
+        "UPDATE media_cache SET hits = 10, last_access = 1 WHERE filepath = 'cached/old.mp4'"
+    )
+    execute(
+        "UPDATE media_cache SET hits = 1, last_access = 2 WHERE filepath = 'cached/rare.mp4'"
+    )
+
+    one = sum(
+        os.stat(media_cache.MEDIA_CACHE_DIR / f"{_key(old)}{ext}").st_blocks * 512
+        for ext in (".data", ".map")
+    )
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_BYTES", int(one * 1.5))
+    media_cache.evict()
+
+    left = {p.name for p in (old, rare)
+            if (media_cache.MEDIA_CACHE_DIR / f"{_key(p)}.data").exists()}
+    assert left == {"old.mp4", "rare.mp4"} - {victim}
+
+
+def test_evict_orphans_first(tier, monkeypatch):
+    path = _source(tier, "a.mp4")
+    _play(path, 2).close()
+    _fill(path)
+    orphan = media_cache.Entry("0000-1-1", BLOCK)
+    orphan.fill(0, os.urandom(BLOCK))
+    orphan.close()
+
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_BYTES", BLOCK * 5)
+    media_cache.evict()
+
+    assert not (media_cache.MEDIA_CACHE_DIR / "0000-1-1.data").exists()
+    assert (media_cache.MEDIA_CACHE_DIR / f"{_key(path)}.data").exists()
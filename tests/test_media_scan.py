@@ -0,0 +1,93 @@
+# tests/test_media_scan.py
+
+import shutil
+
+import pytest
+
+from config import MEDIA_DIR
+from models.base import execute, execute_many, query
+from services import media_scan, thumbnails
+
+
+@pytest.fixture
+def library(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails, "THUMB_DIR", tmp_path / "frames")
+    monkeypatch.setattr(thumbnails, "VARIANT_DIR", tmp_path / "sized")
+    MEDIA_DIR.mkdir(exist_ok=True)
+    for name in ("one.mp4", "two.mkv", "show/ep1.mp4"):
+        path = MEDIA_DIR / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(name.encode() * 100)
+    media_scan.scan_media()
+    yield MEDIA_DIR
+    shutil.rmtree(MEDIA_DIR, ignore_errors=True)
+
+
+def _indexed():
+    return {row["filepath"] for row in query("SELECT filepath FROM media_files")}
+
+
+def test_scan_indexes_library(library):
+    assert _indexed() >= {"one.mp4", "two.mkv", "show/ep1.mp4"}
+
+
+def test_empty_media_dir_keeps_catalog(library):
+    before = _indexed()
+    for child in library.iterdir():
+        shutil.rmtree(child) if child.is_dir() else child.unlink()
+
+    report = media_scan.scan_media()
+
+    assert report["removed"] == 0
+    assert _indexed() == before
+
+
+def test_missing_marker_keeps_catalog(library, monkeypatch):
+    monkeypatch.setattr(media_scan, "MEDIA_DIR_MARKER", ".mounted")
+    before = _indexed()
+    (library / "one.mp4").unlink()
+
+    assert media_scan.scan_media()["removed"] == 0
+    assert _indexed() == before
+
+
+def test_deleted_file_is_removed(library):
+    (library / "two.mkv").unlink()
+
+    assert media_scan.scan_media()["removed"] == 1
+    assert "two.mkv" not in _indexed()
+
+
+def test_removed_file_leaves_no_orphans(library):
+    thumbnails.THUMB_DIR.mkdir()
+    thumbnails.VARIANT_DIR.mkdir()
+
+    gone = query("SELECT media_id FROM media_files WHERE filepath = 'two.mkv'", one=True)["media_id"]
+    kept = query("SELECT media_id FROM media_files WHERE filepath = 'one.mp4'", one=True)["media_id"]
+    execute(
+        "INSERT INTO watch_history (user_id, media_id, progress) VALUES (1, ?, 50), (1, ?, 50)",
+        (gone, kept)
+    )
+    # identical thumbnails share a variant file
+    execute_many(
+        "INSERT INTO thumbnails (media_id, width, format, name) VALUES (?, ?, 'jpg', ?)",
+        [(gone, 320, "own.jpg"), (gone, 640, "shared.jpg"), (kept, 640, "shared.jpg")]
+    )
+    for name in ("own.jpg", "shared.jpg"):
+        (thumbnails.VARIANT_DIR / name).write_bytes(b"jpg")
+    (thumbnails.THUMB_DIR / f"{gone}.jpg").write_bytes(b"jpg")
+    execute(
+        "INSERT OR REPLACE INTO jobs (kind, key, status) VALUES ('thumbnail', ?, 'failed')",
+        (str(gone),)
+    )
+
+    (library / "two.mkv").unlink()
+    assert media_scan.scan_media()["removed"] == 1
+
+    for table in ("watch_history", "thumbnails"):
+        assert not query(f"SELECT 1 FROM {table} WHERE media_id = ?", (gone,))
+        assert query(f"SELECT 1 FROM {table} WHERE media_id = ?", (kept,))
+    assert not query("SELECT 1 FROM jobs WHERE key = ?", (str(gone),))
+    assert not (thumbnails.THUMB_DIR / f"{gone}.jpg").exists()
+    assert not (thumbnails.VARIANT_DIR / "own.jpg").exists()
+    assert (thumbnails.VARIANT_DIR / "shared.jpg").exists()
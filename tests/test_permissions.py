@@ -0,0 +1,91 @@
+# tests/test_permissions.py
+
+import os
+
+import pytest
+from flask import Flask, session
+
+from models.base import execute, query
+from services import permissions
+
+
+@pytest.fixture
+def user(db):
+    execute(
+        "INSERT INTO users (username, password, role, active) VALUES ('viewer', '-', 'user', 1)"
+    )
+    user_id = query("SELECT id FROM users WHERE username = 'viewer'", one=True)["id"]
+    permissions._users.clear()
+    yield user_id
+    execute("DELETE FROM users WHERE id = ?", (user_id,))
+    permissions._users.clear()
+
+
+def _disable(user_id):
+    execute("UPDATE users SET active = 0 WHERE id = ?", (user_id,))
+
+
+def test_get_user_is_cached(user):
+    assert permissions.get_user(user)["active"] == 1
+    _disable(user)
+    # within the TTL and nobody said it changed
+    assert permissions.get_user(user)["active"] == 1
+
+
+def test_get_user_expires(user, monkeypatch):
+    monkeypatch.setattr(permissions, "USER_CACHE_TTL", -1)
+    permissions.get_user(user)
+    _disable(user)
+    assert permissions.get_user(user)["active"] == 0
+
+
+def test_get_user_has_no_password(user):
+    assert set(permissions.get_user(user)) == {"id", "username", "role", "active"}
+
+
+def test_missing_user_is_none(db):
+    assert permissions.get_user(10 ** 9) is None
+
+
+def test_invalidate_user_revokes_at_once(user):
+    assert permissions.active_user(user)
+    _disable(user)
+    permissions.invalidate_user(user)
+    assert permissions.active_user(user) is None
+
+
+def test_invalidate_all_users(user):
+    permissions.get_user(user)
+    execute("UPDATE users SET role = 'admin' WHERE id = ?", (user,))
+    permissions.invalidate_user()
+    assert permissions.get_user(user)["role"] == "admin"
+
+
+def test_invalidate_user_reaches_other_workers(user):
+    permissions.get_user(user)
+    _disable(user)
+
+    # a forked worker (as serve.py starts them) handles the admin request
+    pid = os.fork()
+    if pid == 0:
+        try:
+            permissions.invalidate_user(user)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert permissions.active_user(user) is None
+
+
+def test_revoked_session_is_cleared(user):
+    app = Flask(__name__)
+    app.secret_key = "test"
+    with app.test_request_context():
+        session["user_id"] = user
+        session["role"] = "user"
+        assert permissions.get_current_user()["id"] == user
+
+        _disable(user)
+        permissions.invalidate_user(user)
+        assert permissions.get_current_user() is None
+        assert "user_id" not in session
@@ -0,0 +1,107 @@
+# tests/test_remux.py
+
+import os
+import struct
+
+import pytest
+
+from services import remux
+from services.remux import _valid_length
+
+
+def box(kind, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def large_box(kind, payload=b""):
+    return struct.pack(">I4sQ", 1, kind, 16 + len(payload)) + payload
+
+
+INIT = box(b"ftyp", b"isom") + box(b"moov", b"x" * 40)
+FRAGMENT = box(b"moof", b"y" * 24) + box(b"mdat", b"z" * 100)
+
+
+@pytest.fixture
+def cache_file(tmp_path):
+    fds = []
+
+    def open_with(data):
+        path = tmp_path / "stream.mp4"
+        path.write_bytes(data)
+        fd = os.open(path, os.O_RDONLY)
+        fds.append(fd)
+        return fd
+
+    yield open_with
+    for fd in fds:
+        os.close(fd)
+
+
+@pytest.mark.parametrize("data, expected", [
+    (b"", 0),
+    (INIT, len(INIT)),
+    (INIT + FRAGMENT * 2, len(INIT + FRAGMENT * 2)),
+    # cut inside the mdat, before it, and inside a box header
+    (INIT + FRAGMENT + FRAGMENT[:-10], len(INIT + FRAGMENT)),
+    (INIT + FRAGMENT + box(b"moof", b"y" * 24), len(INIT + FRAGMENT)),
+    (INIT + FRAGMENT[:5], len(INIT)),
+    # only the ftyp: no init segment yet
+    (box(b"ftyp", b"isom"), 0),
+])
+def test_valid_length(cache_file, data, expected):
+    assert _valid_length(cache_file(data)) == expected
+
+
+def test_valid_length_64bit_box(cache_file):
+    data = INIT + box(b"moof", b"y" * 24) + large_box(b"mdat", b"z" * 100)
+    assert _valid_length(cache_file(data)) == len(data)
+
+
+def test_valid_length_stops_at_corrupt_size(cache_file):
+    data = INIT + struct.pack(">I4s", 4, b"moof") + FRAGMENT
+    assert _valid_length(cache_file(data)) == len(INIT)
+
+
+# ----------------------------
+# ffmpeg slots
+# ----------------------------
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    monkeypatch.setattr(remux, "REMUX_DIR", tmp_path / "remux")
+    monkeypatch.setattr(remux, "REMUX_MAX_LIVE", 1)
+    monkeypatch.setattr(remux, "_live", 0)
+    path = tmp_path / "movie.mkv"
+    path.write_bytes(b"x" * 100)
+    return path
+
+
+def _open(path, start=0.0):
+    return remux.open_stream(path, "movie.mkv", os.stat(path), start, "remux")
+
+
+def test_open_stream_reserves_a_slot(source):
+    first = _open(source)
+    assert first is not None and remux._live == 1
+    # full: refused before any response is sent
+    assert _open(source, 5.0) is None
+    assert remux._live == 1
+
+    first.close()
+    assert remux._live == 0
+    second = _open(source, 5.0)
+    assert second is not None
+    second.close()
+
+
+def test_complete_cache_needs_no_slot(source):
+    done = _open(source)
+    done.done_path.touch()
+    done.close()
+
+    blocker = _open(source, 5.0)
+    stream = _open(source)
+    assert stream is not None and remux._live == 1
+    stream.close()
+    blocker.close()
+    assert remux._live == 0
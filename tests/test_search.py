@@ -0,0 +1,27 @@
+# tests/test_search.py
+
+import pytest
+
+from services.search import match_expression
+
+
+@pytest.mark.parametrize("q, expected", [
+    ("car", '"car"*'),
+    ("car mo", '"car"* "mo"*'),
+    ("  spaced   out ", '"spaced"* "out"*'),
+    ('say "hi"', '"say"* "hi"*'),
+    ("AND OR NOT", '"AND"* "OR"* "NOT"*'),
+    ("café", '"café"*'),
+    ("日本", '"日本"*'),
+])
+def test_match_expression(q, expected):
+    assert match_expression(q) == expected
+
+
+@pytest.mark.parametrize("q", ["", "   ", "-- !!", '""'])
+def test_match_expression_nothing_searchable(q):
+    assert match_expression(q) is None
+
+
+def test_match_expression_category():
+    assert match_expression("mood", category='Hip "Hop"') == '"mood"* AND category : "Hip Hop"'
@@ -0,0 +1,108 @@
+# tests/test_streaming.py
+
+import os
+
+import pytest
+from werkzeug.datastructures import Headers
+
+from config import STREAM_MAX_RANGE, STREAM_MAX_RANGES
+from services.streaming import RangeNotSatisfiable, make_etag, parse_range, plan_file
+
+
+# ----------------------------
+# parse_range
+# ----------------------------
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", [(0, 99)]),
+    ("bytes=100-", [(100, 999)]),
+    ("bytes=-100", [(900, 999)]),
+    ("bytes=-5000", [(0, 999)]),
+    ("bytes=900-5000", [(900, 999)]),
+    ("bytes=0-9, 5-19, 30-39", [(0, 19), (30, 39)]),
+    ("bytes=50-59,0-9", [(0, 9), (50, 59)]),
+    ("bytes=0-9,10-19", [(0, 19)]),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    None,
+    "",
+    "items=0-9",
+    "bytes=abc-def",
+    "bytes=10-5",
+    "bytes=5",
+    "bytes=" + ",".join(f"{i * 10}-{i * 10 + 1}" for i in range(STREAM_MAX_RANGES + 1)),
+])
+def test_parse_range_ignored(header):
+    assert parse_range(header, 1000) is None
+
+
+def test_parse_range_open_end_is_capped():
+    size = STREAM_MAX_RANGE * 3
+    assert parse_range("bytes=0-", size) == [(0, STREAM_MAX_RANGE - 1)]
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=2000-3000", "bytes=-0"])
+def test_parse_range_not_satisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, 1000)
+
+
+# ----------------------------
+# plan_file
+# ----------------------------
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(os.urandom(1000))
+    return path
+
+
+def test_plan_file_full_body(video):
+    plan = plan_file(video, Headers())
+    assert plan.status == 200
+    assert plan.parts == [(b"", 0, 999)]
+    assert plan.headers["Content-Length"] == "1000"
+    assert plan.headers["Content-Type"] == "video/mp4"
+    assert plan.headers["ETag"] == make_etag(video.stat())
+
+
+def test_plan_file_single_range(video):
+    plan = plan_file(video, Headers({"Range": "bytes=100-199"}))
+    assert plan.status == 206
+    assert plan.parts == [(b"", 100, 199)]
+    assert plan.headers["Content-Range"] == "bytes 100-199/1000"
+    assert plan.headers["Content-Length"] == "100"
+
+
+def test_plan_file_multiple_ranges(video):
+    plan = plan_file(video, Headers({"Range": "bytes=0-9,500-509"}))
+    assert plan.status == 206
+    assert [(start, end) for _prefix, start, end in plan.parts] == [(0, 9), (500, 509)]
+    assert plan.headers["Content-Type"].startswith("multipart/byteranges; boundary=")
+    body = sum(len(prefix) + end - start + 1 for prefix, start, end in plan.parts)
+    assert int(plan.headers["Content-Length"]) == body + len(plan.trailer)
+
+
+def test_plan_file_not_satisfiable(video):
+    plan = plan_file(video, Headers({"Range": "bytes=5000-"}))
+    assert plan.status == 416
+    assert plan.headers["Content-Range"] == "bytes */1000"
+    assert plan.parts == []
+
+
+def test_plan_file_not_modified(video):
+    etag = make_etag(video.stat())
+    plan = plan_file(video, Headers({"If-None-Match": etag}))
+    assert plan.status == 304
+    assert plan.parts == []
+
+
+def test_plan_file_stale_if_range_sends_everything(video):
+    plan = plan_file(video, Headers({"Range": "bytes=0-9", "If-Range": '"stale"'}))
+    assert plan.status == 200
+    assert plan.parts == [(b"", 0, 999)]
@@ -0,0 +1,40 @@
+# tests/test_thumbnails.py
+
+import pytest
+
+from services import thumbnails
+from services.cache import catalog_version
+
+
+@pytest.fixture
+def fresh(monkeypatch):
+    monkeypatch.setattr(thumbnails, "_unpublished", 0)
+    monkeypatch.setattr(thumbnails, "_bumped_at", 0.0)
+
+
+def _finish_one():
+    thumbnails._unpublished += 1
+    thumbnails._publish(drained=False)
+
+
+def test_first_thumbnail_bumps_at_once(fresh):
+    before = catalog_version()
+    _finish_one()
+    assert catalog_version() == before + 1
+
+
+def test_backfill_bumps_once_per_interval(fresh):
+    _finish_one()
+    before = catalog_version()
+    for _ in range(50):
+        _finish_one()
+    assert catalog_version() == before
+
+    thumbnails._publish()  # the queue drained
+    assert catalog_version() == before + 1
+
+
+def test_idle_without_thumbnails_keeps_version(fresh):
+    before = catalog_version()
+    thumbnails._publish()
+    assert catalog_version() == before
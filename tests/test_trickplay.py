@@ -0,0 +1,31 @@
+# tests/test_trickplay.py
+
+from config import TRICKPLAY_COLUMNS
+from services.trickplay import build_vtt
+
+
+def test_build_vtt_cues():
+    vtt = build_vtt("/t/abc.jpg", 25.5, 10, 3, 160, 90)
+    assert vtt.splitlines() == [
+        "WEBVTT",
+        "",
+        "00:00:00.000 --> 00:00:10.000",
+        "/t/abc.jpg#xywh=0,0,160,90",
+        "",
+        "00:00:10.000 --> 00:00:20.000",
+        "/t/abc.jpg#xywh=160,0,160,90",
+        "",
+        "00:00:20.000 --> 00:00:25.500",
+        "/t/abc.jpg#xywh=320,0,160,90",
+    ]
+
+
+def test_build_vtt_wraps_rows():
+    tiles = TRICKPLAY_COLUMNS + 1
+    vtt = build_vtt("s.jpg", tiles * 5, 5, tiles, 100, 50)
+    assert vtt.splitlines()[-1] == "s.jpg#xywh=0,50,100,50"
+
+
+def test_build_vtt_long_timestamps():
+    vtt = build_vtt("s.jpg", 3 * 3600 + 1.25, 3600, 4, 100, 50)
+    assert "03:00:00.000 --> 03:00:01.250" in vtt
@@ -0,0 +1,211 @@
+# tests/test_uploads.py
+
+import base64
+import hashlib
+import io
+import os
+
+import pytest
+
+from config import MEDIA_DIR, UPLOAD_MAX_CHUNK, UPLOAD_MIN_CHUNK
+from models.base import execute, query
+from services import uploads
+from services.uploads import UploadError
+
+CHUNK = UPLOAD_MIN_CHUNK
+
+
+@pytest.fixture
+def data(db):
+    return os.urandom(CHUNK * 2 + 1000)
+
+
+@pytest.fixture
+def upload(data):
+    status = uploads.create_upload("clip.mp4", len(data), "Clip", chunk_size=CHUNK)
+    yield status
+    try:
+        uploads.abort_upload(status["id"])
+    except UploadError:
+        pass
+
+
+def _chunk(data, index):
+    return data[index * CHUNK:(index + 1) * CHUNK]
+
+
+def _send(upload, data, index, checksum=None):
+    body = _chunk(data, index)
+    return uploads.write_chunk(upload["id"], index, io.BytesIO(body), len(body), checksum)
+
+
+def _send_all(upload, data):
+    for index in reversed(range(upload["chunks"])):
+        _send(upload, data, index)
+
+
+# ----------------------------
+# Create
+# ----------------------------
+
+def test_create_preallocates(upload, data):
+    assert upload["chunks"] == 3
+    assert upload["received"] == [] and upload["offset"] == 0
+    assert uploads.part_path(upload["id"]).stat().st_size == len(data)
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"filename": "evil.exe"},
+    {"title": ""},
+    {"size": 0},
+    {"size": "10"},
+    {"size": True},
+    {"chunk_size": "abc"},
+    {"chunk_size": 0},
+    {"chunk_size": -CHUNK},
+    {"chunk_size": True},
+    {"chunk_size": 1.5 * CHUNK},
+    {"chunk_size": UPLOAD_MIN_CHUNK - 1},
+])
+def test_create_rejects(db, kwargs):
+    args = {"filename": "clip.mp4", "size": 1000, "title": "Clip", **kwargs}
+    with pytest.raises(UploadError) as e:
+        uploads.create_upload(args.pop("filename"), args.pop("size"), args.pop("title"), **args)
+    assert e.value.status == 400
+
+
+def test_create_caps_chunk_size(db):
+    status = uploads.create_upload("big.mp4", 1000, "Big", chunk_size=UPLOAD_MAX_CHUNK * 2)
+    assert status["chunk_size"] == UPLOAD_MAX_CHUNK
+    uploads.abort_upload(status["id"])
+
+
+# ----------------------------
+# Chunks
+# ----------------------------
+
+def test_chunks_in_any_order(upload, data):
+    status = _send(upload, data, 2)
+    assert status["received"] == [2] and status["offset"] == 0
+    status = _send(upload, data, 0)
+    assert status["received"] == [0, 2] and status["offset"] == CHUNK
+
+
+def test_chunk_checksum(upload, data):
+    good = base64.b64encode(hashlib.sha256(_chunk(data, 0)).digest()).decode()
+    assert _send(upload, data, 0, f"sha256 {good}")["received"] == [0]
+
+    with pytest.raises(UploadError) as e:
+        _send(upload, data, 1, f"sha256 {good}")
+    assert e.value.status == 460
+
+
+@pytest.mark.parametrize("index, length, status", [(3, None, 416), (-1, None, 416), (0, 10, 400)])
+def test_chunk_rejects(upload, index, length, status):
+    with pytest.raises(UploadError) as e:
+        uploads.write_chunk(upload["id"], index, io.BytesIO(b"x" * 10), length)
+    assert e.value.status == status
+
+
+def test_truncated_chunk(upload):
+    with pytest.raises(UploadError):
+        uploads.write_chunk(upload["id"], 0, io.BytesIO(b"short"), None)
+    assert uploads.upload_status(upload["id"])["received"] == []
+
+
+# ----------------------------
+# Complete
+# ----------------------------
+
+def test_complete_needs_every_chunk(upload, data):
+    _send(upload, data, 0)
+    with pytest.raises(UploadError) as e:
+        uploads.complete_upload(upload["id"])
+    assert e.value.status == 409
+
+
+def test_complete_links_file_once(upload, data):
+    _send_all(upload, data)
+    result = uploads.complete_upload(upload["id"])
+
+    assert (MEDIA_DIR / result["filepath"]).read_bytes() == data
+    assert not uploads.part_path(upload["id"]).exists()
+    assert query("SELECT title FROM media WHERE id = ?", (result["media_id"],), one=True)["title"] == "Clip"
+    # a retried complete answers the same
+    assert uploads.complete_upload(upload["id"]) == result
+
+
+def test_chunk_after_complete(upload, data):
+    _send_all(upload, data)
+    uploads.complete_upload(upload["id"])
+    with pytest.raises(UploadError) as e:
+        _send(upload, data, 0)
+    assert e.value.status == 409
+
+
+def _stale_lookup(monkeypatch, row):
+    """
+    The chunk request read `row` just before another request changed
+    the upload; later lookups see the change.
+    """
+    real = uploads.get_upload
+    calls = []
+
+    def get_upload(upload_id):
+        calls.append(upload_id)
+        return row if len(calls) == 1 else real(upload_id)
+
+    monkeypatch.setattr(uploads, "get_upload", get_upload)
+
+
+def test_chunk_racing_complete(upload, data, monkeypatch):
+    _send_all(upload, data)
+    row = uploads.get_upload(upload["id"])
+    uploads.complete_upload(upload["id"])
+    _stale_lookup(monkeypatch, row)
+
+    with pytest.raises(UploadError) as e:
+        _send(upload, data, 0)
+    assert e.value.status == 409
+
+
+def test_reserve_name_never_replaces(db):
+    MEDIA_DIR.mkdir(exist_ok=True)
+    names = [uploads.reserve_name("same.mp4") for _ in range(3)]
+    assert names == ["same.mp4", "same-1.mp4", "same-2.mp4"]
+    for name in names:
+        (MEDIA_DIR / name).unlink()
+
+
+# ----------------------------
+# Expiry
+# ----------------------------
+
+def test_expire_drops_stale_uploads(upload, data):
+    _send(upload, data, 0)
+    execute(
+        "UPDATE uploads SET updated_at = datetime('now', '-2 days') WHERE id = ?",
+        (upload["id"],)
+    )
+
+    assert uploads.expire_uploads(hours=24) == 1
+    assert not uploads.part_path(upload["id"]).exists()
+    assert not query("SELECT 1 FROM upload_chunks WHERE upload_id = ?", (upload["id"],))
+    with pytest.raises(UploadError) as e:
+        uploads.get_upload(upload["id"])
+    assert e.value.status == 404
+
+
+def test_expire_keeps_recent_uploads(upload):
+    assert uploads.expire_uploads(hours=24) == 0
+    assert uploads.get_upload(upload["id"])
+
+
+def test_chunk_racing_expiry(upload, data, monkeypatch):
+    row = uploads.get_upload(upload["id"])
+    uploads.abort_upload(upload["id"])
+    _stale_lookup(monkeypatch, row)
+
+    with pytest.raises(UploadError) as e:
+        _send(upload, data, 0)
+    assert e.value.status == 404
@@ -0,0 +1,41 @@
+# tests/test_watch.py
+
+import pytest
+
+from services.watch import parse_progress
+
+
+def test_parse_progress_position():
+    assert parse_progress({"media_id": "7", "position": 30, "duration": 120}) == (7, 25, 30.0)
+
+
+def test_parse_progress_position_capped_at_100():
+    assert parse_progress({"media_id": 7, "position": 500, "duration": 120}) == (7, 100, 500.0)
+
+
+def test_parse_progress_unknown_duration(db):
+    # not probed and no duration posted: resume point kept, percent unknown
+    assert parse_progress({"media_id": 999, "position": 30}) == (999, 0, 30.0)
+
+
+def test_parse_progress_legacy_percent():
+    assert parse_progress({"media_id": 7, "progress": 40}) == (7, 40, None)
+
+
+@pytest.mark.parametrize("data", [
+    {},
+    {"media_id": "x", "progress": 10},
+    {"media_id": 7},
+    {"media_id": 7, "progress": 101},
+    {"media_id": 7, "progress": -1},
+    {"media_id": 7, "progress": "NaN"},
+    {"media_id": 7, "position": -5, "duration": 100},
+    {"media_id": 7, "position": "nan", "duration": 100},
+    {"media_id": 7, "position": "inf", "duration": 100},
+    {"media_id": 7, "position": 10, "duration": "inf"},
+    {"media_id": 7, "position": 10, "duration": -100},
+    {"media_id": 7, "position": [1], "duration": 100},
+])
+def test_parse_progress_rejects(data):
+    with pytest.raises(ValueError):
+        parse_progress(data)